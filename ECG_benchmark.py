@@ -0,0 +1,752 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime, timezone
+from time import perf_counter
+import numpy as np
+from ECG_processor import (take_in_data, clean_missing, extreme_detection,
+                           analyze_strip,
+                           fourier_transform, ideal_filter, find_R_wave,
+                           fetch_metrics, produce_dict, output_file,
+                           band_pass_filter, filter_mask, FILTER_ENGINES,
+                           DETECTOR_ENGINES)
+from ECG_output import write_binary, read_binary
+
+
+def synthetic_ecg(duration, fs=250, hr_bpm=75, noise=0.05, missing=0.0,
+                  seed=0, drift=0.0):
+    """Generate a synthetic ECG strip with known beat times
+
+    Every beat is a narrow Gaussian R wave of height 1 on top of a slow
+    baseline wander and white noise. The RR intervals vary by a few
+    percent around 60 / hr_bpm seconds. A fraction missing of the
+    voltage samples is set to nan. With a drift the height of the R
+    waves swings by that fraction over a period of 120 seconds, as the
+    amplitude does in long recordings.
+
+    Args:
+        duration (float): the length of the strip in seconds
+        fs (float): the sampling frequency in Hz
+        hr_bpm (float): the mean heart rate in beats per minute
+        noise (float): the standard deviation of the white noise
+        missing (float): the fraction of voltage samples set to nan
+        seed (int): the seed of the random generator
+        drift (float): the relative swing of the R wave height
+
+    Returns:
+        array: the time array
+        array: the voltage array
+        array: the times of the beats
+    """
+    rng = np.random.default_rng(seed)
+    time = np.arange(int(duration * fs)) / fs
+    interval = 60.0 / hr_bpm
+    count = int(duration / interval) + 1
+    beats = 0.3 + np.cumsum(interval * rng.uniform(0.95, 1.05, count))
+    beats = beats[beats < time[-1] - 0.3]
+    voltage = 0.3 * np.sin(2 * np.pi * 0.15 * time)
+    voltage += noise * rng.normal(size=time.size)
+    width = int(0.05 * fs)
+    offsets = np.arange(-width, width + 1)
+    centers = np.round(beats * fs).astype(int)
+    index = centers[:, None] + offsets
+    shape = np.exp(-(offsets / (0.01 * fs)) ** 2)
+    height = 1 + drift * np.sin(2 * np.pi * centers / fs / 120)
+    np.add.at(voltage, index, height[:, None] * shape)
+    if missing > 0:
+        voltage[rng.random(voltage.size) < missing] = np.nan
+    return time, voltage, centers / fs
+
+
+def write_synthetic_csv(path, duration, fs=250, hr_bpm=75, noise=0.05,
+                        missing=0.0, seed=0):
+    """Write a synthetic ECG strip as a two-column .csv file
+
+    Args:
+        path (string): the output file path
+        duration (float): the length of the strip in seconds
+        fs (float): the sampling frequency in Hz
+        hr_bpm (float): the mean heart rate in beats per minute
+        noise (float): the standard deviation of the white noise
+        missing (float): the fraction of voltage samples set to nan
+        seed (int): the seed of the random generator
+
+    Returns:
+        array: the times of the beats
+    """
+    time, voltage, beats = synthetic_ecg(duration, fs, hr_bpm, noise,
+                                         missing, seed)
+    np.savetxt(path, np.c_[time, voltage], delimiter=",", fmt="%.6f",
+               header="time,voltage", comments="")
+    return beats
+
+
+def measure(function, *args, repeat=3, **kwargs):
+    """Time a function and record the peak memory it allocates
+
+    The wall time is the best of repeat calls. The peak memory is
+    traced with tracemalloc in one extra call, so the tracing does not
+    slow down the timed calls.
+
+    Args:
+        function (function): the function to measure
+        *args: the positional arguments of the function
+        repeat (int): the number of timed calls
+        **kwargs: the keyword arguments of the function
+
+    Returns:
+        dictionary: the best wall time in seconds and the peak memory in
+        bytes
+    """
+    best = np.inf
+    for i in range(repeat):
+        start = perf_counter()
+        function(*args, **kwargs)
+        best = min(best, perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": best, "peak_bytes": peak}
+
+
+def benchmark_filters(durations, fs=250, engines=FILTER_ENGINES, repeat=3):
+    """Compare the band-pass filter engines across record lengths
+
+    Args:
+        durations (list): the record lengths in seconds
+        fs (float): the sampling frequency in Hz
+        engines (list): the engines of band_pass_filter to compare
+        repeat (int): the number of timed calls per measurement
+
+    Returns:
+        list: one result per record length and engine
+    """
+    results = []
+    for duration in durations:
+        time, voltage, _ = synthetic_ecg(duration, fs)
+        for engine in engines:
+            result = measure(band_pass_filter, time, voltage, engine,
+                             repeat=repeat)
+            result = _stage_result("band_pass_filter", result, duration,
+                                   fs, len(voltage), voltage.nbytes)
+            result["engine"] = engine
+            results.append(result)
+    return results
+
+
+def benchmark_filter_batch(durations, fs=250, count=100, repeat=3):
+    """Compare the ideal filter with and without filter plans on a batch
+
+    For every record length a batch of count strips of that length is
+    filtered, once by fourier_transform and ideal_filter on the full
+    spectrum, as the original pipeline did, and once by the "ideal"
+    engine of band_pass_filter. Its mask cache is cleared before every
+    timed batch, so the time includes building the one mask it needs.
+
+    Args:
+        durations (list): the record lengths in seconds
+        fs (float): the sampling frequency in Hz
+        count (int): the number of strips in a batch
+        repeat (int): the number of timed batches per measurement
+
+    Returns:
+        list: one result per record length and engine
+    """
+    def full_spectrum(time, batch):
+        for voltage in batch:
+            f_index, freq_ECG = fourier_transform(time, voltage)
+            np.real(ideal_filter(f_index, voltage, freq_ECG))
+
+    def planned(time, batch):
+        filter_mask.cache_clear()
+        for voltage in batch:
+            band_pass_filter(time, voltage, "ideal")
+    results = []
+    for duration in durations:
+        batch = []
+        for seed in range(count):
+            time, voltage, _ = synthetic_ecg(duration, fs, seed=seed)
+            batch.append(voltage)
+        for engine, function in (("full_spectrum", full_spectrum),
+                                 ("planned", planned)):
+            result = measure(function, time, batch, repeat=repeat)
+            result = _stage_result("filter_batch", result, duration, fs,
+                                   len(time) * count,
+                                   sum(v.nbytes for v in batch))
+            result["engine"] = engine
+            result["count"] = count
+            results.append(result)
+    return results
+
+
+def _nearest_distance(times, reference):
+    """Give the distance of every time to the nearest reference time
+
+    Args:
+        times (array): the times to measure
+        reference (array): the sorted reference times, not empty
+
+    Returns:
+        array: the distance of every time in seconds
+    """
+    index = np.searchsorted(reference, times)
+    after = reference[np.minimum(index, len(reference) - 1)]
+    before = reference[np.maximum(index - 1, 0)]
+    return np.minimum(np.abs(after - times), np.abs(before - times))
+
+
+def score_beats(detected, truth, tolerance=0.05):
+    """Compare detected beat times with the true ones
+
+    A true beat is found when a detected beat lies within tolerance
+    seconds of it.
+
+    Args:
+        detected (array): the sorted detected beat times
+        truth (array): the sorted true beat times
+        tolerance (float): the largest timing error in seconds
+
+    Returns:
+        float: the sensitivity, the fraction of true beats found
+        float: the positive predictive value, the fraction of detected
+        beats that are true
+    """
+    detected = np.asarray(detected, dtype=np.float64)
+    truth = np.asarray(truth, dtype=np.float64)
+    if len(detected) == 0 or len(truth) == 0:
+        return 0.0, 0.0
+    error = _nearest_distance(truth, detected)
+    found = int(np.sum(error <= tolerance))
+    return found / len(truth), min(found, len(detected)) / len(detected)
+
+
+def benchmark_detectors(durations, fs=250, engines=DETECTOR_ENGINES,
+                        drifts=(0.0, 0.6), noise=0.05, repeat=3):
+    """Compare the accuracy and speed of the R peak detector engines
+
+    Every engine of find_R_wave runs on the filtered synthetic strips,
+    with and without amplitude drift, and its beats are scored against
+    the true beat times with score_beats.
+
+    Args:
+        durations (list): the record lengths in seconds
+        fs (float): the sampling frequency in Hz
+        engines (list): the engines of find_R_wave to compare
+        drifts (list): the relative swings of the R wave height
+        noise (float): the standard deviation of the white noise
+        repeat (int): the number of timed calls per measurement
+
+    Returns:
+        list: one result per record length, drift and engine
+    """
+    results = []
+    for duration in durations:
+        for drift in drifts:
+            time, voltage, beats = synthetic_ecg(duration, fs, noise=noise,
+                                                 drift=drift)
+            recovered_time = np.real(band_pass_filter(time, voltage))
+            for engine in engines:
+                result = measure(find_R_wave, recovered_time, True, engine,
+                                 fs, repeat=repeat)
+                result = _stage_result("find_R_wave", result, duration, fs,
+                                       len(voltage), recovered_time.nbytes)
+                beat_index = find_R_wave(recovered_time, True, engine, fs)[4]
+                sensitivity, ppv = score_beats(time[beat_index], beats)
+                result.update({"engine": engine, "drift": drift,
+                               "sensitivity": sensitivity, "ppv": ppv})
+                results.append(result)
+    return results
+
+
+def benchmark_decimation(durations, fs=1000, engines=DETECTOR_ENGINES,
+                         targets=(None, "auto"), noise=0.05, repeat=3,
+                         work_dir=None):
+    """Compare the analysis of fast recordings with and without decimation
+
+    A synthetic strip is written for every record length and analyzed by
+    analyze_strip with every detector engine and decimation target. The
+    time is the best total of the stages after the cleaning, since the
+    decimation does not change the cost of reading the file. The beats
+    are scored against the true beat times, and the largest error of a
+    found beat shows the resolution kept by refine_peaks.
+
+    Args:
+        durations (list): the record lengths in seconds
+        fs (float): the sampling frequency in Hz
+        engines (list): the engines of find_R_wave to compare
+        targets (list): the decimate arguments of analyze_strip
+        noise (float): the standard deviation of the white noise
+        repeat (int): the number of timed calls per measurement
+        work_dir (string): the directory for the temporary files
+
+    Returns:
+        list: one result per record length, engine and target
+    """
+    temp_dir = tempfile.mkdtemp(dir=work_dir)
+    results = []
+    try:
+        for duration in durations:
+            path = os.path.join(temp_dir, "strip.csv")
+            beats = write_synthetic_csv(path, duration, fs, noise=noise)
+            for engine in engines:
+                for target in targets:
+                    best = None
+                    for _ in range(repeat):
+                        metrics = []
+                        answer = analyze_strip(path, detector=engine,
+                                               decimate=target,
+                                               metrics=metrics)
+                        seconds = sum(m["wall_seconds"] for m in metrics
+                                      if m["stage"] not in ("take_in_data",
+                                                            "clean_missing"))
+                        best = seconds if best is None else min(best,
+                                                                seconds)
+                    detected = np.asarray(answer["beats"])
+                    sensitivity, ppv = score_beats(detected, beats)
+                    result = _stage_result("analysis", {"seconds": best},
+                                           duration, fs, int(duration * fs),
+                                           os.path.getsize(path))
+                    result.update({"engine": engine, "decimate": target,
+                                   "sensitivity": sensitivity, "ppv": ppv,
+                                   "max_error": None})
+                    if detected.size and len(beats):
+                        result["max_error"] = float(
+                            _nearest_distance(detected, beats).max())
+                    results.append(result)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+
+def _stage_result(stage, result, duration, fs, samples, input_bytes):
+    """Complete one measurement with the description of its input"""
+    result.update({"stage": stage, "engine": None, "duration": duration,
+                   "fs": fs, "samples": samples,
+                   "input_bytes": input_bytes,
+                   "samples_per_second": (samples / result["seconds"]
+                                          if result["seconds"] else None)})
+    return result
+
+
+def benchmark_pipeline(durations, fs=250, noise=0.05, missing=0.0,
+                       repeat=3, work_dir=None):
+    """Time and memory-profile every stage of the pipeline
+
+    For every record length a synthetic strip is written to a .csv
+    file and passed through take_in_data, clean_missing,
+    fourier_transform, ideal_filter, find_R_wave, fetch_metrics and
+    output_file in turn. Each stage is measured on the output of the
+    stage before it.
+
+    Args:
+        durations (list): the record lengths in seconds
+        fs (float): the sampling frequency in Hz
+        noise (float): the standard deviation of the white noise
+        missing (float): the fraction of voltage samples set to nan
+        repeat (int): the number of timed calls per measurement
+        work_dir (string): the directory for the temporary files
+
+    Returns:
+        list: one result per record length and stage
+    """
+    temp_dir = tempfile.mkdtemp(dir=work_dir)
+    results = []
+
+    def stage(name, samples, input_bytes, function, *args):
+        output = function(*args)
+        result = measure(function, *args, repeat=repeat)
+        results.append(_stage_result(name, result, duration, fs, samples,
+                                     input_bytes))
+        return output
+
+    try:
+        for duration in durations:
+            path = os.path.join(temp_dir, "strip.csv")
+            write_synthetic_csv(path, duration, fs, noise=noise,
+                                missing=missing)
+            samples = int(duration * fs)
+            time, voltage = stage("take_in_data", samples,
+                                  os.path.getsize(path), take_in_data, path)
+            time, voltage, _ = stage("clean_missing", samples,
+                                     time.nbytes + voltage.nbytes,
+                                     clean_missing, time, voltage)
+            samples = len(time)
+            f_index, freq_ECG = stage("fourier_transform", samples,
+                                      voltage.nbytes, fourier_transform,
+                                      time, voltage)
+            recovered_time = stage("ideal_filter", samples, freq_ECG.nbytes,
+                                   ideal_filter, f_index, voltage, freq_ECG)
+            recovered_time = np.real(recovered_time)
+            peaks = stage("find_R_wave", samples, recovered_time.nbytes,
+                          find_R_wave, recovered_time, True)
+            metrics = stage("fetch_metrics", samples, time.nbytes,
+                            fetch_metrics, *peaks[:4], time, recovered_time,
+                            peaks[4])
+            patient_dict = produce_dict(metrics[0],
+                                        extreme_detection(voltage),
+                                        *metrics[1:])
+            stage("output_file", samples, metrics[3].nbytes, output_file,
+                  patient_dict, os.path.join(temp_dir, "strip"))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+
+_RSS_CODE = """
+import sys, json
+import numpy as np
+from ECG_processor import analyze_strip, _max_rss
+
+
+def peak():
+    try:
+        with open("/proc/self/status") as in_file:
+            for line in in_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return _max_rss()
+
+
+dtype = np.dtype(sys.argv[3]).type
+analyze_strip(sys.argv[1], dtype)
+before = peak()
+analyze_strip(sys.argv[2], dtype)
+print(json.dumps([before, peak()]))
+"""
+
+
+def _rss_growth(warm_path, path, dtype):
+    """Measure how much one analyze_strip call raises the peak RSS
+
+    The strip is analyzed in a new process, after a warm-up call on a
+    short strip so the imports and the first allocations are not
+    counted. On Linux the peak is read from VmHWM, because ru_maxrss
+    keeps the peak of the parent process across fork and exec.
+
+    Returns:
+        int: the growth of the peak RSS in bytes, None where the
+        platform does not tell
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", _RSS_CODE, warm_path, path,
+         np.dtype(dtype).name],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE, check=True).stdout
+    before, after = json.loads(output.decode())
+    return None if before is None else after - before
+
+
+def benchmark_memory(durations, fs=250, dtypes=(np.float64, np.float32),
+                     repeat=3, work_dir=None):
+    """Compare the memory of the array path with the size of the signal
+
+    For every record length and floating point type a synthetic strip
+    is read by take_in_data and analyzed by analyze_strip. The peak
+    memory traced by tracemalloc is set against signal_bytes, the size
+    of the time and voltage arrays, as peak_ratio. For analyze_strip
+    the growth of the peak RSS of a fresh process analyzing the strip
+    is recorded too, as rss_growth_bytes and rss_ratio.
+
+    Args:
+        durations (list): the record lengths in seconds
+        fs (float): the sampling frequency in Hz
+        dtypes (list): the floating point types to compare
+        repeat (int): the number of timed calls per measurement
+        work_dir (string): the directory for the temporary files
+
+    Returns:
+        list: one result per record length, type and stage
+    """
+    temp_dir = tempfile.mkdtemp(dir=work_dir)
+    results = []
+    try:
+        warm_path = os.path.join(temp_dir, "warm.csv")
+        write_synthetic_csv(warm_path, 5, fs)
+        for duration in durations:
+            path = os.path.join(temp_dir, "strip.csv")
+            write_synthetic_csv(path, duration, fs)
+            samples = int(duration * fs)
+            input_bytes = os.path.getsize(path)
+            for dtype in dtypes:
+                signal_bytes = 2 * samples * np.dtype(dtype).itemsize
+                for stage, function in (("take_in_data", take_in_data),
+                                        ("analyze_strip", analyze_strip)):
+                    result = measure(function, path, dtype, repeat=repeat)
+                    result = _stage_result(stage, result, duration, fs,
+                                           samples, input_bytes)
+                    result.update({
+                        "engine": np.dtype(dtype).name,
+                        "signal_bytes": signal_bytes,
+                        "peak_ratio": result["peak_bytes"] / signal_bytes})
+                    if function is analyze_strip:
+                        rss = _rss_growth(warm_path, path, dtype)
+                        result["rss_growth_bytes"] = rss
+                        result["rss_ratio"] = (None if rss is None
+                                               else rss / signal_bytes)
+                    results.append(result)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+
+def benchmark_csv(sizes, fs=250, repeat=3, work_dir=None):
+    """Compare the fast and the fallback .csv parsers of take_in_data
+
+    For every file size a synthetic strip of about that many megabytes
+    is written and read by take_in_data with and without the fast
+    typed parser.
+
+    Args:
+        sizes (list): the file sizes in megabytes
+        fs (float): the sampling frequency in Hz
+        repeat (int): the number of timed calls per measurement
+        work_dir (string): the directory for the temporary files
+
+    Returns:
+        list: one result per file size and parser
+    """
+    temp_dir = tempfile.mkdtemp(dir=work_dir)
+    results = []
+    try:
+        for size in sizes:
+            path = os.path.join(temp_dir, "strip.csv")
+            # Every sample is written as about 20 characters
+            duration = size * 2 ** 20 / 20 / fs
+            write_synthetic_csv(path, duration, fs)
+            input_bytes = os.path.getsize(path)
+            for engine, fast in (("fast", True), ("pandas", False)):
+                result = measure(take_in_data, path, fast=fast,
+                                 repeat=repeat)
+                result = _stage_result("take_in_data", result, duration,
+                                       fs, int(duration * fs), input_bytes)
+                result["engine"] = engine
+                results.append(result)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+
+def benchmark_output(durations, hr_bpm=75, repeat=3, work_dir=None):
+    """Compare the JSON and the binary output of beat-level results
+
+    For every record length a result with the beats of that length is
+    written by output_file and by write_binary and loaded back by
+    json.load and by read_binary. Both loads are followed by the sum of
+    the beat times, so the binary arrays are really read from their
+    memory map.
+
+    Args:
+        durations (list): the record lengths in seconds
+        hr_bpm (float): the mean heart rate in beats per minute
+        repeat (int): the number of timed calls per measurement
+        work_dir (string): the directory for the temporary files
+
+    Returns:
+        list: one result per record length, format and direction, with
+        the size of the file
+    """
+    def load_json(path):
+        with open(path) as in_file:
+            return np.sum(json.load(in_file)["beats"])
+
+    def load_binary(path):
+        return np.sum(read_binary(path)["beats"])
+    temp_dir = tempfile.mkdtemp(dir=work_dir)
+    rng = np.random.default_rng(0)
+    results = []
+    try:
+        for duration in durations:
+            count = int(duration * hr_bpm / 60)
+            beats = np.cumsum(60 / hr_bpm * (1 + 0.03 *
+                                             rng.standard_normal(count)))
+            patient_dict = produce_dict(float(duration), (1.5, -0.5),
+                                        count, hr_bpm, beats)
+            name = os.path.join(temp_dir, "strip")
+            formats = (("json", name + ".json",
+                        lambda: output_file(patient_dict, name), load_json),
+                       ("binary", name + ".ecgb",
+                        lambda: write_binary(name + ".ecgb", patient_dict),
+                        load_binary))
+            for engine, path, write, load in formats:
+                for stage, function, args in (("output_write", write, ()),
+                                              ("output_load", load,
+                                               (path,))):
+                    result = measure(function, *args, repeat=repeat)
+                    result = _stage_result(stage, result, duration, None,
+                                           count, os.path.getsize(path))
+                    result.update({"engine": engine,
+                                   "file_bytes": os.path.getsize(path)})
+                    results.append(result)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+
+def environment():
+    """Describe the machine and library versions of a benchmark run
+
+    Returns:
+        dictionary: the time, Python, numpy and platform of the run
+    """
+    import scipy
+    import pandas
+    return {"created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "pandas": pandas.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()}
+
+
+def compare_results(baseline, current, tolerance=0.1):
+    """Find the measurements that got slower than the baseline
+
+    Results are matched on stage, engine, duration, sampling frequency,
+    drift and decimation. A result is a regression when it takes more than
+    1 + tolerance times the baseline wall time.
+
+    Args:
+        baseline (list): the results of the earlier run
+        current (list): the results of the new run
+        tolerance (float): the allowed relative slowdown
+
+    Returns:
+        list: the stage, engine, duration, fs and slowdown ratio of every
+        regression
+    """
+    def key(result):
+        return (result["stage"], result.get("engine"), result["duration"],
+                result["fs"], result.get("drift"), result.get("decimate"))
+    before = {key(result): result for result in baseline}
+    regressions = []
+    for result in current:
+        old = before.get(key(result))
+        if old is None or not old["seconds"]:
+            continue
+        ratio = result["seconds"] / old["seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append({"stage": result["stage"],
+                                "engine": result.get("engine"),
+                                "duration": result["duration"],
+                                "fs": result["fs"],
+                                "ratio": ratio})
+    return regressions
+
+
+def main(argv=None):
+    """Run the benchmarks and write the results as JSON
+
+    With a baseline file the results are compared with it and the exit
+    status is 1 when any measurement got slower than the tolerance.
+
+    Args:
+        argv (list): the command line arguments, sys.argv if None
+
+    Returns:
+        int: the exit status
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ECG processing pipeline")
+    parser.add_argument("--suite",
+                        choices=["pipeline", "filters", "filter-batch",
+                                 "csv", "detectors", "decimation",
+                                 "output", "memory"],
+                        nargs="+", default=["pipeline", "filters"],
+                        help="benchmarks to run")
+    parser.add_argument("--durations", type=float, nargs="+",
+                        default=[10, 60, 600, 3600],
+                        help="record lengths in seconds, up to 86400")
+    parser.add_argument("--fs", type=float, default=250,
+                        help="sampling frequency in Hz")
+    parser.add_argument("--fast-fs", type=float, default=1000,
+                        help="sampling frequency in Hz for the decimation "
+                        "suite")
+    parser.add_argument("--noise", type=float, default=0.05,
+                        help="standard deviation of the white noise")
+    parser.add_argument("--missing", type=float, default=0.0,
+                        help="fraction of missing voltage samples")
+    parser.add_argument("--engines", nargs="+", choices=FILTER_ENGINES,
+                        default=list(FILTER_ENGINES),
+                        help="filter engines to compare")
+    parser.add_argument("--detectors", nargs="+", choices=DETECTOR_ENGINES,
+                        default=list(DETECTOR_ENGINES),
+                        help="R peak detector engines to compare")
+    parser.add_argument("--drifts", type=float, nargs="+",
+                        default=[0.0, 0.6],
+                        help="R wave height swings for the detectors suite")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="strips per batch for the filter-batch suite")
+    parser.add_argument("--csv-sizes", type=float, nargs="+",
+                        default=[100],
+                        help="file sizes in megabytes for the csv suite")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed calls per measurement")
+    parser.add_argument("-o", "--output", default=None,
+                        help="write the results to this .json file")
+    parser.add_argument("--compare", default=None,
+                        help="baseline .json file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed relative slowdown against the baseline")
+    args = parser.parse_args(argv)
+    logging.getLogger().addHandler(logging.NullHandler())
+    results = []
+    if "pipeline" in args.suite:
+        results.extend(benchmark_pipeline(args.durations, args.fs,
+                                          args.noise, args.missing,
+                                          args.repeat))
+    if "filters" in args.suite:
+        results.extend(benchmark_filters(args.durations, args.fs,
+                                         args.engines, args.repeat))
+    if "filter-batch" in args.suite:
+        results.extend(benchmark_filter_batch(args.durations, args.fs,
+                                              args.batch_size, args.repeat))
+    if "detectors" in args.suite:
+        results.extend(benchmark_detectors(args.durations, args.fs,
+                                           args.detectors, args.drifts,
+                                           args.noise, args.repeat))
+    if "decimation" in args.suite:
+        results.extend(benchmark_decimation(args.durations, args.fast_fs,
+                                            args.detectors,
+                                            noise=args.noise,
+                                            repeat=args.repeat))
+    if "output" in args.suite:
+        results.extend(benchmark_output(args.durations, repeat=args.repeat))
+    if "memory" in args.suite:
+        results.extend(benchmark_memory(args.durations, args.fs,
+                                        repeat=args.repeat))
+    if "csv" in args.suite:
+        results.extend(benchmark_csv(args.csv_sizes, args.fs, args.repeat))
+    report = {"environment": environment(), "results": results}
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as out_file:
+            out_file.write(text)
+    if args.compare is not None:
+        with open(args.compare) as in_file:
+            baseline = json.load(in_file)["results"]
+        regressions = compare_results(baseline, results, args.tolerance)
+        for regression in regressions:
+            print("Regression: {stage} ({engine}) at {duration} s "
+                  "is {ratio:.2f}x slower".format(**regression),
+                  file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,391 @@
+import os
+import json
+import hashlib
+import threading
+from functools import lru_cache
+import numpy as np
+import ECG_readers
+import ECG_processor
+from ECG_processor import take_in_data, clean_missing, _json_default, \
+    _logger
+from ECG_readers import record_files
+
+RESULT_SUFFIX = ".result.json"
+MISSING_COUNTS = ("missing", "time_missing", "voltage_missing")
+
+
+def cache_key(path, dtype=np.float64):
+    """Build the cache key of an ECG file
+
+    The key is a hash of the absolute path, the modification time and
+    the size of the file, and the floating point type of the cached
+    arrays. Editing or replacing the file gives a new key.
+
+    Args:
+        path (string): the inputted file path
+        dtype (type): the floating point type, np.float64 or np.float32
+
+    Returns:
+        string: the hexadecimal cache key
+    """
+    stat = os.stat(path)
+    text = "{}|{}|{}|{}".format(os.path.abspath(path), stat.st_mtime_ns,
+                                stat.st_size, np.dtype(dtype).name)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _cache_entries(cache_dir, suffixes=(".npy", ".json")):
+    """List the entries of the cache with their sizes
+
+    Args:
+        cache_dir (string): the cache directory
+        suffixes (tuple): the file suffixes of an entry, the first one
+        names the entries
+
+    Returns:
+        list: (modification time, size, key) of every entry, oldest first
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(suffixes[0]):
+            continue
+        key = name[:-len(suffixes[0])]
+        size = 0
+        mtime = 0
+        for suffix in suffixes:
+            try:
+                stat = os.stat(os.path.join(cache_dir, key + suffix))
+            except FileNotFoundError:
+                continue
+            size = size + stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+        entries.append((mtime, size, key))
+    entries.sort()
+    return entries
+
+
+def evict_cache(cache_dir, max_bytes, keep=None,
+                suffixes=(".npy", ".json")):
+    """Remove the least recently used entries until the cache fits
+
+    An entry is marked as used whenever it is written or read, so the
+    entries are removed oldest first until the total size is at most
+    max_bytes.
+
+    Args:
+        cache_dir (string): the cache directory
+        max_bytes (int): the size limit of the cache in bytes
+        keep (string): a key that must not be removed
+        suffixes (tuple): the file suffixes of an entry
+
+    Returns:
+        int: the number of removed entries
+    """
+    entries = _cache_entries(cache_dir, suffixes)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, key in entries:
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        for suffix in suffixes:
+            try:
+                os.remove(os.path.join(cache_dir, key + suffix))
+            except FileNotFoundError:
+                pass
+        total = total - size
+        removed = removed + 1
+    return removed
+
+
+def _write_entry(cache_dir, key, data, meta):
+    """Write one cache entry so readers never see a partial file
+
+    Args:
+        cache_dir (string): the cache directory
+        key (string): the cache key
+        data (array): the 2 x n array of time and voltage
+        meta (dictionary): the information stored next to the array
+    """
+    base = os.path.join(cache_dir, key)
+    temp = "{}.{}.{}.tmp".format(base, os.getpid(), threading.get_ident())
+    with open(temp, "wb") as out_file:
+        np.save(out_file, data)
+    os.replace(temp, base + ".npy")
+    with open(temp, "w") as out_file:
+        json.dump(meta, out_file)
+    os.replace(temp, base + ".json")
+
+
+def load_cached_data(path, cache_dir, max_bytes=None, rebuild=False,
+                     dtype=np.float64, report=False):
+    """Take in the cleaned data of an ECG file through the binary cache
+
+    On the first call the file is parsed with take_in_data, the missing
+    data is removed with clean_missing and the two arrays are written
+    as one .npy file in the cache directory. Later calls memory-map that
+    file instead of parsing the CSV again, and repeat the missing data
+    messages of the first parse in the log. The numbers of missing
+    samples are kept with the entry and returned when report is True,
+    since they can no longer be counted in the cleaned arrays. An entry
+    without them is parsed again. With rebuild set to True
+    the file is always parsed and the entry written again. After a new
+    entry is written the least recently used entries are removed to
+    keep the cache under max_bytes.
+
+    Args:
+        path (string): the inputted file path
+        cache_dir (string): the cache directory
+        max_bytes (int): the size limit of the cache in bytes, if any
+        rebuild (bool): parse the file even if it is in the cache
+        dtype (type): the floating point type, np.float64 or np.float32
+        report (bool): also return the numbers of missing samples
+
+    Returns:
+        array: the time array without missing data
+        array: the voltage array without missing data
+        dictionary: the number of missing samples and the number missing
+        in each column, only when report is True
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cache_key(path, dtype)
+    base = os.path.join(cache_dir, key)
+    if not rebuild and os.path.exists(base + ".npy"):
+        try:
+            with open(base + ".json") as in_file:
+                meta = json.load(in_file)
+            missing = {name: meta[name] for name in MISSING_COUNTS}
+            data = np.load(base + ".npy", mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            _logger().warning("Cache entry for %s is unreadable", path)
+        else:
+            os.utime(base + ".npy")
+            os.utime(base + ".json")
+            _logger().info("Start a new ECG trace")
+            _logger().info("Loaded cached ECG trace %s", key)
+            if meta["time_missing"]:
+                _logger().error("There is missing data in time list")
+            if meta["voltage_missing"]:
+                _logger().error("There is missing data in voltage list")
+            if report:
+                return data[0], data[1], missing
+            return data[0], data[1]
+    time, voltage = take_in_data(path, dtype)
+    time, voltage, cleaned = clean_missing(time, voltage)
+    missing = {name: cleaned[name] for name in MISSING_COUNTS}
+    meta = dict(missing, source=os.path.abspath(path))
+    _write_entry(cache_dir, key, np.stack((time, voltage)), meta)
+    if max_bytes is not None:
+        evict_cache(cache_dir, max_bytes, keep=key)
+    data = np.load(base + ".npy", mmap_mode="r")
+    if report:
+        return data[0], data[1], missing
+    return data[0], data[1]
+
+
+@lru_cache(maxsize=None)
+def code_version():
+    """Hash the source code of the analysis pipeline
+
+    Any change to ECG_processor or ECG_readers gives a new version, so
+    results computed by older code are never taken from the cache.
+
+    Returns:
+        string: the hexadecimal hash of the source files
+    """
+    digest = hashlib.sha1()
+    for module in (ECG_processor, ECG_readers):
+        with open(module.__file__, "rb") as in_file:
+            digest.update(in_file.read())
+    return digest.hexdigest()
+
+
+def pipeline_config(dtype=np.float64, filter_engine="ideal",
+                    detector="legacy", hrv_window=None, hrv_step=None,
+                    quality=None, quality_limits=None, decimate=None,
+                    rr_series=False):
+    """Describe the configuration that the results depend on
+
+    Args:
+        dtype (type): the floating point type, np.float64 or np.float32
+        filter_engine (string): the engine of band_pass_filter
+        detector (string): the engine of find_R_wave
+        hrv_window (float): the window of windowed_metrics, if any
+        hrv_step (float): the step of windowed_metrics, if any
+        quality (string): the quality mode of analyze_strip, if any
+        quality_limits (dictionary): the limits of assess_quality
+        decimate (float): the target rate of decimate_signal, if any
+        rr_series (bool): the RR intervals are added to the HRV windows
+
+    Returns:
+        dictionary: the filter cutoffs, the peak height threshold, the
+        filter and detector engines, the HRV windows and RR series, the
+        quality mode and limits, the decimation, the floating point
+        type and the code version
+    """
+    limits = None
+    if quality is not None:
+        limits = dict(ECG_processor.QUALITY_LIMITS, **(quality_limits or {}))
+    return {"low_cutoff": ECG_processor.LOW_CUTOFF,
+            "high_cutoff": ECG_processor.HIGH_CUTOFF,
+            "peak_height": ECG_processor.PEAK_HEIGHT,
+            "filter_engine": filter_engine,
+            "detector": detector,
+            "hrv_window": hrv_window,
+            "hrv_step": hrv_step,
+            "rr_series": rr_series,
+            "quality": quality,
+            "quality_limits": limits,
+            "decimate": decimate,
+            "dtype": np.dtype(dtype).name,
+            "code_version": code_version()}
+
+
+def content_hash(path, block=2**20):
+    """Hash the contents of every file of an ECG record
+
+    Args:
+        path (string): the inputted file path
+        block (int): the number of bytes read at once
+
+    Returns:
+        string: the hexadecimal hash of the contents
+    """
+    digest = hashlib.sha1()
+    for name in record_files(path):
+        with open(name, "rb") as in_file:
+            for data in iter(lambda: in_file.read(block), b""):
+                digest.update(data)
+    return digest.hexdigest()
+
+
+def result_key(path, dtype=np.float64, filter_engine="ideal",
+               detector="legacy", hrv_window=None, hrv_step=None,
+               quality=None, quality_limits=None, decimate=None,
+               rr_series=False):
+    """Build the result cache key of an ECG file
+
+    The key is a hash of the contents of the file and of the pipeline
+    configuration, so it does not depend on the path or the time of the
+    file, and changes whenever the input or a parameter changes.
+
+    Args:
+        path (string): the inputted file path
+        dtype (type): the floating point type, np.float64 or np.float32
+        filter_engine (string): the engine of band_pass_filter
+        detector (string): the engine of find_R_wave
+        hrv_window (float): the window of windowed_metrics, if any
+        hrv_step (float): the step of windowed_metrics, if any
+        quality (string): the quality mode of analyze_strip, if any
+        quality_limits (dictionary): the limits of assess_quality
+        decimate (float): the target rate of decimate_signal, if any
+        rr_series (bool): the RR intervals are added to the HRV windows
+
+    Returns:
+        string: the hexadecimal result key
+    """
+    config = json.dumps(pipeline_config(dtype, filter_engine, detector,
+                                        hrv_window, hrv_step, quality,
+                                        quality_limits, decimate, rr_series),
+                        sort_keys=True)
+    text = "{}|{}".format(content_hash(path), config)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def load_result(result_dir, key):
+    """Take a stored result out of the result cache
+
+    Args:
+        result_dir (string): the directory of the result cache
+        key (string): the result key
+
+    Returns:
+        dictionary: the output of produce_dict, None if not cached
+    """
+    name = os.path.join(result_dir, key + RESULT_SUFFIX)
+    try:
+        with open(name) as in_file:
+            patient_dict = json.load(in_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        _logger().warning("Result cache entry %s is unreadable", key)
+        return None
+    os.utime(name)
+    _logger().info("Start a new ECG trace")
+    _logger().info("Loaded cached result %s", key)
+    patient_dict["voltage_extremes"] = tuple(patient_dict["voltage_extremes"])
+    patient_dict["beats"] = np.asarray(patient_dict["beats"],
+                                       dtype=np.float64)
+    return patient_dict
+
+
+def store_result(result_dir, key, patient_dict, max_bytes=None):
+    """Put a result into the result cache
+
+    The entry is written so readers never see a partial file. Then the
+    least recently used results are removed to keep the cache under
+    max_bytes.
+
+    Args:
+        result_dir (string): the directory of the result cache
+        key (string): the result key
+        patient_dict (dictionary): the output of produce_dict
+        max_bytes (int): the size limit of the cache in bytes, if any
+    """
+    os.makedirs(result_dir, exist_ok=True)
+    name = os.path.join(result_dir, key + RESULT_SUFFIX)
+    temp = "{}.{}.{}.tmp".format(name, os.getpid(), threading.get_ident())
+    with open(temp, "w") as out_file:
+        json.dump(patient_dict, out_file, default=_json_default)
+    os.replace(temp, name)
+    if max_bytes is not None:
+        evict_cache(result_dir, max_bytes, keep=key,
+                    suffixes=(RESULT_SUFFIX,))
+
+
+def plan_results(paths, result_dir, dtype=np.float64, filter_engine="ideal",
+                 detector="legacy", hrv_window=None, hrv_step=None,
+                 quality=None, quality_limits=None, decimate=None,
+                 rr_series=False):
+    """Report which files would be recomputed, without analyzing any
+
+    Args:
+        paths (list): the file paths to check
+        result_dir (string): the directory of the result cache
+        dtype (type): the floating point type, np.float64 or np.float32
+        filter_engine (string): the engine of band_pass_filter
+        detector (string): the engine of find_R_wave
+        hrv_window (float): the window of windowed_metrics, if any
+        hrv_step (float): the step of windowed_metrics, if any
+        quality (string): the quality mode of analyze_strip, if any
+        quality_limits (dictionary): the limits of assess_quality
+        decimate (float): the target rate of decimate_signal, if any
+        rr_series (bool): the RR intervals are added to the HRV windows
+
+    Returns:
+        dictionary: the counts of cached files and files to recompute,
+        and the path, key and state of every file
+    """
+    files = []
+    for path in paths:
+        entry = {"path": path, "key": None, "cached": False, "error": None}
+        try:
+            entry["key"] = result_key(path, dtype, filter_engine, detector,
+                                      hrv_window, hrv_step, quality,
+                                      quality_limits, decimate, rr_series)
+        except OSError as e:
+            entry["error"] = "{}: {}".format(type(e).__name__, e)
+        else:
+            entry["cached"] = os.path.exists(
+                os.path.join(result_dir, entry["key"] + RESULT_SUFFIX))
+        files.append(entry)
+    cached = sum(entry["cached"] for entry in files)
+    return {"total": len(files),
+            "cached": cached,
+            "recompute": len(files) - cached,
+            "config": pipeline_config(dtype, filter_engine, detector,
+                                      hrv_window, hrv_step, quality,
+                                      quality_limits, decimate, rr_series),
+            "files": files}
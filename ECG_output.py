@@ -0,0 +1,360 @@
+import os
+import abc
+import glob
+import json
+import queue
+import struct
+import sqlite3
+import threading
+import numpy as np
+from ECG_processor import output_file, _json_default, _logger
+
+RESULT_FILES = {"jsonl": "results.jsonl", "sqlite": "results.sqlite"}
+BINARY_SUFFIX = ".ecgb"
+BINARY_MAGIC = b"ECGB"
+BINARY_VERSION = 1
+BINARY_PREFIX = struct.Struct("<4sH2xQ")
+BEAT_ARRAYS = ("beats", "consensus_beats")
+
+
+def _binary_blocks(result, path, header, blocks, rr_dtype):
+    """Move the beat arrays of a result into blocks, depth first"""
+    for key, value in result.items():
+        if isinstance(value, dict):
+            header[key] = {}
+            _binary_blocks(value, path + [key], header[key], blocks,
+                           rr_dtype)
+        elif key in BEAT_ARRAYS and value is not None:
+            beats = np.asarray(value, dtype="<f8")
+            header[key] = None
+            blocks.append((path + [key], beats))
+            if key == "beats":
+                header["rr_ms"] = None
+                rr_ms = np.diff(beats) * 1000
+                blocks.append((path + ["rr_ms"], rr_ms.astype(
+                    np.dtype(rr_dtype).newbyteorder("<"))))
+        else:
+            header[key] = value
+
+
+def write_binary(path, result, rr_dtype=np.float32):
+    """Write a result as a JSON header followed by binary beat arrays
+
+    The file starts with the magic bytes ECGB, the format version and
+    the length of the header. The header is the JSON text of the result
+    with null in place of every beat array, and the list of the blocks:
+    the place of the array in the result, its type and its offset after
+    the header. The blocks follow, little-endian and 8-byte aligned. The
+    beat times are always float64, since float32 loses milliseconds
+    after a few hours. Next to every "beats" array, its RR intervals in
+    milliseconds are stored as "rr_ms", in rr_dtype.
+
+    Args:
+        path (string): the output file path
+        result (dictionary): the metrics of the ECG file
+        rr_dtype (type): the floating point type of the RR intervals
+    """
+    scalars = {}
+    blocks = []
+    _binary_blocks(result, [], scalars, blocks, rr_dtype)
+    arrays = []
+    offset = 0
+    for place, array in blocks:
+        arrays.append({"path": place, "dtype": array.dtype.str,
+                       "count": len(array), "offset": offset})
+        offset = offset + -(-array.nbytes // 8) * 8
+    header = json.dumps({"result": scalars, "arrays": arrays},
+                        default=_json_default).encode("utf-8")
+    header = header + b" " * (-len(header) % 8)
+    with open(path, "wb") as out_file:
+        out_file.write(BINARY_PREFIX.pack(BINARY_MAGIC, BINARY_VERSION,
+                                          len(header)))
+        out_file.write(header)
+        for _, array in blocks:
+            out_file.write(array.tobytes())
+            out_file.write(b"\0" * (-array.nbytes % 8))
+
+
+def read_binary(path):
+    """Load a result written by write_binary without copying the arrays
+
+    The beat arrays are read-only views of one memory map of the file,
+    so loading costs the same for any number of beats and only the
+    pages that are used are read from the disk.
+
+    Args:
+        path (string): the path of the .ecgb file
+
+    Returns:
+        dictionary: the result, with numpy arrays for the beats and
+        their RR intervals
+    """
+    with open(path, "rb") as in_file:
+        magic, version, length = BINARY_PREFIX.unpack(
+            in_file.read(BINARY_PREFIX.size))
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError("{} is not a version {} .ecgb file".format(
+                path, BINARY_VERSION))
+        header = json.loads(in_file.read(length))
+    result = header["result"]
+    if not header["arrays"]:
+        return result
+    data = np.memmap(path, np.uint8, mode="r")
+    start = BINARY_PREFIX.size + length
+    for block in header["arrays"]:
+        dtype = np.dtype(block["dtype"])
+        first = start + block["offset"]
+        array = data[first:first + block["count"] * dtype.itemsize]
+        target = result
+        for key in block["path"][:-1]:
+            target = target[key]
+        target[block["path"][-1]] = array.view(dtype)
+    return result
+
+
+class ResultWriter(abc.ABC):
+    """Write analysis results on a background thread
+
+    write only puts the result on a bounded queue, so the analysis
+    never waits for the disk unless the writer falls max_pending
+    results behind. The writer thread takes the results off the queue
+    in batches of up to batch_size and hands every batch to
+    _write_batch, which every writer implements. An error of the writer
+    thread is raised by the next write or by close. Used as a context
+    manager, the writer is closed on leaving the block, and an error of
+    close is only logged when the block already raised, so it never
+    hides the original exception.
+
+    Every result is keyed by the file name of its ECG file, as given
+    by path_leaf.
+
+    Args:
+        target (string): the file or directory the results go to
+        batch_size (int): the largest number of results written at once
+        max_pending (int): the largest number of results in the queue
+    """
+
+    def __init__(self, target, batch_size=256, max_pending=4096):
+        self.target = target
+        self.written = 0
+        self._batch_size = batch_size
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, name, result):
+        """Queue one result
+
+        Args:
+            name (string): the file name of the ECG file
+            result (dictionary): the metrics of the ECG file
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put((name, result))
+
+    def close(self):
+        """Write the queued results and stop the writer thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except Exception:
+            if exc_type is None:
+                raise
+            _logger().exception("Failed to close the result writer")
+
+    def _run(self):
+        """Take the results off the queue and write them in batches"""
+        try:
+            self._open()
+        except Exception as e:
+            self._error = e
+        done = False
+        while not done:
+            batch = []
+            item = self._queue.get()
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self._batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            done = item is None
+            if self._error is None and batch:
+                try:
+                    self._write_batch(batch)
+                    self.written = self.written + len(batch)
+                except Exception as e:
+                    self._error = e
+        try:
+            self._close()
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+
+    def _open(self):
+        """Open the target on the writer thread"""
+
+    def _close(self):
+        """Close the target on the writer thread"""
+
+    @abc.abstractmethod
+    def _write_batch(self, batch):
+        """Write a list of (name, result) pairs"""
+
+
+class JsonWriter(ResultWriter):
+    """Write every result to its own <name>.json file, as output_file"""
+
+    def _write_batch(self, batch):
+        for name, result in batch:
+            output_file(result, os.path.join(self.target, name))
+
+
+class JsonLinesWriter(ResultWriter):
+    """Append every result as one line of a JSON Lines file
+
+    Every line is an object with the "name" and the "result". A later
+    line for the same name replaces the earlier ones.
+    """
+
+    def _open(self):
+        self._file = open(self.target, "a")
+
+    def _write_batch(self, batch):
+        lines = [json.dumps({"name": name, "result": result},
+                            default=_json_default) + "\n"
+                 for name, result in batch]
+        self._file.write("".join(lines))
+        self._file.flush()
+
+    def _close(self):
+        if hasattr(self, "_file"):
+            self._file.close()
+
+
+class SQLiteWriter(ResultWriter):
+    """Store every result as one row of an SQLite table
+
+    The table results holds the name as its primary key, the scalar
+    metrics as columns for queries, and the whole result as JSON text.
+    Writing a name again replaces its row. Every batch is one
+    transaction.
+    """
+
+    def _open(self):
+        self._connection = sqlite3.connect(self.target)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (name TEXT PRIMARY KEY, "
+            "duration REAL, num_beats INTEGER, mean_hr_bpm REAL, "
+            "voltage_min REAL, voltage_max REAL, result TEXT)")
+        self._connection.commit()
+
+    def _write_batch(self, batch):
+        rows = []
+        for name, result in batch:
+            result = json.loads(json.dumps(result, default=_json_default))
+            extremes = result.get("voltage_extremes") or (None, None)
+            rows.append((name, result.get("duration"),
+                         result.get("num_beats"), result.get("mean_hr_bpm"),
+                         extremes[0], extremes[1], json.dumps(result)))
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows)
+
+    def _close(self):
+        if hasattr(self, "_connection"):
+            self._connection.close()
+
+
+class BinaryWriter(ResultWriter):
+    """Write every result to its own <name>.ecgb file, as write_binary"""
+
+    def _write_batch(self, batch):
+        for name, result in batch:
+            write_binary(os.path.join(self.target, name + BINARY_SUFFIX),
+                         result)
+
+
+WRITERS = {"json": JsonWriter, "jsonl": JsonLinesWriter,
+           "sqlite": SQLiteWriter, "binary": BinaryWriter}
+
+
+def open_writer(mode, out_dir=".", **options):
+    """Start a result writer of the given mode
+
+    The json mode writes <name>.json files into out_dir, the binary
+    mode <name>.ecgb files, the jsonl mode appends to
+    out_dir/results.jsonl and the sqlite mode writes to
+    out_dir/results.sqlite.
+
+    Args:
+        mode (string): the output mode, "json", "jsonl", "sqlite" or
+        "binary"
+        out_dir (string): the output directory
+        **options: the keyword arguments of ResultWriter
+
+    Returns:
+        ResultWriter: the running writer
+    """
+    if mode not in WRITERS:
+        raise ValueError("Unknown output mode {}".format(mode))
+    target = out_dir
+    if mode in RESULT_FILES:
+        target = os.path.join(out_dir, RESULT_FILES[mode])
+    return WRITERS[mode](target, **options)
+
+
+def read_results(mode, out_dir="."):
+    """Load the results written by open_writer
+
+    Args:
+        mode (string): the output mode, "json", "jsonl", "sqlite" or
+        "binary"
+        out_dir (string): the output directory
+
+    Returns:
+        dictionary: the result of every file name
+    """
+    results = {}
+    if mode == "json":
+        for path in sorted(glob.glob(os.path.join(out_dir, "*.json"))):
+            if path.endswith(".metrics.json"):
+                continue
+            with open(path) as in_file:
+                results[os.path.basename(path)[:-5]] = json.load(in_file)
+    elif mode == "binary":
+        pattern = os.path.join(out_dir, "*" + BINARY_SUFFIX)
+        for path in sorted(glob.glob(pattern)):
+            name = os.path.basename(path)[:-len(BINARY_SUFFIX)]
+            results[name] = read_binary(path)
+    elif mode == "jsonl":
+        with open(os.path.join(out_dir, RESULT_FILES[mode])) as in_file:
+            for line in in_file:
+                entry = json.loads(line)
+                results[entry["name"]] = entry["result"]
+    elif mode == "sqlite":
+        connection = sqlite3.connect(os.path.join(out_dir,
+                                                  RESULT_FILES[mode]))
+        try:
+            for name, text in connection.execute(
+                    "SELECT name, result FROM results ORDER BY name"):
+                results[name] = json.loads(text)
+        finally:
+            connection.close()
+    else:
+        raise ValueError("Unknown output mode {}".format(mode))
+    return results
@@ -1,13 +1,88 @@
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import math
 import logging
 import ntpath
-from numpy import nan
-from warnings import warn
-from scipy.signal import find_peaks
+import os
+import sys
+import glob
+import argparse
+from time import perf_counter, process_time
+from contextlib import contextmanager
+from functools import partial, lru_cache
+from itertools import compress
 import json
+import tempfile
+import threading
+import tracemalloc
+from ECG_readers import READERS, is_binary, read_signal, read_record, \
+    iter_record
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LOW_CUTOFF = 0.7
+HIGH_CUTOFF = 45
+PEAK_HEIGHT = 0.7
+FILTER_ENGINES = ("ideal", "sos", "fir")
+DETECTOR_ENGINES = ("legacy", "pan_tompkins", "adaptive")
+OUTPUT_MODES = ("json", "jsonl", "sqlite", "binary")
+FILTER_PLANS = 32
+VOLTAGE_RANGE = 300
+DECIMATE_MARGIN = 4
+QUALITY_MODES = ("flag", "reject")
+QUALITY_LIMITS = {"missing": 0.2, "flatline": 0.3, "clipping": 0.02,
+                  "out_of_range": 0.01, "snr_db": 3.0}
+STRIP_OPTIONS = ("quality", "result_dir", "decimate", "cache_dir",
+                 "cache_bytes")
+
+_job_state = threading.local()
+
+
+def _logger():
+    """Return the logger of the current job, the root logger outside a job
+
+    Returns:
+        Logger: the logger the stages write to
+    """
+    logger = getattr(_job_state, "logger", None)
+    return logging.getLogger() if logger is None else logger
+
+
+@contextmanager
+def job_logging(log_path=None, level=logging.INFO, name="ECG"):
+    """Give the code inside the block a logger of its own
+
+    The logger is private to the block: it is not registered with the
+    logging module and does not pass its messages on to the root
+    logger. It is kept in thread-local state, so every thread running a
+    block sees only its own logger and the log files of jobs that run
+    at the same time never mix. Blocks may be nested, the logger of the
+    outer block is restored on leaving the inner one. With a
+    log path the messages are written to that file, which is replaced,
+    in the format of logging.basicConfig.
+
+    Args:
+        log_path (string): the .log file of the job, if any
+        level (int): the lowest level that is logged
+        name (string): the name of the logger
+
+    Yields:
+        Logger: the logger of the job
+    """
+    logger = logging.Logger(name, level)
+    handler = None
+    if log_path is not None:
+        handler = logging.FileHandler(log_path, mode='w')
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        logger.addHandler(handler)
+    previous = getattr(_job_state, "logger", None)
+    _job_state.logger = logger
+    try:
+        yield logger
+    finally:
+        _job_state.logger = previous
+        if handler is not None:
+            handler.close()
 
 
 def path_leaf(path):
@@ -26,12 +101,34 @@ def path_leaf(path):
     return tail or ntpath.basename(head)
 
 
+def output_name(path, root=None):
+    """Give the name the outputs of an ECG file are stored under
+
+    Without a root the name is the file name, as given by path_leaf.
+    With a root it is the path of the file relative to root with every
+    separator escaped, so files of the same name in different folders
+    of an archive keep outputs of their own.
+
+    Args:
+        path (string): the inputted file path
+        root (string): the directory the name is relative to, if any
+
+    Returns:
+        string: the name of the outputs of the file
+    """
+    if root is None:
+        return path_leaf(path)
+    from urllib.parse import quote
+    relative = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    return quote(relative.replace(os.sep, "/"), safe="")
+
+
 def if_missing_time(time, voltage):
     """Detect and remove missing data in time column
 
     The whole data with time column and voltage column is
     given. This function detects the missing data in time
-    column and pop the nan out and the corresponding voltage.
+    column and drops the nan out and the corresponding voltage.
     The function also flags in logging file if missing data
     is in the time column.
 
@@ -43,17 +140,11 @@ def if_missing_time(time, voltage):
         array: the time array without missing data
         array: the voltage array
     """
-    time_na = []
-    count = 0
-    for i in range(len(time)):
-        if math.isnan(time[i]) is True:
-            time_na.append(i)
-    for j in time_na:
-        time.pop(j - count)
-        voltage.pop(j - count)
-        count = count + 1
-    if len(time_na) != 0:
-        logging.error("There is missing data in time list")
+    keep = ~np.isnan(np.asarray(time, dtype=float))
+    if not keep.all():
+        time = list(compress(time, keep))
+        voltage = list(compress(voltage, keep))
+        _logger().error("There is missing data in time list")
     return time, voltage
 
 
@@ -62,7 +153,7 @@ def if_missing_vol(time, voltage):
 
     The whole data with time column and voltage column is
     given. This function detects the missing data in voltage
-    column and pop the nan out and the corresponding time.
+    column and drops the nan out and the corresponding time.
     The function also flags in logging file if missing data
     is in the voltage column.
 
@@ -74,45 +165,298 @@ def if_missing_vol(time, voltage):
         array: the time array
         array: the voltage array without missing data
     """
-    vol_na = []
-    count = 0
-    for i in range(len(voltage)):
-        if math.isnan(voltage[i]) is True:
-            vol_na.append(i)
-    for j in vol_na:
-        time.pop(j - count)
-        voltage.pop(j - count)
-        count = count + 1
-    if len(vol_na) != 0:
-        logging.error("There is missing data in voltage list")
+    keep = ~np.isnan(np.asarray(voltage, dtype=float))
+    if not keep.all():
+        time = list(compress(time, keep))
+        voltage = list(compress(voltage, keep))
+        _logger().error("There is missing data in voltage list")
     return time, voltage
 
 
-def take_in_data(path):
+def _as_float_array(data):
+    """Return the data as a floating point array without copying it
+
+    Arrays that already hold floating point data (float64 or float32)
+    are returned as they are. Anything else is converted to float64.
+
+    Args:
+        data (array): the inputted data
+
+    Returns:
+        array: the floating point array
+    """
+    data = np.asarray(data)
+    if data.dtype.kind != 'f':
+        data = data.astype(np.float64)
+    return data
+
+
+def clean_missing(time, voltage, interpolate=False):
+    """Remove or interpolate missing data in both columns at once
+
+    The whole data with time column and voltage column is given.
+    This function builds one mask of the samples where the time or
+    the voltage is nan and drops those samples from both arrays.
+    With interpolate set to True the missing values are filled by
+    linear interpolation instead, the time over the sample index and
+    the voltage over the time. Missing times before the first or after
+    the last known time are extrapolated with the median sample
+    spacing, so the times stay strictly increasing. The same logging
+    messages as in if_missing_time and if_missing_vol are written. The
+    voltage can also be a 2-D array with one row per lead, then a
+    sample is missing when any of its leads is nan.
+
+    Args:
+        time (array): the inputted time data
+        voltage (array): the inputted voltage data, 1-D or leads x samples
+        interpolate (bool): fill the missing data instead of dropping it
+
+    Returns:
+        array: the time array without missing data
+        array: the voltage array without missing data
+        dictionary: the number of missing, removed and interpolated
+        samples, the number missing in each column and the indices of
+        the missing samples
+    """
+    time = _as_float_array(time)
+    voltage = _as_float_array(voltage)
+    time_na = np.isnan(time)
+    lead_na = np.isnan(voltage)
+    vol_na = lead_na if lead_na.ndim == 1 else lead_na.any(axis=0)
+    if time_na.any():
+        _logger().error("There is missing data in time list")
+    if vol_na.any():
+        _logger().error("There is missing data in voltage list")
+    missing = time_na | vol_na
+    indices = np.flatnonzero(missing)
+    report = {"missing": int(indices.size), "removed": 0,
+              "interpolated": 0,
+              "time_missing": int(time_na.sum()),
+              "voltage_missing": int(vol_na.sum()),
+              "indices": indices}
+    if indices.size == 0:
+        return time, voltage, report
+    if (interpolate and time_na.sum() < len(time) - 1 and
+            not lead_na.all(axis=-1).any()):
+        sample = np.arange(len(time))
+        known = np.flatnonzero(~time_na)
+        time = time.copy()
+        time[time_na] = np.interp(sample[time_na], known, time[known])
+        if time_na[0] or time_na[-1]:
+            spacing = np.median(np.diff(time[known]) / np.diff(known))
+            first, last = known[0], known[-1]
+            time[:first] = time[first] + (sample[:first] - first) * spacing
+            time[last + 1:] = time[last] + (sample[last + 1:] -
+                                            last) * spacing
+        voltage = voltage.copy()
+        for lead, lead_missing in zip(voltage.reshape(-1, len(time)),
+                                      lead_na.reshape(-1, len(time))):
+            lead[lead_missing] = np.interp(time[lead_missing],
+                                           time[~lead_missing],
+                                           lead[~lead_missing])
+        report["interpolated"] = int(indices.size)
+        _logger().info("Interpolated %d samples with missing data",
+                       indices.size)
+    else:
+        time = time[~missing]
+        voltage = voltage[..., ~missing]
+        report["removed"] = int(indices.size)
+        _logger().info("Removed %d samples with missing data", indices.size)
+    return time, voltage, report
+
+
+def _fast_read_csv(path, dtype=np.float64):
+    """Parse a plain numeric ECG file with the typed C parser of pandas
+
+    Every column is parsed straight to the given type in one pass,
+    without the intermediate object columns of to_numeric, so a float32
+    file never holds a float64 copy of its columns. Empty fields and
+    "nan" become nan. Any other text raises ValueError, so irregular
+    files can fall back to the tolerant path.
+
+    Args:
+        path (string): the inputted file path
+        dtype (type): the floating point type, np.float64 or np.float32
+
+    Returns:
+        DataFrame: the columns of the file in the given type
+    """
+    import pandas as pd
+    return pd.read_csv(path, dtype=dtype, engine="c")
+
+
+def _read_numeric_csv(path, fast=True, dtype=np.float64):
+    """Read an ECG file into a data frame of floating point columns
+
+    The fast typed parser is tried first. A file it cannot parse is
+    read again by pandas with the non numeric entries set to nan.
+
+    Args:
+        path (string): the inputted file path
+        fast (bool): try the fast typed parser first
+        dtype (type): the floating point type, np.float64 or np.float32
+
+    Returns:
+        DataFrame: the columns of the file in the given type
+    """
+    import pandas as pd
+    if fast:
+        try:
+            return _fast_read_csv(path, dtype)
+        except (ValueError, TypeError, OverflowError):
+            _logger().debug("Falling back to the tolerant parser for %s", path)
+    ECG = pd.read_csv(path)
+    return ECG.apply(pd.to_numeric, errors='coerce').astype(dtype)
+
+
+def take_in_data(path, dtype=np.float64, fast=True):
     """Take in the data in two arrays
 
     The path of the data is given. The function will take in this data
-    and transfer it into two arrays "time" and "voltage".
+    and transfer it into two contiguous arrays "time" and "voltage" of
+    the given floating point type. Entries that are not numbers become
+    nan. Plain numeric files are parsed by a fast typed parser, other
+    files fall back to pandas. Binary records (raw samples with a .hdr
+    header, WFDB .hea and EDF files) are memory-mapped by the readers
+    of ECG_readers and their first channel is taken.
 
     Args:
         path (string): the inputted file path
+        dtype (type): the floating point type, np.float64 or np.float32
+        fast (bool): try the fast typed parser first
 
     Returns:
         array: the time array
-        array: the voltage array without missing data
+        array: the voltage array
     """
-    ECG = pd.read_csv(path)
-    logging.info("Start a new ECG trace")
+    if is_binary(path):
+        _logger().info("Start a new ECG trace")
+        return read_signal(path, dtype)
+    ECG = _read_numeric_csv(path, fast, dtype)
+    _logger().info("Start a new ECG trace")
     ECG.columns = ["time", "voltage"]
-    ECG.time = pd.to_numeric(ECG.time, errors='coerce')
-    ECG.voltage = pd.to_numeric(ECG.voltage, errors='coerce')
-    time = list(ECG['time'])
-    voltage = list(ECG['voltage'])
-    for i in range(len(time)):
-        time[i] = float(time[i])
-    for i in range(len(voltage)):
-        voltage[i] = float(voltage[i])
-    return time, voltage
+    time = ECG.time.to_numpy(dtype=dtype)
+    voltage = ECG.voltage.to_numpy(dtype=dtype)
+    return np.ascontiguousarray(time), np.ascontiguousarray(voltage)
+
+
+def take_in_leads(path, dtype=np.float64, fast=True):
+    """Take in a multi-lead ECG file
+
+    The first column of the file is the time and every other column is
+    one lead. The leads are returned as one contiguous 2-D array with
+    one row per lead, so the later stages can process all the leads in
+    one batched operation. Entries that are not numbers become nan.
+    Every channel of a binary record is one lead.
+
+    Args:
+        path (string): the inputted file path
+        dtype (type): the floating point type, np.float64 or np.float32
+        fast (bool): try the fast typed parser first
+
+    Returns:
+        array: the time array
+        array: the voltage array, leads x samples
+        list: the names of the leads
+    """
+    if is_binary(path):
+        _logger().info("Start a new ECG trace")
+        return read_record(path, dtype)
+    ECG = _read_numeric_csv(path, fast, dtype)
+    _logger().info("Start a new ECG trace")
+    if len(ECG.columns) < 2:
+        raise ValueError("There is no lead column in {}".format(path))
+    names = [str(name) for name in ECG.columns[1:]]
+    data = ECG.to_numpy(dtype=dtype)
+    time = np.ascontiguousarray(data[:, 0])
+    voltage = np.ascontiguousarray(data[:, 1:].T)
+    return time, voltage, names
+
+
+def _parse_chunks(path, chunksize, dtype=np.float64):
+    """Parse a .csv ECG file piece by piece
+
+    Args:
+        path (string): the inputted file path
+        chunksize (int): the number of rows parsed at once
+        dtype (type): the floating point type, np.float64 or np.float32
+
+    Yields:
+        array: the time array of the piece
+        array: the voltage array of the piece
+    """
+    import pandas as pd
+    for ECG in pd.read_csv(path, chunksize=chunksize):
+        ECG.columns = ["time", "voltage"]
+        time = pd.to_numeric(ECG.time,
+                             errors='coerce').to_numpy(dtype=dtype)
+        voltage = pd.to_numeric(ECG.voltage,
+                                errors='coerce').to_numpy(dtype=dtype)
+        yield time, voltage
+
+
+def _read_chunks(path, chunksize, dtype=np.float64):
+    """Read an ECG file piece by piece and remove the missing data
+
+    Args:
+        path (string): the inputted file path
+        chunksize (int): the number of rows parsed at once
+        dtype (type): the floating point type, np.float64 or np.float32
+
+    Yields:
+        array: the time array of the piece without missing data
+        array: the voltage array of the piece without missing data
+    """
+    _logger().info("Start a new ECG trace")
+    if is_binary(path):
+        chunks = iter_record(path, chunksize, dtype)
+    else:
+        chunks = _parse_chunks(path, chunksize, dtype)
+    for time, voltage in chunks:
+        time, voltage, _ = clean_missing(time, voltage)
+        if len(time) != 0:
+            yield time, voltage
+
+
+def stream_data(path, window, overlap=0, chunksize=None,
+                dtype=np.float64):
+    """Read an ECG file as a sequence of fixed-size windows
+
+    The file is parsed piece by piece, so only about one window of
+    samples is held in memory at a time. The missing data is removed
+    as in clean_missing. Every window holds window samples and starts
+    window - overlap samples after the previous one. The last window
+    holds what is left and can be shorter.
+
+    Args:
+        path (string): the inputted file path
+        window (int): the number of samples in a window
+        overlap (int): the number of samples shared by two windows
+        chunksize (int): the number of rows parsed at once, window if None
+        dtype (type): the floating point type, np.float64 or np.float32
+
+    Yields:
+        array: the time array of the window
+        array: the voltage array of the window
+    """
+    if not 0 <= overlap < window:
+        raise ValueError("overlap must be at least 0 and less than window")
+    if chunksize is None:
+        chunksize = window
+    time_buffer = np.empty(0, dtype=dtype)
+    voltage_buffer = np.empty(0, dtype=dtype)
+    fresh = False
+    for time, voltage in _read_chunks(path, chunksize, dtype):
+        time_buffer = np.concatenate((time_buffer, time))
+        voltage_buffer = np.concatenate((voltage_buffer, voltage))
+        fresh = True
+        while len(time_buffer) >= window:
+            yield time_buffer[:window], voltage_buffer[:window]
+            time_buffer = time_buffer[window - overlap:]
+            voltage_buffer = voltage_buffer[window - overlap:]
+            fresh = len(time_buffer) > overlap
+    if fresh:
+        yield time_buffer, voltage_buffer
 
 
 def extreme_detection(voltage):
@@ -127,19 +471,206 @@ def extreme_detection(voltage):
     Returns:
         tuple: the voltage extremes with maximum and minimum
     """
-    voltage_extremes = (max(voltage), min(voltage))
-    if voltage_extremes[0] > 300 or voltage_extremes[1] < -300:
-        logging.warning('The voltages exceeded the normal range')
+    voltage_extremes = (float(np.max(voltage)), float(np.min(voltage)))
+    if (voltage_extremes[0] > VOLTAGE_RANGE or
+            voltage_extremes[1] < -VOLTAGE_RANGE):
+        _logger().warning('The voltages exceeded the normal range')
     return voltage_extremes
 
 
+def assess_quality(time, voltage, limits=None, flat_run=0.5,
+                   min_duration=2.0, removed=0):
+    """Measure the quality of a strip before the expensive stages
+
+    Every measure is one vectorized pass over the samples:
+
+    * missing: the fraction of samples whose time or voltage is nan
+    * flatline: the fraction of samples in runs of one constant value
+      at least flat_run seconds long, as from a disconnected lead
+    * clipping: the fraction of samples at the highest or the lowest
+      value, as from a saturated amplifier
+    * out_of_range: the fraction of samples beyond +-VOLTAGE_RANGE
+    * snr_db: the ratio of the standard deviation of the signal to the
+      sample noise, estimated from the median absolute difference of
+      neighbouring samples, in dB. White noise alone gives about 0 dB.
+
+    A strip fails every limit it is beyond, and the reason codes list
+    the failed measures, "low_snr" for snr_db. A strip with fewer than
+    min_duration seconds of samples fails with "too_short" and the
+    other measures are skipped. Samples with missing data that were
+    already removed, as in the data of the cache, are counted as
+    missing through removed.
+
+    Args:
+        time (array): the inputted time data, with missing values
+        voltage (array): the inputted voltage data, with missing values
+        limits (dictionary): the limits that replace those of
+        QUALITY_LIMITS
+        flat_run (float): the shortest flat run in seconds
+        min_duration (float): the shortest strip in seconds
+        removed (int): the number of missing samples already removed
+
+    Returns:
+        dictionary: "ok", the list of "reasons" and every measure
+    """
+    unknown = set(limits or ()) - set(QUALITY_LIMITS)
+    if unknown:
+        raise ValueError("Unknown quality limits {}, choose from {}".format(
+            ", ".join(sorted(unknown)), ", ".join(QUALITY_LIMITS)))
+    limits = dict(QUALITY_LIMITS, **(limits or {}))
+    time = np.asarray(time)
+    voltage = np.asarray(voltage)
+    valid = ~(np.isnan(time) | np.isnan(voltage))
+    total = valid.size + removed
+    report = {"ok": False, "reasons": [],
+              "missing": (float(1 - np.count_nonzero(valid) / total)
+                          if total else 1.0),
+              "flatline": None, "clipping": None, "out_of_range": None,
+              "snr_db": None}
+    time = time[valid]
+    voltage = voltage[valid]
+    if len(time) < 2 or time[-1] - time[0] < min_duration:
+        report["reasons"].append("too_short")
+        return report
+    fs = (len(time) - 1) / (time[-1] - time[0])
+    step = np.diff(voltage)
+    edges = np.flatnonzero(step != 0) + 1
+    runs = np.diff(np.concatenate(([0], edges, [len(voltage)])))
+    flat = runs[runs >= max(2, flat_run * fs)].sum()
+    report["flatline"] = float(flat / len(voltage))
+    highest = voltage.max()
+    lowest = voltage.min()
+    at_rail = np.count_nonzero(voltage == highest)
+    if lowest != highest:
+        at_rail = at_rail + np.count_nonzero(voltage == lowest)
+    report["clipping"] = float(at_rail / len(voltage))
+    report["out_of_range"] = float(
+        np.count_nonzero(np.abs(voltage) > VOLTAGE_RANGE) / len(voltage))
+    noise = np.median(np.abs(step)) / 0.6745 / np.sqrt(2)
+    spread = voltage.std()
+    if noise > 0 and spread > 0:
+        report["snr_db"] = float(20 * np.log10(spread / noise))
+    for name in ("missing", "flatline", "clipping", "out_of_range"):
+        if report[name] > limits[name]:
+            report["reasons"].append(name)
+    if report["snr_db"] is not None and report["snr_db"] < limits["snr_db"]:
+        report["reasons"].append("low_snr")
+    report["ok"] = not report["reasons"]
+    return report
+
+
+def decimation_factor(f_sample, target="auto", high=HIGH_CUTOFF,
+                      length=None):
+    """Choose the integer decimation factor for a sampling frequency
+
+    The "auto" target rate is DECIMATE_MARGIN times the high cutoff of
+    the band-pass filter (180Hz for 45Hz), which keeps the whole band
+    well below the new Nyquist frequency. Every factor up to
+    f_sample / target keeps the rate above the target. Given the length
+    of the strip, the largest of them down to half of the highest whose
+    decimated length has only small prime factors is chosen, since the
+    FFT of the filter is much slower on other lengths.
+
+    Args:
+        f_sample (float): the sampling frequency
+        target (float): the lowest acceptable rate in Hz, or "auto"
+        high (float): the high cutoff frequency
+        length (int): the number of samples of the strip, if known
+
+    Returns:
+        int: the decimation factor, 1 when the rate is already low
+    """
+    if target == "auto":
+        target = DECIMATE_MARGIN * high
+    target = float(target)
+    if target <= 2 * high:
+        raise ValueError("The target rate must be above twice the high "
+                         "cutoff frequency {}Hz".format(high))
+    factor = max(1, int(f_sample // target))
+    if length is None or factor == 1:
+        return factor
+    from scipy.fft import next_fast_len
+    for candidate in range(factor, factor // 2, -1):
+        size = -(-length // candidate)
+        if next_fast_len(size, True) == size:
+            return candidate
+    return factor
+
+
+def decimate_signal(time, voltage, target="auto", high=HIGH_CUTOFF):
+    """Reduce the sampling rate of a strip by an integer factor
+
+    The voltage passes through an anti-aliasing FIR filter applied by
+    scipy.signal.resample_poly, which has no phase shift, and every
+    factor-th sample is kept, so the new sample i stays at time
+    time[i * factor]. Only the band below the high cutoff has to stay
+    free of aliases, so the Kaiser window filter (60dB) only needs to
+    stop the frequencies above the new rate minus the high cutoff, which
+    takes far fewer taps than the default filter of resample_poly. A 2-D
+    voltage is decimated along its last axis.
+
+    Args:
+        time (array): the inputted time data without missing
+        voltage (array): the inputted voltage data without missing
+        target (float): the lowest acceptable rate in Hz, or "auto"
+        high (float): the high cutoff frequency
+
+    Returns:
+        array: the decimated time
+        array: the decimated voltage
+        int: the decimation factor, 1 when nothing was done
+    """
+    f_sample = (len(time) - 1) / (time[-1] - time[0])
+    factor = decimation_factor(f_sample, target, high,
+                               np.shape(voltage)[-1])
+    if factor == 1:
+        return time, voltage, 1
+    from scipy.signal import firwin, kaiserord, resample_poly
+    rate = f_sample / factor
+    numtaps, beta = kaiserord(60, (rate - 2 * high) / (f_sample / 2))
+    taps = firwin(numtaps | 1, rate / 2, window=("kaiser", beta),
+                  fs=f_sample)
+    decimated = resample_poly(voltage, 1, factor, axis=-1, window=taps)
+    return (np.ascontiguousarray(time[::factor]),
+            decimated.astype(np.asarray(voltage).dtype, copy=False), factor)
+
+
+def refine_peaks(signal, index, factor):
+    """Place peaks of a decimated signal on the samples of the original
+
+    A parabola is fitted through every peak of the filtered, decimated
+    signal and its two neighbours. Its vertex gives the position of the
+    peak between the decimated samples, which is rounded to the nearest
+    sample of the original strip.
+
+    Args:
+        signal (array): the filtered decimated signal
+        index (array): the sample indices of the peaks in signal
+        factor (int): the decimation factor
+
+    Returns:
+        array: the sample indices of the peaks in the original strip
+    """
+    signal = np.asarray(signal)
+    index = np.clip(np.asarray(index, dtype=np.intp), 1, len(signal) - 2)
+    left = signal[index - 1]
+    middle = signal[index]
+    right = signal[index + 1]
+    curve = left - 2 * middle + right
+    offset = np.divide(left - right, 2 * curve, out=np.zeros(len(index)),
+                       where=curve < 0)
+    offset = np.clip(offset, -0.5, 0.5)
+    return np.rint((index + offset) * factor).astype(np.intp)
+
+
 def fourier_transform(time, voltage):
     """Do Fourier transform to the original signal
 
     This function calculates the sample frequency and sets
     the frequency index. Then Fast Fourier Transformation will be
     done in this function. The frequency index and the frequency
-    spectrum will be returned by this function.
+    spectrum will be returned by this function. A 2-D voltage is
+    transformed along its last axis, one row per lead.
 
     Args:
         time (array): the inputted time data without missing
@@ -151,17 +682,18 @@ def fourier_transform(time, voltage):
     """
     t0 = time[1] - time[0]
     f_sample = 1/t0
-    f_index = np.linspace(-f_sample, f_sample, len(voltage))
-    freq_ECG = np.fft.fftshift(np.fft.fft(voltage))
+    f_index = np.linspace(-f_sample, f_sample, np.shape(voltage)[-1])
+    freq_ECG = np.fft.fftshift(np.fft.fft(voltage), axes=-1)
     return f_index, freq_ECG
 
 
-def ideal_filter(f_index, voltage, freq_ECG):
+def ideal_filter(f_index, voltage, freq_ECG, low=LOW_CUTOFF,
+                 high=HIGH_CUTOFF):
     """Pass the signal through an ideal filter
 
     This function takes in the fourier transformed data
     and passes it through a inner ideal band-pass filter, which has the
-    high cutoff frequency 45Hz and low cutoff frequency 0.7Hz.
+    high cutoff frequency 45Hz and low cutoff frequency 0.7Hz by default.
     The filtered signal will be recovered by inverse fast fourier
     tansform. The recovered signal will be returned.
 
@@ -169,70 +701,605 @@ def ideal_filter(f_index, voltage, freq_ECG):
         f_index (array): the frequency index
         voltage (array): the inputted voltage data without missing
         freq_ECG (array): the frequency spectrum of the signal
+        low (float): the low cutoff frequency
+        high (float): the high cutoff frequency
 
     Returns:
         array: the filtered recovered signal
     """
-    hz_minus50 = np.where(f_index >= -45)
-    hz_minus50 = hz_minus50[0][0]
-    hz_50 = np.where(f_index <= 45)
-    hz_50 = hz_50[0][-1]
-    hz_minus05 = np.where(f_index >= -0.7)
-    hz_minus05 = hz_minus05[0][0]
-    hz_05 = np.where(f_index <= 0.7)
-    hz_05 = hz_05[0][-1]
-    ideal_filter = np.zeros(len(voltage))
-    ideal_filter[hz_minus50:hz_minus05] = 1
-    ideal_filter[hz_05:hz_50] = 1
+    ideal_filter = _ideal_mask(f_index, low, high)
     after_filter = freq_ECG * ideal_filter
-    recovered_time = np.fft.ifft(np.fft.ifftshift(after_filter))
+    recovered_time = np.fft.ifft(np.fft.ifftshift(after_filter, axes=-1))
     return recovered_time
 
 
-def find_R_wave(recovered_time):
+def _ideal_mask(f_index, low, high, dtype=np.float64):
+    """Build the mask of ideal_filter over the shifted frequency index"""
+    hz_minus50 = np.searchsorted(f_index, -high, side='left')
+    hz_50 = np.searchsorted(f_index, high, side='right') - 1
+    hz_minus05 = np.searchsorted(f_index, -low, side='left')
+    hz_05 = np.searchsorted(f_index, low, side='right') - 1
+    mask = np.zeros(len(f_index), dtype=dtype)
+    mask[hz_minus50:hz_minus05] = 1
+    mask[hz_05:hz_50] = 1
+    return mask
+
+
+@lru_cache(maxsize=FILTER_PLANS)
+def filter_mask(length, f_sample, low=LOW_CUTOFF, high=HIGH_CUTOFF):
+    """Build the ideal filter of a strip length for real-input FFTs
+
+    The mask of ideal_filter is moved back to the unshifted order of
+    np.fft.fft and averaged with its mirror image. Because the spectrum
+    of a real signal is symmetric, multiplying its rfft by the first
+    half of that mask and taking the irfft gives the real part of the
+    ideal_filter output, with half the spectrum and no complex inverse
+    transform. The masks of the last FILTER_PLANS shapes are kept, so a
+    batch of strips of the same length and sampling frequency builds
+    its mask only once. The mask is read-only because it is shared.
+    It is built from boolean masks and kept as float32, which holds
+    its values 0, 0.5 and 1 exactly, so it costs a float32 strip no
+    more than the strip itself.
+
+    Args:
+        length (int): the number of samples of the strip
+        f_sample (float): the sampling frequency
+        low (float): the low cutoff frequency
+        high (float): the high cutoff frequency
+
+    Returns:
+        array: the mask of the rfft of the strip
+    """
+    f_index = np.linspace(-f_sample, f_sample, length)
+    shifted = _ideal_mask(f_index, low, high, bool)
+    del f_index
+    full = np.fft.ifftshift(shifted)
+    mirror = np.roll(full[::-1], 1)
+    half = length // 2 + 1
+    mask = np.add(full[:half], mirror[:half], dtype=np.float32)
+    mask /= 2
+    mask.flags.writeable = False
+    return mask
+
+
+def _fir_filter(voltage, f_sample, low, high):
+    """Pass the signal through a linear-phase FIR band-pass filter
+
+    The taps are designed with a Hamming window, with a transition
+    band as wide as the low cutoff frequency. The odd-length symmetric
+    filter is applied by overlap-add convolution and the output is
+    centered, so the result has no phase shift.
+
+    Args:
+        voltage (array): the inputted voltage data without missing
+        f_sample (float): the sampling frequency
+        low (float): the low cutoff frequency
+        high (float): the high cutoff frequency
+
+    Returns:
+        array: the filtered signal
+    """
+    from scipy.signal import firwin, oaconvolve
+    numtaps = int(3.3 * f_sample / low) | 1
+    numtaps = min(numtaps, (np.shape(voltage)[-1] - 1) | 1)
+    taps = firwin(numtaps, [low, high], pass_zero=False, fs=f_sample)
+    taps = taps.reshape((1,) * (np.ndim(voltage) - 1) + (-1,))
+    return oaconvolve(voltage, taps, mode='same', axes=-1)
+
+
+def band_pass_filter(time, voltage, engine="ideal", low=LOW_CUTOFF,
+                     high=HIGH_CUTOFF):
+    """Pass the signal through the band-pass filter of the chosen engine
+
+    Three engines keep the 0.7-45Hz band-pass of the pipeline:
+    "ideal" gives the result of fourier_transform followed by
+    ideal_filter, as in the original pipeline, with real-input FFTs and
+    the cached mask of filter_mask, "sos" is a fourth-order Butterworth
+    filter in second-order sections run forwards and backwards (zero
+    phase), and "fir" is a linear-phase FIR filter applied by
+    overlap-add. The high cutoff is lowered to 0.45 times the sampling
+    frequency when the signal is sampled too slowly for it. The result
+    is always real. A 2-D voltage with one row per lead is filtered in
+    one call along its last axis. The ideal engine transforms with
+    scipy.fft, which keeps a float32 strip in float32 and complex64.
+
+    Args:
+        time (array): the inputted time data without missing
+        voltage (array): the inputted voltage data without missing
+        engine (string): "ideal", "sos" or "fir"
+        low (float): the low cutoff frequency
+        high (float): the high cutoff frequency
+
+    Returns:
+        array: the filtered recovered signal
+    """
+    if engine == "ideal":
+        from scipy.fft import rfft, irfft
+        length = np.shape(voltage)[-1]
+        mask = filter_mask(length, float(1 / (time[1] - time[0])), low,
+                           high)
+        spectrum = rfft(voltage)
+        spectrum *= mask
+        return irfft(spectrum, length, overwrite_x=True)
+    f_sample = 1 / (time[1] - time[0])
+    high = min(high, 0.45 * f_sample)
+    if engine == "sos":
+        from scipy.signal import butter, sosfiltfilt
+        sos = butter(4, [low, high], btype='bandpass', fs=f_sample,
+                     output='sos')
+        return sosfiltfilt(sos, voltage, axis=-1)
+    if engine == "fir":
+        return _fir_filter(voltage, f_sample, low, high)
+    raise ValueError("Unknown filter engine {!r}, choose one of "
+                     "{}".format(engine, ", ".join(FILTER_ENGINES)))
+
+
+def _local_maxima(signal):
+    """Find every local maximum of a signal as find_peaks does
+
+    The samples are compared with their neighbours in the type of the
+    signal, so a float32 signal is never copied to float64. A run of
+    equal samples higher than the samples on both sides is one peak in
+    the middle of the run, rounded down, as find_peaks places it.
+
+    Args:
+        signal (array): the real 1-D signal
+
+    Returns:
+        array: the sample indices of the local maxima
+    """
+    inner = signal[1:-1]
+    strict = inner > signal[:-2]
+    strict &= inner > signal[2:]
+    peaks = np.flatnonzero(strict) + 1
+    equal = signal[1:] == signal[:-1]
+    if not equal.any():
+        return peaks
+    equal = np.concatenate(([False], equal, [False]))
+    edges = np.flatnonzero(equal[1:] != equal[:-1])
+    left, right = edges[0::2], edges[1::2]
+    inside = (left > 0) & (right < len(signal) - 1)
+    left, right = left[inside], right[inside]
+    plateau = ((signal[left - 1] < signal[left]) &
+               (signal[right + 1] < signal[right]))
+    middle = (left[plateau] + right[plateau]) // 2
+    return np.sort(np.concatenate((peaks, middle)))
+
+
+def find_R_wave(recovered_time, return_index=False, engine="legacy",
+                fs=None):
     """Find the R peaks in the sequence
 
     This function will find the R peaks from ECG signal.
-    This fucntion uses find_peaks function in scipy.signal package. Then
+    With the legacy engine this fucntion finds the local maxima as
+    find_peaks function in scipy.signal package does. Then
     it will extract the three largest value and do normalization to the
     rest of peaks. Then the function extracts the peaks again and attach
     the three largest value to the list of peaks.
     The function returns the result index after second findpeaks, the
     normalized voltage, the result of second findpeaks with the attached
-    peaks.
+    peaks. With return_index set to True the sorted sample indices of
+    the detected beats in recovered_time are returned as well, so the
+    beat times can be looked up without searching the signal.
+
+    The pan_tompkins and adaptive engines run in linear time and judge
+    every candidate peak against the signal around it rather than the
+    whole strip, so they follow amplitude drift in long recordings.
+    They need the sampling frequency fs. They return the accepted
+    candidates, the locally normalized heights and the heights of all
+    the candidate peaks, and an empty array in place of the three
+    largest values.
 
     Args:
         recovered_time (array): the filtered recovered signal
+        return_index (bool): also return the sample indices of the beats
+        engine (string): "legacy", "pan_tompkins" or "adaptive"
+        fs (float): the sampling frequency in Hz, for the new engines
 
     Returns:
         array: the result index after second findpeaks
         array: the normalized voltage
-        list: the result of second findpeaks
-        list: the three largest value before normalization
-    """
-    peaks, _ = find_peaks(recovered_time)
-    recovered_time = np.array(recovered_time)
-    wrapped_voltage = recovered_time[peaks]
-    wrapped_voltage = list(wrapped_voltage)
-    value = []
+        array: the result of second findpeaks
+        array: the three largest value before normalization
+        array: the sorted sample indices of the beats, only if
+        return_index is True
+    """
+    recovered_time = np.asarray(recovered_time)
+    if engine == "legacy":
+        peaks = _local_maxima(np.real(recovered_time))
+        wrapped_voltage = recovered_time[peaks]
+        (new_peaks, normalized_voltage, wrapped_voltage, value,
+         beat_index) = _select_R_peaks(peaks, wrapped_voltage)
+    elif engine in ("pan_tompkins", "adaptive"):
+        if fs is None:
+            raise ValueError("The {} detector needs fs".format(engine))
+        signal = np.real(recovered_time)
+        if engine == "adaptive":
+            peaks, normalized_voltage, new_peaks = _detect_adaptive(signal,
+                                                                    fs)
+        else:
+            peaks, normalized_voltage, new_peaks = _detect_pan_tompkins(
+                signal, fs)
+        wrapped_voltage = recovered_time[peaks]
+        value = np.empty(0, dtype=wrapped_voltage.dtype)
+        beat_index = peaks[new_peaks]
+    else:
+        raise ValueError("Unknown detector engine {}".format(engine))
+    if return_index:
+        return (new_peaks, normalized_voltage, wrapped_voltage, value,
+                beat_index)
+    return new_peaks, normalized_voltage, wrapped_voltage, value
+
+
+def _select_R_peaks(peaks, wrapped_voltage):
+    """Pick the R peaks out of all the local maxima of the signal
+
+    This is the second stage of find_R_wave. It takes out the three
+    largest local maxima, normalizes the rest and keeps those above
+    0.7 after a second findpeaks.
+
+    Args:
+        peaks (array): the positions of the local maxima
+        wrapped_voltage (array): the signal values at those positions
+
+    Returns:
+        array: the result index after second findpeaks
+        array: the normalized voltage
+        array: the result of second findpeaks
+        array: the three largest value before normalization
+        array: the sorted positions of the beats taken from peaks
+    """
+    from scipy.signal import find_peaks
+    value = np.empty(3, dtype=wrapped_voltage.dtype)
+    value_index = np.empty(3, dtype=peaks.dtype)
     for i in range(3):
-        value.append(max(wrapped_voltage))
-        wrapped_voltage.remove(max(wrapped_voltage))
-    min_v = min(wrapped_voltage)
-    max_v = max(wrapped_voltage)
+        largest = np.argmax(wrapped_voltage)
+        value[i] = wrapped_voltage[largest]
+        value_index[i] = peaks[largest]
+        wrapped_voltage = np.delete(wrapped_voltage, largest)
+        peaks = np.delete(peaks, largest)
+    min_v = np.min(wrapped_voltage)
+    max_v = np.max(wrapped_voltage)
     normalized_voltage = ((wrapped_voltage-min_v)/(max_v-min_v))
-    new_peaks, _ = find_peaks(normalized_voltage, height=0.7)
-    if np.real(normalized_voltage[0]) > 0.7:
+    new_peaks, _ = find_peaks(normalized_voltage, height=PEAK_HEIGHT)
+    if np.real(normalized_voltage[0]) > PEAK_HEIGHT:
         new_peaks = np.insert(new_peaks, 0, 0)
-    if np.real(normalized_voltage[-1]) > 0.7:
+    if np.real(normalized_voltage[-1]) > PEAK_HEIGHT:
         last_i = np.where(normalized_voltage == normalized_voltage[-1])[0][0]
         new_peaks = np.append(new_peaks, last_i)
-    return new_peaks, normalized_voltage, wrapped_voltage, value
+    beat_index = np.sort(np.concatenate((value_index, peaks[new_peaks])))
+    return new_peaks, normalized_voltage, wrapped_voltage, value, beat_index
+
+
+def _select_spilled_peaks(spill, dtype, count, chunk=2**16):
+    """Pick the R peaks out of local maxima spilled to a file
+
+    This is the selection of _select_R_peaks over all the local maxima
+    of a recording, which are read back from the file in chunks, so
+    only one chunk is in memory at a time. A first pass finds the three
+    largest values and the range of the rest. A second pass finds the
+    local maxima of the rest that are high enough once normalized,
+    carrying the last run of equal values over to the next chunk, so
+    plateaus are broken as find_peaks breaks them.
+
+    Args:
+        spill (file): the binary file of the local maxima
+        dtype (dtype): the record type, with "time" and "value" fields
+        count (int): the number of records in the file
+        chunk (int): the number of records read at once
+
+    Returns:
+        int: the number of beats
+        array: the times of the beats
+    """
+    dtype = np.dtype(dtype)
+
+    def chunks():
+        spill.seek(0)
+        for first in range(0, count, chunk):
+            size = min(chunk, count - first)
+            yield first, np.frombuffer(spill.read(size * dtype.itemsize),
+                                       dtype)
+    if count < 4:
+        raise ValueError("There are too few local maxima to pick the R "
+                         "peaks from")
+    best = np.empty(0, dtype=np.int64)
+    best_values = np.empty(0, dtype=dtype["value"])
+    lowest = None
+    for first, records in chunks():
+        values = records["value"]
+        order = np.argsort(-values, kind="stable")[:4]
+        index = np.concatenate((best, first + order))
+        candidates = np.concatenate((best_values, values[order]))
+        keep = np.lexsort((index, -candidates))[:4]
+        best, best_values = index[keep], candidates[keep]
+        low = values.min()
+        lowest = low if lowest is None else min(lowest, low)
+    top = best[:3]
+    min_v = lowest
+    max_v = best_values[3]
+
+    def normalize(value):
+        return (value - min_v) / (max_v - min_v)
+    beat_index = [top]
+    beat_time = [np.empty(0)]
+    carry_value = np.empty(0, dtype=best_values.dtype)
+    carry_index = np.empty(0, dtype=np.int64)
+    carry_time = np.empty(0)
+    previous = np.inf
+    head = tail = None
+    for first, records in chunks():
+        index = first + np.arange(len(records))
+        removed = np.isin(index, top)
+        beat_time[0] = np.concatenate((beat_time[0],
+                                       records["time"][removed]))
+        index = index[~removed]
+        if len(index) == 0:
+            continue
+        records = records[~removed]
+        if head is None:
+            head = (index[0], records["time"][0], records["value"][0])
+        tail = (index[-1], records["time"][-1], records["value"][-1])
+        values = np.concatenate((carry_value, records["value"]))
+        index = np.concatenate((carry_index, index))
+        times = np.concatenate((carry_time, records["time"]))
+        starts = np.flatnonzero(np.concatenate(
+            ([True], values[1:] != values[:-1])))
+        runs = values[starts]
+        left = np.concatenate(([previous], runs[:-2]))
+        peak = ((runs[:-1] > left) & (runs[:-1] > runs[1:]) &
+                (normalize(runs[:-1]).astype(np.float64) >= PEAK_HEIGHT))
+        middle = (starts[:-1][peak] + starts[1:][peak] - 1) // 2
+        beat_index.append(index[middle])
+        beat_time.append(times[middle])
+        if len(runs) > 1:
+            previous = runs[-2]
+        carry_value = values[starts[-1]:]
+        carry_index = index[starts[-1]:]
+        carry_time = times[starts[-1]:]
+    beat_index[0] = np.sort(top)
+    if normalize(head[2]) > PEAK_HEIGHT:
+        beat_index.append(np.array([head[0]]))
+        beat_time.append(np.array([head[1]]))
+    if normalize(tail[2]) > PEAK_HEIGHT:
+        last_value = normalize(tail[2])
+        for first, records in chunks():
+            index = first + np.arange(len(records))
+            records = records[~np.isin(index, top)]
+            index = index[~np.isin(index, top)]
+            hits = np.flatnonzero(normalize(records["value"]) == last_value)
+            if len(hits):
+                beat_index.append(index[hits[:1]])
+                beat_time.append(records["time"][hits[:1]])
+                break
+    beat_index = np.concatenate(beat_index)
+    beat_time = np.concatenate(beat_time)
+    return len(beat_index), beat_time[np.argsort(beat_index, kind="stable")]
+
+
+def _detect_adaptive(signal, fs, window=3.0, refractory=0.25):
+    """Find the R peaks against a windowed adaptive threshold
+
+    The candidates are the largest local maxima at least one refractory
+    period apart. The running maximum and minimum of the signal over
+    window seconds, computed in linear time, give every candidate a
+    local scale. A candidate is a beat when its height is above
+    PEAK_HEIGHT of the local range.
+
+    Args:
+        signal (array): the filtered signal
+        fs (float): the sampling frequency in Hz
+        window (float): the length of the local window in seconds
+        refractory (float): the shortest time between two beats in seconds
+
+    Returns:
+        array: the sample indices of the candidate peaks
+        array: the locally normalized heights of the candidates
+        array: the positions of the beats among the candidates
+    """
+    from scipy.signal import find_peaks
+    from scipy.ndimage import maximum_filter1d, minimum_filter1d
+    peaks, _ = find_peaks(signal, distance=max(1, int(refractory * fs)))
+    size = max(3, int(window * fs) | 1)
+    high = maximum_filter1d(signal, size)[peaks]
+    low = minimum_filter1d(signal, size)[peaks]
+    span = np.where(high > low, high - low, 1)
+    normalized = (signal[peaks] - low) / span
+    return peaks, normalized, np.flatnonzero(normalized > PEAK_HEIGHT)
+
+
+def _detect_pan_tompkins(signal, fs, refractory=0.2, learning=2.0):
+    """Find the R peaks with the Pan-Tompkins decision rules
+
+    The signal is differentiated, squared and integrated over a moving
+    window of 150 ms. Every peak of the integrated signal is placed on
+    the largest sample of the filtered signal inside its integration
+    window. As in the original rules, a candidate is a beat only when
+    it is above a threshold in both signals, each following running
+    estimates of the signal and noise peak levels. A candidate within
+    360 ms of the previous beat whose steepest slope is under half that
+    of the beat is taken as a T wave. When no beat is found for 1.66
+    times the mean RR interval, the largest skipped candidate above
+    half of both thresholds is taken. The thresholds depend on every
+    earlier decision, so the candidates are judged one at a time; all
+    the per-sample work is vectorized. The levels follow the signal
+    slowly, so where the R waves shrink to about twice the noise, as in
+    the trough of a strong amplitude drift, noise peaks pass as beats
+    and the positive predictive value falls to about 0.8; the adaptive
+    engine holds up better there.
+
+    Args:
+        signal (array): the filtered signal
+        fs (float): the sampling frequency in Hz
+        refractory (float): the shortest time between two beats in seconds
+        learning (float): the length of the learning period in seconds
+
+    Returns:
+        array: the sample indices of the candidate peaks
+        array: the heights of the candidates relative to the levels
+        array: the positions of the beats among the candidates
+    """
+    from scipy.signal import find_peaks
+    width = max(1, int(0.15 * fs))
+    slope = np.abs(np.diff(signal, prepend=signal[:1]))
+    total = np.concatenate(([0], np.cumsum(np.square(slope))))
+    start = np.maximum(np.arange(len(signal)) + 1 - width, 0)
+    integrated = (total[1:] - total[start]) / width
+    peaks, _ = find_peaks(integrated, distance=max(1, int(refractory * fs)))
+    heights = integrated[peaks]
+    if len(peaks) == 0:
+        return peaks, heights, peaks
+    offsets = np.arange(-width + 1, 1)
+    index = np.clip(peaks[:, None] + offsets, 0, len(signal) - 1)
+    located = index[np.arange(len(peaks)),
+                    np.argmax(signal[index], axis=1)]
+    filtered = signal[located]
+    slopes = slope[index].max(axis=1)
+    learned = peaks < learning * fs
+    if not learned.any():
+        learned[:] = True
+    levels = [0.5 * np.max(heights[learned]), 0.5 * np.mean(heights[learned]),
+              0.5 * np.max(filtered[learned]),
+              0.5 * np.mean(filtered[learned])]
+    normalized = np.empty(len(peaks))
+    beats = []
+    rr = []
+    t_wave = 0.36 * fs
+
+    def accept(i, weight):
+        if beats:
+            rr.append(peaks[i] - peaks[beats[-1]])
+            del rr[:-8]
+        beats.append(i)
+        levels[0] = weight * heights[i] + (1 - weight) * levels[0]
+        levels[2] = weight * filtered[i] + (1 - weight) * levels[2]
+    for i in range(len(peaks)):
+        signal_level, noise_level = levels[:2]
+        span = max(signal_level - noise_level, np.finfo(float).tiny)
+        threshold = noise_level + 0.25 * span
+        threshold_f = levels[3] + 0.25 * (levels[2] - levels[3])
+        if rr and peaks[i] - peaks[beats[-1]] > 1.66 * np.mean(rr):
+            first = beats[-1] + 1
+            skipped = np.flatnonzero(
+                (heights[first:i] > 0.5 * threshold) &
+                (filtered[first:i] > 0.5 * threshold_f))
+            if len(skipped):
+                accept(first + skipped[np.argmax(
+                    heights[first + skipped])], 0.25)
+        normalized[i] = (heights[i] - noise_level) / span
+        if (heights[i] > threshold and filtered[i] > threshold_f and
+                not (beats and peaks[i] - peaks[beats[-1]] < t_wave and
+                     slopes[i] < 0.5 * slopes[beats[-1]])):
+            accept(i, 0.125)
+        else:
+            levels[1] = 0.125 * heights[i] + 0.875 * levels[1]
+            levels[3] = 0.125 * filtered[i] + 0.875 * levels[3]
+    beats = np.array(beats, dtype=int)
+    _, first = np.unique(located[beats], return_index=True)
+    return located, normalized, np.sort(beats[first])
+
+
+def _lookup_samples(signal, value):
+    """Find every sample of the signal equal to one of the values
+
+    The signal is sorted once and each value is located with a binary
+    search, so the lookup costs O((n + k) log n) instead of a scan of
+    the whole signal per value. A sample matching several values is
+    returned once per matching value.
+
+    Args:
+        signal (array): the signal to search
+        value (array): the values to look for
+
+    Returns:
+        array: the matching sample indices
+    """
+    signal = np.asarray(signal)
+    order = np.argsort(signal, kind='stable')
+    sorted_signal = signal[order]
+    low = np.searchsorted(sorted_signal, value, side='left')
+    high = np.searchsorted(sorted_signal, value, side='right')
+    counts = high - low
+    offsets = np.repeat(low - np.cumsum(counts) + counts, counts)
+    return order[offsets + np.arange(counts.sum())]
+
+
+def find_R_wave_leads(recovered_time, engine="legacy", fs=None):
+    """Find the R peaks of every lead
+
+    Every lead goes through find_R_wave in turn, so its beats are
+    exactly those of a single-lead analysis of the same signal.
+
+    Args:
+        recovered_time (array): the filtered recovered signal, leads x
+        samples
+        engine (string): "legacy", "pan_tompkins" or "adaptive"
+        fs (float): the sampling frequency in Hz, for the new engines
+
+    Returns:
+        list: the number of detected beats and the sorted sample indices
+        of the beats for every lead
+    """
+    results = []
+    for lead in np.asarray(recovered_time):
+        beat_index = find_R_wave(lead, True, engine, fs)[4]
+        results.append((len(beat_index), beat_index))
+    return results
+
+
+def _consensus_clusters(times, leads, count, tolerance):
+    """Group the beat times of all the leads into clusters
+
+    Args:
+        times (array): the sorted beat times of all the leads
+        leads (array): the lead of every beat time
+        count (int): the number of leads
+        tolerance (float): the largest gap inside a cluster in seconds
+
+    Returns:
+        array: the cluster of every beat time
+        array: the number of distinct leads in every cluster
+    """
+    cluster = np.concatenate(([0], np.cumsum(np.diff(times) > tolerance)))
+    pairs = np.unique(cluster * count + leads)
+    support = np.bincount(pairs // count, minlength=cluster[-1] + 1)
+    return cluster, support
+
+
+def consensus_beats(lead_beats, tolerance=0.05, min_leads=None):
+    """Merge the beat times of several leads into one consensus list
+
+    The beat times of all the leads are sorted together and split into
+    clusters wherever two neighbours are more than tolerance seconds
+    apart. A cluster becomes a consensus beat at the mean of its times
+    when at least min_leads different leads have a beat in it.
+
+    Args:
+        lead_beats (list): the beat times of every lead
+        tolerance (float): the largest gap inside a cluster in seconds
+        min_leads (int): the number of leads needed, a majority if None
+
+    Returns:
+        array: the consensus beat times
+    """
+    count = len(lead_beats)
+    if min_leads is None:
+        min_leads = count // 2 + 1
+    times = np.concatenate([np.asarray(b, dtype=float) for b in lead_beats])
+    if len(times) == 0:
+        return times
+    leads = np.repeat(np.arange(count), [len(b) for b in lead_beats])
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    cluster, support = _consensus_clusters(times, leads[order], count,
+                                           tolerance)
+    center = np.bincount(cluster, weights=times) / np.bincount(cluster)
+    return center[support >= min_leads]
 
 
 def fetch_metrics(new_peaks, normalized_voltage,
                   wrapped_voltage, value,
-                  time, recovered_time):
+                  time, recovered_time, beat_index=None):
     """Find the duration, num_beats, mean_hr_bpm, beats_time
 
     This fucntion receives the result index after second findpeaks,
@@ -244,43 +1311,137 @@ def fetch_metrics(new_peaks, normalized_voltage,
     strip, as a numeric variable type, the mean_hr_bpm:
     estimated average heart rate over the length of the strip,
     and the beats: the list of times when a beat occurred.
+    The beat times come from beat_index when it is given. Otherwise
+    the samples of recovered_time equal to the peak values are found
+    through a sorted index of the signal.
 
     Args:
         new_peaks (array): the result index after second findpeaks
         normalized_voltage (array): the normalized voltage
-        wrapped_voltage (list): the result of second findpeaks
-        value (list): the three largest value before normalization
+        wrapped_voltage (array): the result of second findpeaks
+        value (array): the three largest value before normalization
         recovered_time (array): the filtered recovered signal
         time (array): the inputted time data without missing
+        beat_index (array): the sample indices of the beats from
+        find_R_wave
 
     Returns:
         float: time duration of the ECG strip
         int: number of detected beats in the strip, as a numeric variable type
         float: estimated average heart rate over the length of the strip
-        list: list of times when a beat occurred
+        array: array of times when a beat occurred
     """
-    num_beats = normalized_voltage[new_peaks].shape
-    num_beats = num_beats[0] + 3
+    num_beats = len(new_peaks) + len(value)
     duration = time[-1]
     mean_hr_bpm = (num_beats/duration) * 60
     mean_hr_bpm = round(mean_hr_bpm)
-    wrapped_voltage = np.array(wrapped_voltage)
-    original_voltage = wrapped_voltage[new_peaks]
-    original_voltage = list(original_voltage)
-    new_value = original_voltage
-    value = value + new_value
-    beats = []
-    for j in range(0, len(value)):
-        for i in range(0, len(recovered_time)):
-            if recovered_time[i] == value[j]:
-                beats.append(i)
-    beats.sort()
-    beats_time = []
-    for i in beats:
-        beats_time.append(time[i])
+    if beat_index is None:
+        wrapped_voltage = np.asarray(wrapped_voltage)
+        value = np.concatenate((value, wrapped_voltage[new_peaks]))
+        beat_index = _lookup_samples(recovered_time, value)
+    beats_time = np.asarray(time)[np.sort(beat_index)]
     return duration, num_beats, mean_hr_bpm, beats_time
 
 
+def _window_sums(values, times, starts, window):
+    """Sum values and squared values over time windows in one pass
+
+    The values are taken in time order. With the running sums the sum
+    over every window is one difference, found with a binary search of
+    the window edges, so no window is visited in a loop.
+
+    Args:
+        values (array): the values to sum
+        times (array): the sorted time of every value
+        starts (array): the start times of the windows
+        window (float): the length of the windows in seconds
+
+    Returns:
+        array: the number of values in every window
+        array: the sum of the values in every window
+        array: the sum of the squared values in every window
+    """
+    low = np.searchsorted(times, starts, side='left')
+    high = np.searchsorted(times, starts + window, side='left')
+    total = np.concatenate(([0.0], np.cumsum(values)))
+    squares = np.concatenate(([0.0], np.cumsum(np.square(values))))
+    return high - low, total[high] - total[low], squares[high] - squares[low]
+
+
+def _compact(values, decimals):
+    """Round an array for the output and turn nan into None"""
+    values = np.round(np.asarray(values, dtype=np.float64), decimals)
+    return [None if np.isnan(value) else value for value in values.tolist()]
+
+
+def windowed_metrics(beats_time, window=300.0, step=None, start=0.0,
+                     end=None, rr_series=False):
+    """Find the heart rate and HRV statistics over sliding windows
+
+    The RR intervals are the differences of the beat times, each one
+    belongs to the window holding the beat that ends it. For every
+    window the mean heart rate, SDNN (the standard deviation of the RR
+    intervals), RMSSD (the root mean square of the successive RR
+    differences) and pNN50 (the percentage of successive differences
+    larger than 50 ms) are found from running sums, in one vectorized
+    pass over all the windows. A statistic without enough intervals in
+    its window is None.
+
+    The result is columnar and compact: the windows start at start +
+    i * step, so only start, step and window are stored, and every
+    statistic is one rounded list with one entry per window.
+
+    Args:
+        beats_time (array): the sorted times of the beats in seconds
+        window (float): the length of the windows in seconds
+        step (float): the time between window starts, window if None
+        start (float): the start time of the first window
+        end (float): the end of the recording, the last beat if None
+        rr_series (bool): also return every RR interval in milliseconds
+
+    Returns:
+        dictionary: the window layout and the lists "num_beats",
+        "hr_bpm", "sdnn_ms", "rmssd_ms" and "pnn50", and "rr_ms" if
+        rr_series is True
+    """
+    beats_time = np.asarray(beats_time, dtype=np.float64)
+    if step is None:
+        step = window
+    if window <= 0 or step <= 0:
+        raise ValueError("window and step must be positive")
+    if end is None:
+        end = beats_time[-1] if len(beats_time) else start
+    count = max(1, int(np.floor((end - start - window) / step + 1e-9)) + 1)
+    starts = start + step * np.arange(count)
+    rr = np.diff(beats_time)
+    diffs = np.diff(rr)
+    centered = rr - (rr.mean() if len(rr) else 0.0)
+    num_beats = (np.searchsorted(beats_time, starts + window) -
+                 np.searchsorted(beats_time, starts))
+    n, total, squares = _window_sums(centered, beats_time[1:], starts,
+                                     window)
+    n_sd, _, squared_sd = _window_sums(diffs, beats_time[2:], starts,
+                                       window)
+    _, n_50, _ = _window_sums((np.abs(diffs) > 0.05).astype(np.float64),
+                              beats_time[2:], starts, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_rr = total / n + (rr.mean() if len(rr) else 0.0)
+        variance = (squares - total * total / n) / (n - 1)
+        hrv = {"window": window, "step": step, "start": start,
+               "num_beats": num_beats.tolist(),
+               "hr_bpm": _compact(np.where(n > 0, 60 / mean_rr, np.nan), 1),
+               "sdnn_ms": _compact(np.where(
+                   n > 1, 1000 * np.sqrt(np.maximum(variance, 0)), np.nan),
+                   1),
+               "rmssd_ms": _compact(np.where(
+                   n_sd > 0, 1000 * np.sqrt(squared_sd / n_sd), np.nan), 1),
+               "pnn50": _compact(np.where(n_sd > 0, 100 * n_50 / n_sd,
+                                          np.nan), 1)}
+    if rr_series:
+        hrv["rr_ms"] = np.round(1000 * rr).astype(int).tolist()
+    return hrv
+
+
 def produce_dict(duration, voltage_extremes, num_beats,
                  mean_hr_bpm, beats_time):
     """Put the metrics into dictionary
@@ -307,7 +1468,7 @@ def produce_dict(duration, voltage_extremes, num_beats,
     Returns:
         dictionary: the dictionary with different metrics of an ECG signal
     """
-    logging.info("Assign the ECG trace metrics into dictionary")
+    _logger().info("Assign the ECG trace metrics into dictionary")
     patient_dict = {"duration": duration,
                     "voltage_extremes": voltage_extremes,
                     "num_beats": num_beats,
@@ -316,6 +1477,21 @@ def produce_dict(duration, voltage_extremes, num_beats,
     return patient_dict
 
 
+def _json_default(obj):
+    """Convert numpy arrays and scalars for json.dump
+
+    Args:
+        obj (object): the object json cannot serialize by itself
+
+    Returns:
+        object: the list or Python scalar for the object
+    """
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError("Object of type {} is not JSON "
+                    "serializable".format(type(obj).__name__))
+
+
 def output_file(patient_dict, file_name):
     """Output the signal information in dictionary into .json file
 
@@ -330,22 +1506,859 @@ def output_file(patient_dict, file_name):
     """
     filename = file_name + '.json'
     out_file = open(filename, "w")
-    json.dump(patient_dict, out_file)
+    json.dump(patient_dict, out_file, default=_json_default)
     out_file.close()
 
 
+def _max_rss():
+    """Return the largest resident set size of the process so far
+
+    Returns:
+        int: the size in bytes, None where the platform does not tell
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+@contextmanager
+def _tracing(enabled=True):
+    """Trace memory allocations with tracemalloc inside the block
+
+    Tracing is only started, and stopped again at the end, when it is
+    enabled and not running yet, so an outer trace is left alone.
+
+    Args:
+        enabled (bool): trace the block at all
+    """
+    start = enabled and not tracemalloc.is_tracing()
+    if start:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if start:
+            tracemalloc.stop()
+
+
+@contextmanager
+def _stage(metrics, name, size=None):
+    """Record the cost of one pipeline stage
+
+    When metrics is None nothing is measured, so the instrumentation
+    costs almost nothing when it is turned off. Otherwise the wall
+    time, CPU time, input size and the growth of the resident set size
+    high-water mark during the stage, zero when the stage stayed under
+    an earlier peak, are appended to metrics. While tracemalloc is
+    tracing, the peak of the memory allocated during the stage, above
+    what was allocated at its start, is recorded as well, and the
+    record is marked as traced, since the tracing slows the stage down.
+    Before Python 3.9 the peak cannot be reset, so tracing is restarted
+    for the stage, which drops the traces taken before it.
+
+    Args:
+        metrics (list): the list of stage records, or None
+        name (string): the name of the stage
+        size (int): the size of the input of the stage
+    """
+    if metrics is None:
+        yield
+        return
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.stop()
+            tracemalloc.start()
+        allocated = tracemalloc.get_traced_memory()[0]
+    rss = _max_rss()
+    wall = perf_counter()
+    cpu = process_time()
+    yield
+    record = {"stage": name,
+              "wall_seconds": perf_counter() - wall,
+              "cpu_seconds": process_time() - cpu,
+              "input_size": size,
+              "max_rss_growth_bytes": (None if rss is None
+                                       else _max_rss() - rss),
+              "traced": tracing}
+    if tracing:
+        record["peak_bytes"] = (tracemalloc.get_traced_memory()[1] -
+                                allocated)
+    metrics.append(record)
+
+
+def analyze_stream(path, window=2**18, margin=2**12, dtype=np.float64,
+                   filter_engine="ideal", detector="legacy", hrv_window=None,
+                   hrv_step=None, rr_series=False):
+    """Run the analysis pipeline on a recording window by window
+
+    The recording is read with stream_data in overlapping windows, so
+    files larger than the memory can be analyzed. Every window is
+    filtered on its own and its local maxima are kept only inside the
+    core of the window, which leaves margin samples of context on both
+    sides. The cores of consecutive windows meet exactly, so a beat on
+    a window boundary is found once. The local maxima go to a temporary
+    file rather than the memory, and the R peaks are then picked from
+    all of them together, as in find_R_wave, by _select_spilled_peaks
+    reading the file back in chunks, so apart from the beats the memory
+    stays bounded by the window however long the recording is. The
+    metrics are put into the same dictionary as analyze_strip gives.
+    The other detector engines only look at the signal around every
+    peak, so they run on every window and keep only the beats in its
+    core. With an hrv_window the windowed_metrics of the beats are
+    added under "hrv", with every RR interval when rr_series is True.
+
+    Args:
+        path (string): the inputted file path
+        window (int): the number of samples filtered at once
+        margin (int): the number of context samples on each side
+        dtype (type): the floating point type, np.float64 or np.float32
+        filter_engine (string): the engine of band_pass_filter
+        detector (string): the engine of find_R_wave
+        hrv_window (float): the window of windowed_metrics in seconds
+        hrv_step (float): the step of windowed_metrics in seconds
+        rr_series (bool): add the RR intervals to the "hrv" entry
+
+    Returns:
+        dictionary: the dictionary with different metrics of an ECG signal
+    """
+    if window <= 2 * margin:
+        raise ValueError("window must be larger than twice the margin")
+    step = window - 2 * margin
+    peak_time = []
+    spill = tempfile.TemporaryFile() if detector == "legacy" else None
+    record_type = None
+    spilled = 0
+    highest = -np.inf
+    lowest = np.inf
+    windows = stream_data(path, window, 2 * margin, dtype=dtype)
+    current = next(windows, None)
+    if current is None:
+        raise ValueError("There is no data in {}".format(path))
+    count = 0
+    try:
+        while current is not None:
+            following = next(windows, None)
+            time, voltage = current
+            highest = max(highest, float(np.max(voltage)))
+            lowest = min(lowest, float(np.min(voltage)))
+            recovered_time = band_pass_filter(time, voltage, filter_engine)
+            if detector == "legacy":
+                peaks = _local_maxima(recovered_time)
+            else:
+                fs = (len(time) - 1) / (time[-1] - time[0])
+                peaks = find_R_wave(recovered_time, True, detector, fs)[4]
+            low = 0 if count == 0 else margin
+            high = len(time) if following is None else margin + step
+            peaks = peaks[(peaks >= low) & (peaks < high)]
+            if spill is None:
+                peak_time.append(time[peaks])
+            else:
+                if record_type is None:
+                    record_type = np.dtype([("time", time.dtype),
+                                            ("value", recovered_time.dtype)])
+                records = np.empty(len(peaks), record_type)
+                records["time"] = time[peaks]
+                records["value"] = recovered_time[peaks]
+                spill.write(records.tobytes())
+                spilled = spilled + len(peaks)
+            duration = time[-1]
+            current = following
+            count = count + 1
+        if spill is not None:
+            num_beats, beats_time = _select_spilled_peaks(spill, record_type,
+                                                          spilled)
+    finally:
+        if spill is not None:
+            spill.close()
+    voltage_extremes = (highest, lowest)
+    if highest > VOLTAGE_RANGE or lowest < -VOLTAGE_RANGE:
+        _logger().warning('The voltages exceeded the normal range')
+    if spill is None:
+        beats_time = np.concatenate(peak_time)
+        num_beats = len(beats_time)
+    mean_hr_bpm = round((num_beats/duration) * 60)
+    patient_dict = produce_dict(duration, voltage_extremes, num_beats,
+                                mean_hr_bpm, beats_time)
+    if hrv_window is not None:
+        patient_dict["hrv"] = windowed_metrics(patient_dict["beats"],
+                                               hrv_window, hrv_step,
+                                               end=duration,
+                                               rr_series=rr_series)
+    return patient_dict
+
+
+def analyze_strip(path, dtype=np.float64, cache_dir=None,
+                  cache_bytes=None, rebuild_cache=False,
+                  filter_engine="ideal", metrics=None, result_dir=None,
+                  result_bytes=None, detector="legacy", hrv_window=None,
+                  hrv_step=None, quality=None, quality_limits=None,
+                  decimate=None, rr_series=False):
+    """Run the whole analysis pipeline on one ECG strip
+
+    This function takes in the file path of one ECG strip and runs
+    every stage from take_in_data to produce_dict on it. The samples
+    stay in contiguous arrays of the given type through every stage.
+    With a cache directory the cleaned data is taken in through
+    load_cached_data in ECG_cache instead. With a result directory the
+    finished dictionary is kept in the result cache of ECG_cache, keyed
+    by the contents of the file and the configuration of the pipeline,
+    and returned from there when nothing changed. When a metrics list is
+    given, the cost of every stage is appended to it. With an
+    hrv_window the windowed_metrics of the beats are added under "hrv",
+    with every RR interval when rr_series is True.
+    With a quality mode the report of assess_quality is added under
+    "quality", measured before the missing samples are removed, or with
+    the missing counts kept by the cache. In the "reject" mode a strip
+    that fails it skips the filter and the detector: its num_beats and
+    mean_hr_bpm are None and its beats are empty. With decimate, the
+    cleaned strip is decimated by decimate_signal before the filter and
+    the detector, and refine_peaks places every beat back on a sample of
+    the original strip, so the beat times keep the original resolution.
+
+    Args:
+        path (string): the inputted file path
+        dtype (type): the floating point type, np.float64 or np.float32
+        cache_dir (string): the directory of the binary data cache
+        cache_bytes (int): the size limit of the cache in bytes
+        rebuild_cache (bool): parse and analyze the file even if it is
+        cached
+        filter_engine (string): the engine of band_pass_filter
+        metrics (list): the list the stage records are appended to
+        result_dir (string): the directory of the result cache
+        result_bytes (int): the size limit of the result cache in bytes
+        detector (string): the engine of find_R_wave
+        hrv_window (float): the window of windowed_metrics in seconds
+        hrv_step (float): the step of windowed_metrics in seconds
+        quality (string): None, "flag" or "reject"
+        quality_limits (dictionary): the limits of assess_quality
+        decimate (float): the target rate of decimate_signal in Hz, or
+        "auto", no decimation if None
+        rr_series (bool): add the RR intervals to the "hrv" entry
+
+    Returns:
+        dictionary: the dictionary with different metrics of an ECG signal
+    """
+    if quality is not None and quality not in QUALITY_MODES:
+        raise ValueError("Unknown quality mode {!r}, choose one of "
+                         "{}".format(quality, ", ".join(QUALITY_MODES)))
+    if result_dir is not None:
+        from ECG_cache import result_key, load_result, store_result
+        with _stage(metrics, "load_result"):
+            key = result_key(path, dtype, filter_engine, detector,
+                             hrv_window, hrv_step, quality, quality_limits,
+                             decimate, rr_series)
+            patient_dict = None
+            if not rebuild_cache:
+                patient_dict = load_result(result_dir, key)
+        if patient_dict is not None:
+            return patient_dict
+    removed = 0
+    if cache_dir is None:
+        size = os.path.getsize(path) if metrics is not None else None
+        with _stage(metrics, "take_in_data", size):
+            time, voltage = take_in_data(path, dtype)
+    else:
+        from ECG_cache import load_cached_data
+        with _stage(metrics, "load_cached_data"):
+            time, voltage, missing = load_cached_data(
+                path, cache_dir, cache_bytes, rebuild_cache, dtype, True)
+        removed = missing["missing"]
+    if quality is not None:
+        with _stage(metrics, "assess_quality", len(time)):
+            report = assess_quality(time, voltage, quality_limits,
+                                    removed=removed)
+        if quality == "reject" and not report["ok"]:
+            _logger().warning("Rejected the strip: %s",
+                              ", ".join(report["reasons"]))
+            finite = voltage[~np.isnan(voltage)]
+            extremes = None
+            if finite.size:
+                extremes = (float(finite.max()), float(finite.min()))
+            times = time[~np.isnan(time)]
+            patient_dict = produce_dict(
+                float(times[-1]) if times.size else 0.0, extremes, None,
+                None, np.empty(0))
+            patient_dict["quality"] = report
+            if result_dir is not None:
+                store_result(result_dir, key, patient_dict, result_bytes)
+            return patient_dict
+    if cache_dir is None:
+        with _stage(metrics, "clean_missing", len(time)):
+            time, voltage, _ = clean_missing(time, voltage)
+    with _stage(metrics, "extreme_detection", len(voltage)):
+        voltage_extremes = extreme_detection(voltage)
+    factor = 1
+    if decimate is not None:
+        with _stage(metrics, "decimate_signal", len(voltage)):
+            full_time = time
+            time, voltage, factor = decimate_signal(time, voltage, decimate)
+    with _stage(metrics, "band_pass_filter", len(voltage)):
+        recovered_time = band_pass_filter(time, voltage, filter_engine)
+    with _stage(metrics, "find_R_wave", len(recovered_time)):
+        fs = (len(time) - 1) / (time[-1] - time[0])
+        (new_peaks, normalized_voltage, wrapped_voltage,
+         value, beat_index) = find_R_wave(recovered_time, True, detector,
+                                          fs)
+    if factor > 1:
+        with _stage(metrics, "refine_peaks", len(beat_index)):
+            beat_index = np.minimum(
+                refine_peaks(recovered_time, np.sort(beat_index), factor),
+                len(full_time) - 1)
+            time = full_time
+    with _stage(metrics, "fetch_metrics", len(beat_index)):
+        (duration, num_beats, mean_hr_bpm,
+         beats_time) = fetch_metrics(new_peaks, normalized_voltage,
+                                     wrapped_voltage, value,
+                                     time, recovered_time, beat_index)
+    patient_dict = produce_dict(duration, voltage_extremes, num_beats,
+                                mean_hr_bpm, beats_time)
+    if hrv_window is not None:
+        with _stage(metrics, "windowed_metrics", len(beats_time)):
+            patient_dict["hrv"] = windowed_metrics(beats_time, hrv_window,
+                                                   hrv_step, end=duration,
+                                                   rr_series=rr_series)
+    if quality is not None:
+        patient_dict["quality"] = report
+    if result_dir is not None:
+        store_result(result_dir, key, patient_dict, result_bytes)
+    return patient_dict
+
+
+def plot_strip(path, patient_dict=None, out_path=None,
+               filter_engine="ideal"):
+    """Plot an ECG strip and mark its detected beats
+
+    Plotting is optional and needs matplotlib, which is listed in
+    requirements-plot.txt. The strip is read again from the file and
+    the beats of patient_dict, or of a new analyze_strip run when it is
+    None, are marked on the signal.
+
+    Args:
+        path (string): the inputted file path
+        patient_dict (dictionary): the metrics of the strip, if known
+        out_path (string): save the figure to this image file
+        filter_engine (string): the engine of band_pass_filter
+
+    Returns:
+        Figure: the matplotlib figure
+    """
+    try:
+        from matplotlib.figure import Figure
+    except ImportError:
+        raise ImportError("Plotting needs matplotlib, install it with "
+                          "pip install -r requirements-plot.txt")
+    time, voltage = take_in_data(path)
+    time, voltage, _ = clean_missing(time, voltage)
+    if patient_dict is None:
+        patient_dict = analyze_strip(path, filter_engine=filter_engine)
+    beats = np.asarray(patient_dict["beats"], dtype=float)
+    figure = Figure(figsize=(12, 4))
+    axes = figure.add_subplot(1, 1, 1)
+    axes.plot(time, voltage, linewidth=0.8)
+    axes.plot(beats, np.interp(beats, time, voltage), "rx")
+    axes.set_xlabel("Time (s)")
+    axes.set_ylabel("Voltage")
+    axes.set_title(path_leaf(path))
+    if out_path is not None:
+        figure.savefig(out_path)
+    return figure
+
+
+def analyze_leads(path, dtype=np.float64, filter_engine="ideal",
+                  consensus=True, tolerance=0.05, detector="legacy",
+                  hrv_window=None, hrv_step=None, rr_series=False):
+    """Run the analysis pipeline on every lead of a multi-lead file
+
+    All the leads are cleaned, filtered and searched for local maxima
+    together as 2-D arrays. The dictionary holds the duration, the
+    voltage extremes over all the leads, one produce_dict dictionary
+    per lead under "leads" and, if consensus is True, the consensus
+    beat times of consensus_beats under "consensus_beats". With an
+    hrv_window the windowed_metrics of the beats of every lead are added
+    under "hrv" in the dictionary of the lead.
+
+    Args:
+        path (string): the inputted file path
+        dtype (type): the floating point type, np.float64 or np.float32
+        filter_engine (string): the engine of band_pass_filter
+        consensus (bool): add the consensus beat times
+        tolerance (float): the tolerance of consensus_beats in seconds
+        detector (string): the engine of find_R_wave
+        hrv_window (float): the window of windowed_metrics in seconds
+        hrv_step (float): the step of windowed_metrics in seconds
+        rr_series (bool): add the RR intervals to the "hrv" entries
+
+    Returns:
+        dictionary: the dictionary with the metrics of every lead
+    """
+    time, voltage, names = take_in_leads(path, dtype)
+    time, voltage, _ = clean_missing(time, voltage)
+    recovered_time = band_pass_filter(time, voltage, filter_engine)
+    duration = time[-1]
+    fs = (len(time) - 1) / (time[-1] - time[0])
+    leads = {}
+    for name, lead_voltage, (num_beats, beat_index) in zip(
+            names, voltage, find_R_wave_leads(recovered_time, detector,
+                                              fs)):
+        mean_hr_bpm = round((num_beats/duration) * 60)
+        leads[name] = produce_dict(duration,
+                                   extreme_detection(lead_voltage),
+                                   num_beats, mean_hr_bpm, time[beat_index])
+        if hrv_window is not None:
+            leads[name]["hrv"] = windowed_metrics(
+                leads[name]["beats"], hrv_window, hrv_step, end=duration,
+                rr_series=rr_series)
+    patient_dict = {"duration": duration,
+                    "voltage_extremes": extreme_detection(voltage),
+                    "leads": leads}
+    if consensus:
+        patient_dict["consensus_beats"] = consensus_beats(
+            [lead["beats"] for lead in leads.values()], tolerance)
+    return patient_dict
+
+
+def collect_paths(source, recursive=False):
+    """Expand a batch source into a list of ECG file paths
+
+    The source can be a directory (every .csv file and binary record
+    inside it is taken, and inside its subdirectories too when
+    recursive is True), a glob pattern, a single .csv file or binary
+    record, or a manifest file listing one path per line. Blank lines
+    and lines starting with "#" are skipped in a manifest, and relative
+    paths are taken relative to the manifest itself.
+
+    Args:
+        source (string): the directory, glob pattern, file or manifest
+        recursive (bool): walk the subdirectories of a directory
+
+    Returns:
+        list: the sorted list of file paths
+    """
+    if os.path.isdir(source):
+        paths = []
+        pattern = os.path.join("**", "*") if recursive else "*"
+        for extension in (".csv",) + tuple(READERS):
+            paths.extend(glob.glob(os.path.join(source, pattern + extension),
+                                   recursive=recursive))
+        return sorted(paths)
+    if glob.has_magic(source):
+        return sorted(glob.glob(source))
+    if source.lower().endswith(".csv") or is_binary(source):
+        return [source]
+    base = os.path.dirname(source)
+    paths = []
+    with open(source) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            paths.append(os.path.join(base, line))
+    return paths
+
+
+def _check_strip_options(window, leads, options):
+    """Refuse the options of STRIP_OPTIONS with a window or leads
+
+    Args:
+        window (int): the window size for analyze_stream, if any
+        leads (bool): analyze every lead of a multi-lead file
+        options (dictionary): the keyword arguments for analyze_strip
+    """
+    if leads or window is not None:
+        unsupported = [key for key in STRIP_OPTIONS
+                       if options.get(key) is not None]
+        if unsupported:
+            raise ValueError("{} only work on whole single-lead strips, "
+                             "not with a window or leads".format(
+                                 ", ".join(unsupported)))
+
+
+def process_file(path, out_dir=".", window=None, leads=False,
+                 instrument=False, trace_memory=False, metrics_hook=None,
+                 plot=False, output=True, root=None, **options):
+    """Analyze one file in batch mode and isolate any failure
+
+    The function runs analyze_strip on the file and writes the .json
+    file into the output directory. The log messages of this file go
+    to its own .log file next to the .json file. Any exception is
+    caught and reported in the returned record, so one bad strip never
+    stops the rest of the batch. With a window size the file is
+    analyzed with analyze_stream instead, and with leads set to True
+    with analyze_leads. With instrument set to True the cost of every
+    stage is measured and written to a .metrics.json file next to the
+    .json file, and passed to metrics_hook if one is given. With
+    trace_memory set to True as well, the peak memory the allocations
+    of every stage take is traced with tracemalloc, which slows the
+    stages down, so their times are only reliable without it. With plot
+    set to True a .png image of a single-lead strip is saved as well.
+    With output set to False the .json file is not written and the
+    metrics are returned in the record under "result" instead, for a
+    result writer of ECG_output. The outputs are named by output_name,
+    after the file name or, with a root, after the path relative to it.
+    The options of STRIP_OPTIONS only exist in analyze_strip, so giving
+    one of them with a window or leads raises a ValueError instead of
+    being ignored.
+
+    Args:
+        path (string): the inputted file path
+        out_dir (string): the directory for the .json and .log files
+        window (int): the window size for analyze_stream, if any
+        leads (bool): analyze every lead of a multi-lead file
+        instrument (bool): measure the cost of every stage
+        trace_memory (bool): also trace the peak memory of every stage
+        metrics_hook (function): called with the path and the stage
+        records of every instrumented file
+        plot (bool): save a plot of the strip with plot_strip
+        output (bool): write the .json file, or return the metrics
+        root (string): the directory the output names are relative to
+        **options: the keyword arguments passed on to analyze_strip
+
+    Returns:
+        dictionary: the path, output name, status, error message and
+        elapsed seconds, and the stage records if instrumented
+    """
+    _check_strip_options(window, leads, options)
+    file_name = output_name(path, root)
+    out_name = os.path.join(out_dir, file_name)
+    start = perf_counter()
+    record = {"path": path, "name": file_name, "status": "ok",
+              "error": None}
+    metrics = [] if instrument else None
+    with job_logging(out_name + '.log'), \
+            _tracing(instrument and trace_memory):
+        try:
+            shared = {key: options[key] for key in
+                      ("dtype", "filter_engine", "detector")
+                      if key in options}
+            hrv = {key: options[key] for key in
+                   ("hrv_window", "hrv_step", "rr_series") if key in options}
+            if leads:
+                with _stage(metrics, "analyze_leads"):
+                    patient_dict = analyze_leads(path, **shared, **hrv)
+            elif window is not None:
+                with _stage(metrics, "analyze_stream"):
+                    patient_dict = analyze_stream(path, window, **shared,
+                                                  **hrv)
+            else:
+                patient_dict = analyze_strip(path, metrics=metrics,
+                                             **options)
+            if output:
+                with _stage(metrics, "output_file"):
+                    output_file(patient_dict, out_name)
+            else:
+                record["result"] = patient_dict
+            if plot and not leads:
+                plot_strip(path, patient_dict, out_name + '.png')
+        except Exception as e:
+            _logger().exception("Failed to process %s", path)
+            record["status"] = "error"
+            record["error"] = "{}: {}".format(type(e).__name__, e)
+    record["seconds"] = perf_counter() - start
+    if instrument:
+        record["stages"] = metrics
+        with open(out_name + '.metrics.json', "w") as out_file:
+            json.dump(record, out_file, indent=2)
+        if metrics_hook is not None:
+            metrics_hook(path, metrics)
+    return record
+
+
+def profile_file(path, stats_path, out_dir=".", **options):
+    """Analyze one file under cProfile and save the statistics
+
+    The file goes through process_file with instrumentation turned on
+    while cProfile records every function call. The statistics are
+    written to stats_path, where pstats or snakeviz can read them.
+
+    Args:
+        path (string): the inputted file path
+        stats_path (string): the output file of the profile statistics
+        out_dir (string): the directory for the .json and .log files
+        **options: the keyword arguments passed on to process_file
+
+    Returns:
+        dictionary: the record returned by process_file
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        record = process_file(path, out_dir, instrument=True, **options)
+    finally:
+        profiler.disable()
+    profiler.dump_stats(stats_path)
+    return record
+
+
+def _print_progress(done, total, record):
+    """Print one progress line of the batch to standard error
+
+    Args:
+        done (int): the number of finished files
+        total (int): the number of files in the batch
+        record (dictionary): the record returned by process_file
+    """
+    print("[{}/{}] {} {}".format(done, total, record["status"],
+                                 record["path"]), file=sys.stderr)
+
+
+def batch_process(paths, workers=None, ordered=True, out_dir=".",
+                  chunksize=None, progress=None, window=None, leads=False,
+                  output_mode="json", root=None, **options):
+    """Analyze many ECG files on a process pool
+
+    Every file goes through process_file on a pool of worker
+    processes, so the imports are paid once per worker instead of
+    once per file. The files are handed out in chunks to keep the
+    scheduling overhead low on large archives. With ordered set to
+    False the records are collected in completion order. With one
+    worker the files are processed in the current process.
+
+    The metrics are sent back to this process and written by a result
+    writer of ECG_output on a background thread, as one .json file per
+    strip, one JSON Lines file or one SQLite database, keyed by the
+    file name of the strip, or by its path relative to root when one is
+    given.
+
+    An option of STRIP_OPTIONS given with a window or leads raises a
+    ValueError before any worker starts.
+
+    Args:
+        paths (list): the file paths to analyze
+        workers (int): the number of worker processes, all cores if None
+        ordered (bool): keep the records in the order of paths
+        out_dir (string): the directory for the .json and .log files
+        chunksize (int): the number of files handed to a worker at once
+        progress (function): called with (done, total, record) per file
+        window (int): the window size for analyze_stream, if any
+        leads (bool): analyze every lead of multi-lead files
+        output_mode (string): "json", "jsonl" or "sqlite"
+        root (string): the directory the output names are relative to
+        **options: the keyword arguments passed on to analyze_strip
+
+    Returns:
+        dictionary: the summary with counts, timing and every record
+    """
+    from ECG_output import open_writer
+    _check_strip_options(window, leads, options)
+    paths = list(paths)
+    total = len(paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, total or 1))
+    if chunksize is None:
+        chunksize = max(1, total // (workers * 4))
+    os.makedirs(out_dir, exist_ok=True)
+    records = []
+    start = perf_counter()
+    writer = open_writer(output_mode, out_dir)
+    job = partial(process_file, out_dir=out_dir, window=window,
+                  leads=leads, output=False, root=root, **options)
+    if workers == 1:
+        results = (job(path) for path in paths)
+        pool = None
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        if ordered:
+            results = pool.imap(job, paths, chunksize)
+        else:
+            results = pool.imap_unordered(job, paths, chunksize)
+    with writer:
+        try:
+            for record in results:
+                result = record.pop("result", None)
+                if result is not None:
+                    writer.write(record["name"], result)
+                records.append(record)
+                if progress is not None:
+                    progress(len(records), total, record)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    elapsed = perf_counter() - start
+    failed = [r for r in records if r["status"] != "ok"]
+    summary = {"total": total,
+               "succeeded": total - len(failed),
+               "failed": len(failed),
+               "workers": workers,
+               "output": writer.target,
+               "elapsed": elapsed,
+               "files_per_second": total / elapsed if elapsed > 0 else 0.0,
+               "failures": [{"path": r["path"], "error": r["error"]}
+                            for r in failed],
+               "records": records}
+    return summary
+
+
+class ECGPipeline:
+    """Analyze many ECG strips in one process with one configuration
+
+    The configuration is kept on the pipeline instead of in global
+    state, so pipelines with different settings can be used side by
+    side. Every job logs through its own job_logging logger, so the
+    jobs can run at the same time: run_many hands them to a thread pool
+    that lives as long as the pipeline. The FFT, filter and peak search
+    stages spend most of their time in numpy and scipy code that
+    releases the GIL, so the threads overlap. warm_up imports the heavy
+    libraries and prepares the FFT for a typical strip once, instead of
+    once per job or per worker process.
+
+    The .log files of the jobs are named by output_name, after the path
+    of the strip relative to root, or by default relative to the
+    deepest directory holding all the strips of the run_many call, so
+    strips of the same name in different folders never share a log.
+
+    Args:
+        workers (int): the number of threads of run_many, all cores if
+        None
+        log_dir (string): the directory for a .log file per job, none
+        if None
+        root (string): the directory the .log names are relative to
+        **options: the keyword arguments passed on to analyze_strip
+    """
+
+    def __init__(self, workers=None, log_dir=None, root=None, **options):
+        self.options = dict(options)
+        self.workers = workers or os.cpu_count() or 1
+        self.log_dir = log_dir
+        self.root = root
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def warm_up(self, fs=250, duration=10):
+        """Import the libraries and prepare the FFT of a typical strip
+
+        Args:
+            fs (float): the sampling frequency in Hz
+            duration (float): the length of the strip in seconds
+        """
+        from importlib import import_module
+        for module in ("pandas", "scipy.signal", "scipy.ndimage"):
+            import_module(module)
+        time = np.arange(int(duration * fs)) / fs
+        voltage = np.sin(2 * np.pi * 1.2 * time) ** 31
+        recovered_time = band_pass_filter(
+            time, voltage, self.options.get("filter_engine", "ideal"))
+        find_R_wave(recovered_time, False,
+                    self.options.get("detector", "legacy"), fs)
+
+    def run(self, path, log_path=None, metrics=None):
+        """Analyze one strip in the calling thread
+
+        Args:
+            path (string): the inputted file path
+            log_path (string): the .log file of the job, if any
+            metrics (list): the list the stage records are appended to
+
+        Returns:
+            dictionary: the dictionary with different metrics of an ECG
+            signal
+        """
+        with job_logging(log_path):
+            return analyze_strip(path, metrics=metrics, **self.options)
+
+    def _job(self, path, root=None):
+        """Analyze one strip of run_many and record any failure
+
+        The strip is analyzed under its own job logger, writing to
+        log_dir/<output name>.log when the pipeline has a log directory.
+
+        Args:
+            path (string): the inputted file path
+            root (string): the directory the output name is relative to
+
+        Returns:
+            dictionary: the path, output name, status ("ok" or "error"),
+            error message, result of analyze_strip, or None if it
+            failed, and elapsed seconds of the strip
+        """
+        name = output_name(path, root)
+        log_path = None
+        if self.log_dir is not None:
+            log_path = os.path.join(self.log_dir, name + '.log')
+        start = perf_counter()
+        record = {"path": path, "name": name, "status": "ok",
+                  "error": None, "result": None}
+        with job_logging(log_path):
+            try:
+                record["result"] = analyze_strip(path, **self.options)
+            except Exception as e:
+                _logger().exception("Failed to process %s", path)
+                record["status"] = "error"
+                record["error"] = "{}: {}".format(type(e).__name__, e)
+        record["seconds"] = perf_counter() - start
+        return record
+
+    def run_many(self, paths, ordered=True):
+        """Analyze many strips on the thread pool of the pipeline
+
+        A failure is reported in the record of its strip and never
+        stops the others.
+
+        Args:
+            paths (list): the file paths to analyze
+            ordered (bool): keep the records in the order of paths
+
+        Returns:
+            list: the path, output name, status, error message, elapsed
+            seconds and result of every strip
+        """
+        paths = list(paths)
+        root = self.root
+        if root is None and paths:
+            root = os.path.commonpath([os.path.dirname(os.path.abspath(path))
+                                       for path in paths])
+        job = partial(self._job, root=root)
+        if self.log_dir is not None:
+            os.makedirs(self.log_dir, exist_ok=True)
+        executor = self.executor
+        if ordered:
+            return list(executor.map(job, paths))
+        from concurrent.futures import as_completed
+        futures = [executor.submit(job, path) for path in paths]
+        return [future.result() for future in as_completed(futures)]
+
+    @property
+    def executor(self):
+        """ThreadPoolExecutor: the thread pool, started on first use"""
+        with self._lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(self.workers)
+            return self._executor
+
+    def close(self):
+        """Stop the thread pool after the running jobs"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def interface():
     """Take in the data file name
     This function is an interface which can interact with the user. This
     function takes in the file path with file extension.
     Then it calls the function extreme_detection to collect the maximum
     and the minimum.
-    Then it calls the functions if_missing_time and if_missing_vol to
-    remove the missing data.
-    Then it calls the function fourier_transform to do fast fourier
-    transform to the data without missing data.
-    Then it calls the function ideal_filter to pass the signal through
-    an ideal filter to remove the baseline of the signal.
+    Then it calls the function clean_missing to remove the missing
+    data.
+    Then it calls the function band_pass_filter, which does fast
+    fourier transform with fourier_transform and passes the signal
+    through an ideal filter with ideal_filter to remove the baseline of
+    the signal.
     Then it calls the function find_R_wave to find the R peaks.
     Then it calls the function fetch_metrics to calculate the metrics.
     Then it calls the function produce_dict to output the metrics into
@@ -357,23 +2370,222 @@ def interface():
     print("Please include the extension,like: .csv")
     path = input("The path is: ")
     file_name = path_leaf(path)
-    logging.basicConfig(filename=file_name + '.log',
-                        level=logging.INFO,
-                        filemode='w')
-    time, voltage = take_in_data(path)
-    time, voltage = if_missing_time(time, voltage)
-    time, voltage = if_missing_vol(time, voltage)
-    voltage_extremes = extreme_detection(voltage)
-    f_index, freq_ECG = fourier_transform(time, voltage)
-    recovered_time = ideal_filter(f_index, voltage, freq_ECG)
-    (new_peaks, normalized_voltage,
-     wrapped_voltage, value) = find_R_wave(recovered_time)
-    (duration, num_beats, mean_hr_bpm,
-     beats_time) = fetch_metrics(new_peaks, normalized_voltage,
-                                 wrapped_voltage, value,
-                                 time, recovered_time)
-    patient_dict = produce_dict(duration, voltage_extremes, num_beats,
-                                mean_hr_bpm, beats_time)
-    output_file(patient_dict, file_name)
+    with job_logging(file_name + '.log'):
+        patient_dict = analyze_strip(path)
+        output_file(patient_dict, file_name)
+
+
+def main(argv=None):
+    """Analyze the ECG files given on the command line
+
+    Every source (directory, glob pattern, .csv file or manifest) is
+    expanded and the files are analyzed in batch mode, then a summary
+    is printed as JSON. The heavy libraries are only imported by the
+    stages that need them, so short runs start quickly. The old
+    interactive interface is started with --interactive.
+
+    Args:
+        argv (list): the command line arguments, sys.argv if None
+
+    Returns:
+        int: the exit status, 1 if any file failed
+    """
+    parser = argparse.ArgumentParser(description="Analyze ECG strips")
+    parser.add_argument("sources", nargs="*",
+                        help="directory, glob, .csv file or manifest")
+    parser.add_argument("-i", "--interactive", action="store_true",
+                        help="ask for one file path instead")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument("-o", "--out-dir", default=".",
+                        help="directory for the .json and .log files")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="files handed to a worker at once")
+    parser.add_argument("--window", type=int, default=None,
+                        help="stream each file in windows of this many "
+                        "samples")
+    parser.add_argument("--leads", action="store_true",
+                        help="analyze every lead of multi-lead files")
+    parser.add_argument("--output-mode", choices=OUTPUT_MODES,
+                        default="json", help="one .json file per strip, "
+                        "one results.jsonl file, one results.sqlite "
+                        "database or one binary .ecgb file per strip")
+    parser.add_argument("--filter", choices=FILTER_ENGINES,
+                        default="ideal", help="band-pass filter engine")
+    parser.add_argument("--detector", choices=DETECTOR_ENGINES,
+                        default="legacy", help="R peak detector engine")
+    parser.add_argument("--hrv-window", type=float, default=None,
+                        help="add heart rate and HRV statistics over "
+                        "windows of this many seconds")
+    parser.add_argument("--hrv-step", type=float, default=None,
+                        help="seconds between HRV window starts, the "
+                        "window length by default")
+    parser.add_argument("--hrv-rr", action="store_true",
+                        help="also output every RR interval in "
+                        "milliseconds with the HRV statistics")
+    parser.add_argument("--decimate", nargs="?", const="auto", default=None,
+                        metavar="HZ",
+                        help="decimate fast recordings to at least this "
+                        "rate before filtering, chosen from the filter "
+                        "band without a value")
+    parser.add_argument("--quality", choices=QUALITY_MODES, default=None,
+                        help="check the signal quality first and add a "
+                        "report, or also skip the analysis of strips "
+                        "that fail it")
+    parser.add_argument("--quality-limit", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="replace one limit of the quality check, "
+                        "e.g. snr_db=6, may be repeated")
+    parser.add_argument("--cache-dir",
+                        default=os.environ.get("ECG_CACHE_DIR"),
+                        help="directory of the binary data cache")
+    parser.add_argument("--cache-size", type=float, default=None,
+                        help="size limit of the cache in megabytes")
+    parser.add_argument("--rebuild-cache", action="store_true",
+                        help="parse every file again and refresh the cache")
+    parser.add_argument("--result-cache",
+                        default=os.environ.get("ECG_RESULT_CACHE"),
+                        help="directory of the result cache, used for "
+                        "single-lead whole-file analysis")
+    parser.add_argument("--result-cache-size", type=float, default=None,
+                        help="size limit of the result cache in megabytes")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report which files the result cache "
+                        "would recompute")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not use the caches")
+    parser.add_argument("--metrics", action="store_true",
+                        help="write per-stage timing to .metrics.json files")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also trace the peak memory of every stage, "
+                        "which slows the stages down")
+    parser.add_argument("--profile", default=None, metavar="STATS",
+                        help="profile a single file with cProfile into "
+                        "this file")
+    parser.add_argument("--plot", action="store_true",
+                        help="save a .png plot of every strip (needs "
+                        "matplotlib)")
+    parser.add_argument("--unordered", action="store_true",
+                        help="report files in completion order")
+    parser.add_argument("--summary", default=None,
+                        help="also write the summary to this .json file")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="do not print per-file progress")
+    args = parser.parse_args(argv)
+    if args.interactive:
+        interface()
+        return 0
+    if not args.sources:
+        parser.error("give at least one source or --interactive")
+    options = {"filter_engine": args.filter, "detector": args.detector}
+    if args.hrv_window is not None:
+        options["hrv_window"] = args.hrv_window
+        options["hrv_step"] = args.hrv_step
+        options["rr_series"] = args.hrv_rr
+    elif args.hrv_rr:
+        parser.error("--hrv-rr needs --hrv-window")
+    if args.decimate is not None:
+        if args.window is not None or args.leads:
+            parser.error("--decimate only works on whole single-lead "
+                         "strips, not with --window or --leads")
+        if args.decimate != "auto":
+            try:
+                args.decimate = float(args.decimate)
+            except ValueError:
+                parser.error("--decimate needs a rate in Hz or no value")
+        options["decimate"] = args.decimate
+    if args.quality is not None:
+        if args.window is not None or args.leads:
+            parser.error("--quality only works on whole single-lead "
+                         "strips, not with --window or --leads")
+        options["quality"] = args.quality
+        limits = {}
+        for limit in args.quality_limit:
+            name, _, value = limit.partition("=")
+            if name not in QUALITY_LIMITS or not value:
+                parser.error("--quality-limit needs NAME=VALUE with NAME "
+                             "one of " + ", ".join(QUALITY_LIMITS))
+            try:
+                limits[name] = float(value)
+            except ValueError:
+                parser.error("--quality-limit {} needs a number, not "
+                             "{!r}".format(name, value))
+        if limits:
+            options["quality_limits"] = limits
+    elif args.quality_limit:
+        parser.error("--quality-limit needs --quality")
+    if args.cache_dir is not None and not args.no_cache:
+        if args.window is not None or args.leads:
+            parser.error("the data cache (--cache-dir or ECG_CACHE_DIR) "
+                         "only works on whole single-lead strips, add "
+                         "--no-cache to use --window or --leads")
+        options["cache_dir"] = args.cache_dir
+        options["rebuild_cache"] = args.rebuild_cache
+        if args.cache_size is not None:
+            options["cache_bytes"] = int(args.cache_size * 2**20)
+    if args.result_cache is not None and not args.no_cache:
+        if args.window is not None or args.leads:
+            parser.error("the result cache (--result-cache or "
+                         "ECG_RESULT_CACHE) only works on whole "
+                         "single-lead strips, add --no-cache to use "
+                         "--window or --leads")
+        options["result_dir"] = args.result_cache
+        options["rebuild_cache"] = args.rebuild_cache
+        if args.result_cache_size is not None:
+            options["result_bytes"] = int(args.result_cache_size * 2**20)
+    paths = []
+    for source in args.sources:
+        paths.extend(collect_paths(source))
+    if args.dry_run:
+        if "result_dir" not in options:
+            parser.error("--dry-run needs --result-cache")
+        from ECG_cache import plan_results
+        report = plan_results(paths, args.result_cache,
+                              filter_engine=args.filter,
+                              detector=args.detector,
+                              hrv_window=args.hrv_window,
+                              hrv_step=args.hrv_step,
+                              quality=options.get("quality"),
+                              quality_limits=options.get("quality_limits"),
+                              decimate=args.decimate,
+                              rr_series=args.hrv_rr)
+        for entry in report["files"]:
+            print("{} {}".format("cached   " if entry["cached"]
+                                 else "recompute", entry["path"]))
+        del report["files"]
+        print(json.dumps(report, indent=2))
+        return 0
+    if args.profile is not None:
+        if len(paths) != 1:
+            parser.error("--profile needs exactly one file")
+        os.makedirs(args.out_dir, exist_ok=True)
+        record = profile_file(paths[0], args.profile, args.out_dir,
+                              window=args.window, leads=args.leads,
+                              **options)
+        import pstats
+        pstats.Stats(args.profile).sort_stats("cumulative").print_stats(20)
+        return 0 if record["status"] == "ok" else 1
+    if args.metrics or args.trace_memory:
+        options["instrument"] = True
+        options["trace_memory"] = args.trace_memory
+    if args.plot:
+        options["plot"] = True
+    summary = batch_process(paths, workers=args.workers,
+                            ordered=not args.unordered,
+                            out_dir=args.out_dir,
+                            chunksize=args.chunksize,
+                            progress=None if args.quiet
+                            else _print_progress,
+                            window=args.window, leads=args.leads,
+                            output_mode=args.output_mode, **options)
+    report = dict(summary)
+    del report["records"]
+    print(json.dumps(report, indent=2))
+    if args.summary is not None:
+        with open(args.summary, "w") as out_file:
+            json.dump(summary, out_file, indent=2)
+    return 1 if summary["failed"] else 0
+
+
 if __name__ == "__main__":
-    interface()
+    sys.exit(main())
@@ -0,0 +1,437 @@
+import os
+import re
+import json
+import numpy as np
+
+
+class Record:
+    """A binary ECG record whose samples stay on disk
+
+    The samples are read through a memory map, so opening a record
+    reads only its header. The digital samples of a range are read on
+    demand and turned into voltages in millivolts as
+    (digital - baseline) / gain, one channel per row.
+
+    Args:
+        fs (float): the sampling frequency in Hz
+        length (int): the number of samples per channel
+        names (list): the names of the channels
+        gain (array): the digital units per millivolt of every channel
+        baseline (array): the digital value of 0 mV of every channel
+        read (function): returns the digital samples of a range as a
+            samples x channels array
+        start_time (float): the time of the first sample in seconds
+        invalid (int): the digital value of a missing sample, or None
+    """
+
+    def __init__(self, fs, length, names, gain, baseline, read,
+                 start_time=0.0, invalid=None):
+        self.fs = float(fs)
+        self.length = int(length)
+        self.names = list(names)
+        self.gain = np.asarray(gain, dtype=np.float64)
+        self.baseline = np.asarray(baseline, dtype=np.float64)
+        self.start_time = float(start_time)
+        self.invalid = invalid
+        self._read = read
+
+    def digital(self, start=0, stop=None):
+        """Read the digital samples of a range
+
+        Args:
+            start (int): the first sample
+            stop (int): the sample after the last one, the end if None
+
+        Returns:
+            array: the samples x channels digital samples
+        """
+        start, stop, _ = slice(start, stop).indices(self.length)
+        return self._read(start, max(start, stop))
+
+    def time(self, start=0, stop=None, dtype=np.float64):
+        """Build the time array of a range
+
+        Args:
+            start (int): the first sample
+            stop (int): the sample after the last one, the end if None
+            dtype (type): the floating point type, np.float64 or np.float32
+
+        Returns:
+            array: the time array
+        """
+        start, stop, _ = slice(start, stop).indices(self.length)
+        index = np.arange(start, max(start, stop), dtype=np.float64)
+        return (self.start_time + index / self.fs).astype(dtype)
+
+    def voltage(self, start=0, stop=None, dtype=np.float64, channels=None):
+        """Read the voltages of a range in millivolts
+
+        Missing samples become nan.
+
+        Args:
+            start (int): the first sample
+            stop (int): the sample after the last one, the end if None
+            dtype (type): the floating point type, np.float64 or np.float32
+            channels (list): the indices of the channels, all if None
+
+        Returns:
+            array: the voltage array, channels x samples
+        """
+        if channels is None:
+            channels = slice(None)
+        digital = self.digital(start, stop)[:, channels].T
+        voltage = np.subtract(digital, self.baseline[channels, None],
+                              dtype=dtype)
+        voltage /= self.gain[channels, None].astype(dtype)
+        if self.invalid is not None:
+            voltage[digital == self.invalid] = np.nan
+        return np.ascontiguousarray(voltage)
+
+
+def _unit_scale(units):
+    """Find the factor from the given units to millivolts"""
+    units = units.strip()
+    if units in ("uV", "µV", "μV"):
+        return 0.001
+    if units == "V":
+        return 1000.0
+    return 1.0
+
+
+def _columns(samples, width):
+    """View a flat array of interleaved samples as samples x channels"""
+    return samples[:len(samples) // width * width].reshape(-1, width)
+
+
+def open_raw(path):
+    """Open a raw binary sample file with a sidecar header
+
+    The header is a JSON file next to the data with the same name and
+    the extension .hdr. It holds the sampling frequency "fs" and
+    optionally "dtype" ("int16" by default, or "float32"), "gain"
+    (digital units per millivolt, 1 by default), "offset" (the digital
+    value of 0 mV, 0 by default), "channels" (1 by default), "names",
+    "units" ("mV" by default), "start_time" and "header_bytes" (the
+    bytes to skip at the start of the data file). Multiple channels
+    are interleaved sample by sample. gain and offset can be one value
+    or one value per channel.
+
+    Args:
+        path (string): the path of the data file
+
+    Returns:
+        Record: the record
+    """
+    with open(os.path.splitext(path)[0] + ".hdr") as in_file:
+        header = json.load(in_file)
+    dtype = np.dtype(header.get("dtype", "int16")).newbyteorder("<")
+    if dtype.name not in ("int16", "float32"):
+        raise ValueError("Unsupported sample type {}".format(dtype.name))
+    channels = int(header.get("channels", 1))
+    samples = np.memmap(path, dtype=dtype, mode="r",
+                        offset=int(header.get("header_bytes", 0)))
+    samples = _columns(samples, channels)
+    names = header.get("names", [str(i) for i in range(channels)])
+    gain = np.broadcast_to(np.asarray(header.get("gain", 1.0),
+                                      dtype=np.float64), channels)
+    gain = gain / _unit_scale(header.get("units", "mV"))
+    offset = np.broadcast_to(np.asarray(header.get("offset", 0.0),
+                                        dtype=np.float64), channels)
+    return Record(header["fs"], len(samples), names, gain, offset,
+                  lambda start, stop: samples[start:stop],
+                  header.get("start_time", 0.0))
+
+
+def _unpack_212(data, first, count):
+    """Decode samples of a WFDB format 212 byte array
+
+    Every two samples are packed into three bytes as 12-bit two's
+    complement numbers.
+
+    Args:
+        data (array): the bytes of the file
+        first (int): the first sample in the file
+        count (int): the number of samples
+
+    Returns:
+        array: the int16 samples
+    """
+    pair = first // 2
+    end = (first + count + 1) // 2
+    block = data[3 * pair:3 * end].reshape(-1, 3).astype(np.int16)
+    samples = np.empty(2 * len(block), dtype=np.int16)
+    samples[0::2] = block[:, 0] | ((block[:, 1] & 0x0f) << 8)
+    samples[1::2] = block[:, 2] | ((block[:, 1] & 0xf0) << 4)
+    samples[samples > 2047] -= 4096
+    skip = first - 2 * pair
+    return samples[skip:skip + count]
+
+
+def open_wfdb(path):
+    """Open a WFDB record from its .hea header file
+
+    The signals must be stored together in one .dat file in format 16
+    (16-bit little-endian), 80 (8-bit offset binary) or 212 (packed
+    12-bit). The digital value -32768 (-2048 in format 212, 0 in
+    format 80) marks a missing sample.
+
+    Args:
+        path (string): the path of the .hea file
+
+    Returns:
+        Record: the record
+    """
+    with open(path) as in_file:
+        lines = [line.strip() for line in in_file]
+    lines = [line for line in lines if line and not line.startswith("#")]
+    fields = lines[0].split()
+    nsig = int(fields[1])
+    fs = 250.0
+    if len(fields) > 2:
+        fs = float(re.match(r"[\d.eE+-]+", fields[2]).group())
+    length = int(fields[3]) if len(fields) > 3 else None
+    files = set()
+    formats = set()
+    names = []
+    gain = []
+    baseline = []
+    byte_offset = 0
+    for i, line in enumerate(lines[1:nsig + 1]):
+        fields = line.split(None, 8)
+        files.add(fields[0])
+        match = re.match(r"(\d+)(?:x\d+)?(?::\d+)?(?:\+(\d+))?", fields[1])
+        formats.add(match.group(1))
+        byte_offset = int(match.group(2) or 0)
+        adc_gain = 200.0
+        adc_baseline = None
+        units = "mV"
+        if len(fields) > 2:
+            match = re.match(r"([\d.eE+-]+)(?:\((-?\d+)\))?(?:/(\S+))?",
+                             fields[2])
+            adc_gain = float(match.group(1)) or 200.0
+            if match.group(2) is not None:
+                adc_baseline = int(match.group(2))
+            units = match.group(3) or units
+        if adc_baseline is None:
+            adc_baseline = int(fields[4]) if len(fields) > 4 else 0
+        names.append(fields[8] if len(fields) > 8 else str(i))
+        gain.append(adc_gain / _unit_scale(units))
+        baseline.append(adc_baseline)
+    if len(files) != 1 or len(formats) != 1:
+        raise ValueError("The signals of {} must share one file and "
+                         "format".format(path))
+    data_path = os.path.join(os.path.dirname(path), files.pop())
+    form = formats.pop()
+    if form == "16":
+        samples = _columns(np.memmap(data_path, dtype="<i2", mode="r",
+                                     offset=byte_offset), nsig)
+
+        def read(start, stop):
+            return samples[start:stop]
+        invalid = -32768
+        total = len(samples)
+    elif form == "80":
+        samples = _columns(np.memmap(data_path, dtype=np.uint8, mode="r",
+                                     offset=byte_offset), nsig)
+
+        def read(start, stop):
+            return samples[start:stop].astype(np.int16) - 128
+        invalid = -128
+        total = len(samples)
+    elif form == "212":
+        data = np.memmap(data_path, dtype=np.uint8, mode="r",
+                         offset=byte_offset)
+
+        def read(start, stop):
+            flat = _unpack_212(data, start * nsig, (stop - start) * nsig)
+            return flat.reshape(-1, nsig)
+        invalid = -2048
+        total = len(data) // 3 * 2 // nsig
+    else:
+        raise ValueError("Unsupported WFDB format {}".format(form))
+    if length is None or length > total:
+        length = total
+    return Record(fs, length, names, gain, baseline, read, invalid=invalid)
+
+
+def open_edf(path):
+    """Open an EDF or EDF+ file
+
+    The ECG signals are the signals with the sampling frequency of the
+    first signal that is not an annotation signal. Their 16-bit samples
+    are read through a memory map, one data record at a time.
+
+    Args:
+        path (string): the path of the .edf file
+
+    Returns:
+        Record: the record
+    """
+    with open(path, "rb") as in_file:
+        header = in_file.read(256).decode("ascii", "replace")
+        header_bytes = int(header[184:192])
+        num_records = int(header[236:244])
+        duration = float(header[244:252])
+        ns = int(header[252:256])
+        signals = in_file.read(ns * 256).decode("ascii", "replace")
+
+    def field(start, width):
+        offset = start * ns
+        return [signals[offset + i * width:offset + (i + 1) * width].strip()
+                for i in range(ns)]
+    labels = field(0, 16)
+    units = field(96, 8)
+    physical_min = np.array(field(104, 8), dtype=np.float64)
+    physical_max = np.array(field(112, 8), dtype=np.float64)
+    digital_min = np.array(field(120, 8), dtype=np.float64)
+    digital_max = np.array(field(128, 8), dtype=np.float64)
+    counts = np.array(field(216, 8), dtype=int)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    chosen = [i for i in range(ns) if labels[i] != "EDF Annotations"]
+    if len(chosen) == 0:
+        raise ValueError("There is no signal in {}".format(path))
+    per_record = counts[chosen[0]]
+    chosen = [i for i in chosen if counts[i] == per_record]
+    data = np.memmap(path, dtype="<i2", mode="r", offset=header_bytes)
+    if num_records < 0:
+        num_records = len(data) // counts.sum()
+    data = data[:num_records * counts.sum()].reshape(num_records, -1)
+    scale = np.array([_unit_scale(units[i]) for i in chosen])
+    step = ((physical_max - physical_min) / (digital_max - digital_min))[
+        chosen]
+    gain = 1 / (step * scale)
+    baseline = digital_min[chosen] - physical_min[chosen] / step
+
+    def read(start, stop):
+        first = start // per_record
+        last = -(-stop // per_record)
+        block = data[first:last]
+        samples = np.stack([block[:, offsets[i]:offsets[i] + per_record]
+                            .reshape(-1) for i in chosen], axis=1)
+        skip = start - first * per_record
+        return samples[skip:skip + stop - start]
+    return Record(per_record / duration, num_records * per_record,
+                  [labels[i] for i in chosen], gain, baseline, read)
+
+
+READERS = {".raw": open_raw, ".bin": open_raw, ".hea": open_wfdb,
+           ".edf": open_edf}
+
+
+def register_reader(extension, opener):
+    """Add a reader for the files with the given extension
+
+    Args:
+        extension (string): the file extension, like ".dat"
+        opener (function): takes a path and returns a Record
+    """
+    READERS[extension.lower()] = opener
+
+
+def is_binary(path):
+    """Check whether a file is read by one of the binary readers
+
+    Args:
+        path (string): the inputted file path
+
+    Returns:
+        bool: True if a reader is registered for the file extension
+    """
+    return os.path.splitext(path)[1].lower() in READERS
+
+
+def record_files(path):
+    """List every file that holds a part of an ECG record
+
+    A .csv or EDF file is one file, a raw record has its .hdr header
+    and a WFDB record has the .dat files named in its header.
+
+    Args:
+        path (string): the inputted file path
+
+    Returns:
+        list: the paths of the files of the record
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if READERS.get(extension) is open_raw:
+        return [path, os.path.splitext(path)[0] + ".hdr"]
+    if READERS.get(extension) is open_wfdb:
+        with open(path) as in_file:
+            lines = [line.split() for line in in_file
+                     if line.strip() and not line.startswith("#")]
+        names = sorted(set(fields[0] for fields in lines[1:]))
+        return [path] + [os.path.join(os.path.dirname(path), name)
+                         for name in names]
+    return [path]
+
+
+def open_record(path):
+    """Open a binary ECG record with the reader of its extension
+
+    Args:
+        path (string): the inputted file path
+
+    Returns:
+        Record: the record
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in READERS:
+        raise ValueError("There is no reader for {}".format(path))
+    return READERS[extension](path)
+
+
+def read_record(path, dtype=np.float64):
+    """Read all the channels of a binary ECG record
+
+    Args:
+        path (string): the inputted file path
+        dtype (type): the floating point type, np.float64 or np.float32
+
+    Returns:
+        array: the time array
+        array: the voltage array, channels x samples
+        list: the names of the channels
+    """
+    record = open_record(path)
+    return (record.time(dtype=dtype), record.voltage(dtype=dtype),
+            record.names)
+
+
+def read_signal(path, dtype=np.float64, channel=0):
+    """Read one channel of a binary ECG record
+
+    Only the samples of the channel are converted, the rest of the
+    file is never loaded.
+
+    Args:
+        path (string): the inputted file path
+        dtype (type): the floating point type, np.float64 or np.float32
+        channel (int): the index of the channel
+
+    Returns:
+        array: the time array
+        array: the voltage array
+    """
+    record = open_record(path)
+    voltage = record.voltage(dtype=dtype, channels=[channel])
+    return record.time(dtype=dtype), voltage[0]
+
+
+def iter_record(path, chunksize, dtype=np.float64, channel=0):
+    """Read one channel of a binary ECG record piece by piece
+
+    Args:
+        path (string): the inputted file path
+        chunksize (int): the number of samples read at once
+        dtype (type): the floating point type, np.float64 or np.float32
+        channel (int): the index of the channel
+
+    Yields:
+        array: the time array of the piece
+        array: the voltage array of the piece
+    """
+    record = open_record(path)
+    for start in range(0, record.length, chunksize):
+        stop = min(start + chunksize, record.length)
+        voltage = record.voltage(start, stop, dtype, [channel])
+        yield record.time(start, stop, dtype), voltage[0]
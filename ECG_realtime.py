@@ -0,0 +1,272 @@
+import sys
+import json
+import argparse
+from time import perf_counter, sleep
+from collections import deque
+import numpy as np
+from scipy.signal import butter, sosfilt, sosfilt_zi
+from ECG_processor import take_in_data, clean_missing
+
+
+class StreamingRDetector:
+    """Detect R peaks incrementally as samples arrive
+
+    The samples pass through a causal Butterworth band-pass filter
+    (0.7-45 Hz by default) whose state is carried from one block to
+    the next. Local maxima of the filtered signal are compared with an
+    adaptive threshold that follows running estimates of the signal
+    and noise peak levels, as in the Pan-Tompkins detector. A peak
+    above the threshold is held for one refractory period and replaced
+    by any larger peak in that time, then emitted as a beat. So a beat
+    is reported at most latency_budget seconds of signal, one
+    refractory period, plus one block after its sample arrives. During
+    the first learning seconds the peaks are only collected to set the
+    initial levels.
+
+    The whole state is bounded: the filter state, two samples of the
+    filtered signal, the learning peaks and the last rr_window RR
+    intervals.
+
+    Args:
+        fs (float): the sampling frequency in Hz
+        low (float): the low cutoff frequency in Hz
+        high (float): the high cutoff frequency in Hz
+        refractory (float): the shortest time between two beats in seconds
+        learning (float): the length of the learning period in seconds
+        rr_window (int): the number of RR intervals in mean_hr_bpm
+        start_time (float): the time of the first sample in seconds
+    """
+
+    def __init__(self, fs, low=0.7, high=45, refractory=0.2, learning=2.0,
+                 rr_window=8, start_time=0.0):
+        self.fs = float(fs)
+        high = min(high, 0.45 * self.fs)
+        self._sos = butter(2, [low, high], btype="band", fs=self.fs,
+                           output="sos")
+        self._zi = None
+        self._refractory = int(round(refractory * self.fs))
+        self._learning = int(round(learning * self.fs))
+        self._start_time = start_time
+        self._count = 0
+        self._tail = np.empty(0)
+        self._learned = []
+        self._signal_level = None
+        self._noise_level = 0.0
+        self._pending = None
+        self._last_beat = None
+        self._rr = deque(maxlen=rr_window)
+        self.latency_budget = self._refractory / self.fs
+
+    @property
+    def threshold(self):
+        """float: the current detection threshold, None while learning"""
+        if self._signal_level is None:
+            return None
+        return self._noise_level + 0.25 * (self._signal_level -
+                                           self._noise_level)
+
+    @property
+    def mean_hr_bpm(self):
+        """float: the heart rate over the last RR intervals, None if unknown"""
+        if len(self._rr) == 0:
+            return None
+        return 60.0 / (sum(self._rr) / len(self._rr))
+
+    def _beat(self, index):
+        """Record one beat and return its time"""
+        if self._last_beat is not None:
+            self._rr.append((index - self._last_beat) / self.fs)
+        self._last_beat = index
+        return self._start_time + index / self.fs
+
+    def _peak(self, index, value, beats):
+        """Feed one local maximum of the filtered signal to the detector"""
+        if value <= self.threshold:
+            self._noise_level = 0.125 * value + 0.875 * self._noise_level
+            return
+        if self._pending is not None:
+            if index - self._pending[0] < self._refractory:
+                if value > self._pending[1]:
+                    self._pending = (index, value)
+                return
+            beats.append(self._beat(self._pending[0]))
+        self._signal_level = 0.125 * value + 0.875 * self._signal_level
+        self._pending = (index, value)
+
+    def push(self, voltage):
+        """Process a block of new samples
+
+        Args:
+            voltage (array): the new samples
+
+        Returns:
+            list: the times of the beats confirmed by this block
+        """
+        voltage = np.asarray(voltage, dtype=np.float64)
+        if len(voltage) == 0:
+            return []
+        if self._zi is None:
+            self._zi = sosfilt_zi(self._sos) * voltage[0]
+        filtered, self._zi = sosfilt(self._sos, voltage, zi=self._zi)
+        signal = np.concatenate((self._tail, filtered))
+        offset = self._count - len(self._tail)
+        middle = signal[1:-1]
+        local = np.flatnonzero((middle > signal[:-2]) &
+                               (middle >= signal[2:])) + 1
+        self._tail = signal[-2:]
+        self._count = self._count + len(voltage)
+        beats = []
+        for i in local:
+            index = offset + i
+            value = signal[i]
+            if self._signal_level is None:
+                self._learned.append((index, value))
+                continue
+            self._peak(index, value, beats)
+        if self._signal_level is None and self._count >= self._learning:
+            self._finish_learning(beats)
+        if (self._pending is not None and
+                self._count - 1 - self._pending[0] >= self._refractory):
+            beats.append(self._beat(self._pending[0]))
+            self._pending = None
+        return beats
+
+    def _finish_learning(self, beats):
+        """Set the initial levels and replay the learning peaks"""
+        values = np.array([value for _, value in self._learned])
+        if len(values) == 0:
+            return
+        self._signal_level = 0.5 * float(np.max(values))
+        self._noise_level = 0.5 * float(np.mean(values))
+        learned = self._learned
+        self._learned = []
+        for index, value in learned:
+            self._peak(index, value, beats)
+
+    def flush(self):
+        """Emit the beat still held at the end of the feed
+
+        Returns:
+            list: the time of the held beat, if any
+        """
+        beats = []
+        if self._signal_level is None:
+            self._finish_learning(beats)
+        if self._pending is not None:
+            beats.append(self._beat(self._pending[0]))
+            self._pending = None
+        return beats
+
+
+def replay(path, speed=1.0, block=0.04, **detector_options):
+    """Replay an ECG file through StreamingRDetector as a simulated feed
+
+    The file is read and cleaned, then handed to the detector in blocks
+    of block seconds. With a speed the blocks are released at speed
+    times real time, otherwise as fast as possible. For every beat the
+    latency is the wall time from the arrival of the block that holds
+    its sample to the moment the beat is emitted. The detection delay
+    is the signal time from the beat to the end of the block that
+    emits it, which the detector keeps under its latency_budget plus
+    one block. The beats over that budget are counted in over_budget.
+    The beats of the learning period wait for its end, so they are
+    left out of the delay statistics.
+
+    Args:
+        path (string): the inputted file path
+        speed (float): the replay speed, 1 for real time, None for no pause
+        block (float): the length of a block in seconds
+        **detector_options: the keyword arguments of StreamingRDetector
+
+    Returns:
+        dictionary: the beats, the final mean_hr_bpm, latency, detection
+        delay and throughput statistics
+    """
+    time, voltage = take_in_data(path)
+    time, voltage, _ = clean_missing(time, voltage)
+    fs = 1 / (time[1] - time[0])
+    detector = StreamingRDetector(fs, start_time=float(time[0]),
+                                  **detector_options)
+    size = max(1, int(round(block * fs)))
+    arrivals = []
+    beats = []
+    latencies = []
+    delays = []
+    busy = 0.0
+    start = perf_counter()
+    for first in range(0, len(voltage), size):
+        if speed:
+            due = start + (first + size) / fs / speed
+            wait = due - perf_counter()
+            if wait > 0:
+                sleep(wait)
+        arrival = perf_counter()
+        arrivals.append(arrival)
+        found = detector.push(voltage[first:first + size])
+        done = perf_counter()
+        busy = busy + done - arrival
+        seen = min(first + size, len(voltage))
+        for beat in found:
+            sample = int(round((beat - time[0]) * fs))
+            latencies.append(done - arrivals[sample // size])
+            if sample >= detector._learning:
+                delays.append((seen - 1 - sample) / fs)
+        beats.extend(found)
+    found = detector.flush()
+    done = perf_counter()
+    for beat in found:
+        sample = int(round((beat - time[0]) * fs))
+        latencies.append(done - arrivals[min(sample // size,
+                                             len(arrivals) - 1)])
+        if sample >= detector._learning:
+            delays.append((len(voltage) - 1 - sample) / fs)
+    beats.extend(found)
+    elapsed = done - start
+    latencies = np.array(latencies)
+    delays = np.array(delays)
+    budget = detector.latency_budget + size / fs
+    stats = {"beats": beats,
+             "num_beats": len(beats),
+             "mean_hr_bpm": detector.mean_hr_bpm,
+             "samples": len(voltage),
+             "elapsed": elapsed,
+             "samples_per_second": len(voltage) / busy if busy else None,
+             "realtime_factor": (len(voltage) / fs) / busy if busy else None,
+             "latency_mean": float(latencies.mean()) if beats else None,
+             "latency_p95": (float(np.percentile(latencies, 95))
+                             if beats else None),
+             "latency_max": float(latencies.max()) if beats else None,
+             "delay_budget": budget,
+             "delay_mean": float(delays.mean()) if len(delays) else None,
+             "delay_max": float(delays.max()) if len(delays) else None,
+             "over_budget": int((delays > budget).sum())}
+    return stats
+
+
+def main(argv=None):
+    """Replay ECG files through the streaming detector and print the stats
+
+    Args:
+        argv (list): the command line arguments, sys.argv if None
+
+    Returns:
+        int: the exit status
+    """
+    parser = argparse.ArgumentParser(
+        description="Replay ECG strips through the streaming detector")
+    parser.add_argument("paths", nargs="+", help="the .csv files to replay")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed, 0 for as fast as possible")
+    parser.add_argument("--block", type=float, default=0.04,
+                        help="block length in seconds")
+    args = parser.parse_args(argv)
+    for path in args.paths:
+        stats = replay(path, speed=args.speed, block=args.block)
+        del stats["beats"]
+        stats["path"] = path
+        print(json.dumps(stats))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,367 @@
+import os
+import sys
+import json
+import argparse
+import socketserver
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import TimeoutError as ResultTimeout
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import perf_counter, sleep
+import numpy as np
+from ECG_processor import ECGPipeline, _json_default, _logger, \
+    FILTER_ENGINES, DETECTOR_ENGINES
+
+
+class ServiceBusy(Exception):
+    """Raised when too many strips wait in an ECGService"""
+
+
+class ECGService:
+    """Analyze ECG strips sent to a local HTTP server
+
+    The service keeps one warm ECGPipeline for its whole life, so the
+    libraries are imported and the FFT is prepared once instead of once
+    per strip. The strips are analyzed on the thread pool of the
+    pipeline, so at most workers strips are analyzed at once however
+    many connections are open, and a burst is spread over all the
+    threads. At most max_pending strips wait for a free thread. When
+    that many are waiting a submission is refused at once, and the HTTP
+    server answers 503 with a Retry-After header, so callers back off
+    instead of piling up.
+
+    The HTTP interface is:
+
+    * POST /analyze with a CSV body uploads a strip. With a JSON body
+      {"path": "..."} the strip is read from that path, which must be
+      inside root when root is given. The answer is the dictionary of
+      produce_dict as JSON, or {"error": "..."} with status 422 if the
+      analysis failed.
+    * GET /stats returns the counters, the waiting strips and the
+      latency and throughput statistics of stats.
+    * GET /health returns {"status": "ok"}.
+
+    Args:
+        host (string): the address the server listens on
+        port (int): the port the server listens on, any free port if 0
+        workers (int): the number of worker threads, all cores if None
+        max_pending (int): the most strips waiting for a thread
+        max_upload (int): the largest accepted upload in bytes
+        timeout (float): the seconds a request waits for its result
+        root (string): the directory submitted paths must be inside
+        spool_dir (string): the directory for uploaded strips
+        **options: the keyword arguments passed on to analyze_strip
+    """
+
+    def __init__(self, host="127.0.0.1", port=8000, workers=None,
+                 max_pending=64, max_upload=64 * 2**20,
+                 timeout=300.0, root=None, spool_dir=None, **options):
+        self.pipeline = ECGPipeline(workers=workers, **options)
+        self.workers = self.pipeline.workers
+        self.max_upload = max_upload
+        self.timeout = timeout
+        self.root = None if root is None else os.path.realpath(root)
+        self.spool_dir = spool_dir
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._latency = deque(maxlen=1024)
+        self._service = deque(maxlen=1024)
+        self._counts = {"submitted": 0, "completed": 0, "failed": 0,
+                        "rejected": 0, "in_flight": 0, "pending": 0}
+        self._started = None
+        self._thread = None
+        self._server = _Server((host, port), _Handler)
+        self._server.service = self
+
+    @property
+    def url(self):
+        """string: the base URL of the server"""
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self, warm_up=True):
+        """Start the HTTP server
+
+        Args:
+            warm_up (bool): warm the pipeline up before serving
+
+        Returns:
+            ECGService: the running service
+        """
+        if warm_up:
+            self.pipeline.warm_up()
+        self._started = perf_counter()
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Start the service and block until it is interrupted"""
+        self.start()
+        try:
+            while True:
+                sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop taking submissions, finish the waiting strips and stop"""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        self.pipeline.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, path=None, data=None):
+        """Queue one strip, given by its path or its CSV contents
+
+        Args:
+            path (string): the path of the strip
+            data (bytes): the contents of a .csv strip
+
+        Returns:
+            Future: the future of the dictionary of produce_dict
+        """
+        if (path is None) == (data is None):
+            raise ValueError("Give either a path or the data of a strip")
+        if path is not None and self.root is not None:
+            real = os.path.realpath(path)
+            if os.path.commonpath([real, self.root]) != self.root:
+                raise PermissionError("{} is outside {}".format(path,
+                                                                self.root))
+        with self._lock:
+            if self._counts["pending"] >= self.max_pending:
+                self._counts["rejected"] += 1
+                raise ServiceBusy("{} strips are waiting".format(
+                    self.max_pending))
+            self._counts["pending"] += 1
+            self._counts["submitted"] += 1
+        temp = False
+        try:
+            if data is not None:
+                handle, path = tempfile.mkstemp(suffix=".csv",
+                                                dir=self.spool_dir)
+                with os.fdopen(handle, "wb") as out_file:
+                    out_file.write(data)
+                temp = True
+            return self.pipeline.executor.submit(self._analyze, path, temp,
+                                                 perf_counter())
+        except BaseException:
+            with self._lock:
+                self._counts["pending"] -= 1
+                self._counts["submitted"] -= 1
+            if temp:
+                os.remove(path)
+            raise
+
+    def _analyze(self, path, temp, submitted):
+        """Analyze one strip on a thread of the pipeline"""
+        with self._lock:
+            self._counts["pending"] -= 1
+            self._counts["in_flight"] += 1
+        start = perf_counter()
+        failed = False
+        try:
+            return self.pipeline.run(path)
+        except Exception:
+            _logger().exception("Failed to process %s", path)
+            failed = True
+            raise
+        finally:
+            if temp:
+                os.remove(path)
+            end = perf_counter()
+            with self._lock:
+                self._counts["in_flight"] -= 1
+                self._counts["failed" if failed else "completed"] += 1
+                self._latency.append(end - submitted)
+                self._service.append(end - start)
+
+    def stats(self):
+        """Return the counters and the latency and throughput statistics
+
+        The latencies, from submission to result, and the service times,
+        the analysis alone, are taken over the last 1024 strips.
+
+        Returns:
+            dictionary: the statistics of the service
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            latency = np.array(self._latency)
+            service = np.array(self._service)
+        elapsed = perf_counter() - self._started if self._started else 0.0
+        finished = stats["completed"] + stats["failed"]
+        stats.update({
+            "max_pending": self.max_pending,
+            "workers": self.workers,
+            "uptime": elapsed,
+            "strips_per_second": finished / elapsed if elapsed else None})
+        for name, values in (("latency", latency), ("service", service)):
+            if len(values):
+                stats[name + "_mean"] = float(values.mean())
+                stats[name + "_p50"] = float(np.percentile(values, 50))
+                stats[name + "_p95"] = float(np.percentile(values, 95))
+                stats[name + "_max"] = float(values.max())
+            else:
+                for key in ("mean", "p50", "p95", "max"):
+                    stats[name + "_" + key] = None
+        return stats
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    """Serve every connection on a thread of its own"""
+
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answer the HTTP requests of an ECGService"""
+
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status, body, headers=()):
+        data = json.dumps(body, default=_json_default).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/stats":
+            self._reply(200, service.stats())
+        elif self.path == "/health":
+            self._reply(200, {"status": "ok"})
+        else:
+            self._reply(404, {"error": "Unknown path " + self.path})
+
+    def do_POST(self):
+        service = self.server.service
+        if self.path != "/analyze":
+            self.close_connection = True
+            self._reply(404, {"error": "Unknown path " + self.path})
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.close_connection = True
+            self._reply(411, {"error": "Content-Length is required"})
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self._reply(400, {"error": "Content-Length must be a "
+                              "non-negative integer"})
+            return
+        if length > service.max_upload:
+            self.close_connection = True
+            self._reply(413, {"error": "The strip is larger than {} "
+                              "bytes".format(service.max_upload)})
+            return
+        body = self.rfile.read(length)
+        content_type = self.headers.get("Content-Type", "")
+        try:
+            if content_type.startswith("application/json"):
+                future = service.submit(path=json.loads(body)["path"])
+            else:
+                future = service.submit(data=body)
+        except ServiceBusy as e:
+            self._reply(503, {"error": str(e)}, [("Retry-After", "1")])
+            return
+        except PermissionError as e:
+            self._reply(403, {"error": str(e)})
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": "Bad request: {}".format(e)})
+            return
+        try:
+            result = future.result(service.timeout)
+        except ResultTimeout:
+            self._reply(504, {"error": "The analysis timed out"})
+        except Exception as e:
+            message = "{}: {}".format(type(e).__name__, e)
+            self._reply(422, {"error": message})
+        else:
+            self._reply(200, result)
+
+    def log_message(self, format, *args):
+        _logger().debug("%s - %s", self.address_string(), format % args)
+
+
+def main(argv=None):
+    """Serve ECG analysis over HTTP until interrupted
+
+    Args:
+        argv (list): the command line arguments, sys.argv if None
+
+    Returns:
+        int: the exit status
+    """
+    parser = argparse.ArgumentParser(
+        description="Serve ECG analysis over a local HTTP interface")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="port to listen on")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker threads")
+    parser.add_argument("--max-pending", type=int, default=64,
+                        help="strips waiting before submissions are "
+                        "refused with 503")
+    parser.add_argument("--max-upload", type=float, default=64,
+                        help="largest upload in megabytes")
+    parser.add_argument("--root", default=None,
+                        help="only accept paths inside this directory")
+    parser.add_argument("--filter", choices=FILTER_ENGINES,
+                        default="ideal", help="band-pass filter engine")
+    parser.add_argument("--detector", choices=DETECTOR_ENGINES,
+                        default="legacy", help="R peak detector engine")
+    parser.add_argument("--hrv-window", type=float, default=None,
+                        help="add heart rate and HRV statistics over "
+                        "windows of this many seconds")
+    parser.add_argument("--hrv-step", type=float, default=None,
+                        help="seconds between HRV window starts")
+    parser.add_argument("--hrv-rr", action="store_true",
+                        help="also return every RR interval in "
+                        "milliseconds with the HRV statistics")
+    parser.add_argument("--result-cache",
+                        default=os.environ.get("ECG_RESULT_CACHE"),
+                        help="directory of the result cache")
+    args = parser.parse_args(argv)
+    options = {"filter_engine": args.filter, "detector": args.detector}
+    if args.hrv_window is not None:
+        options["hrv_window"] = args.hrv_window
+        options["hrv_step"] = args.hrv_step
+        options["rr_series"] = args.hrv_rr
+    elif args.hrv_rr:
+        parser.error("--hrv-rr needs --hrv-window")
+    if args.result_cache is not None:
+        options["result_dir"] = args.result_cache
+    service = ECGService(args.host, args.port, args.workers,
+                         args.max_pending,
+                         int(args.max_upload * 2**20), root=args.root,
+                         **options)
+    print("Serving on {}".format(service.url), flush=True)
+    service.serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
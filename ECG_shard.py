@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import glob
+import zlib
+import shutil
+import argparse
+from time import perf_counter
+from ECG_processor import batch_process, collect_paths, OUTPUT_MODES, \
+    FILTER_ENGINES, DETECTOR_ENGINES
+
+MANIFEST = "shard-{}-of-{}.jsonl"
+SHARD_DIR = "shard-{}-of-{}"
+SUMMARY = "summary.json"
+MERGED_DIR = "merged"
+
+
+def shard_of(path, count):
+    """Give the shard of an ECG file
+
+    The shard is the CRC-32 of the normalized path modulo the number of
+    shards, so every node that lists the archive under the same paths
+    splits it the same way, without sharing any state.
+
+    Args:
+        path (string): the inputted file path
+        count (int): the number of shards
+
+    Returns:
+        int: the shard of the file, from 0 to count - 1
+    """
+    key = os.path.normpath(path).encode("utf-8", "surrogateescape")
+    return zlib.crc32(key) % count
+
+
+def shard_paths(paths, index, count):
+    """Select the files of one shard
+
+    Args:
+        paths (list): the file paths of the whole archive
+        index (int): the shard, from 0 to count - 1
+        count (int): the number of shards
+
+    Returns:
+        list: the sorted file paths of the shard
+    """
+    if not 0 <= index < count:
+        raise ValueError("The shard {} is not in 0 to {}".format(index,
+                                                                 count - 1))
+    return sorted(path for path in paths if shard_of(path, count) == index)
+
+
+def read_manifest(path):
+    """Load the checkpoint manifest of a shard
+
+    The manifest is a JSON Lines file. A line with a "shard" entry
+    describes a run of the shard, every other line is the record of one
+    finished file, and a later record of a file replaces the earlier
+    ones. A line cut short by a crash is ignored.
+
+    Args:
+        path (string): the path of the manifest
+
+    Returns:
+        dictionary: the last run description under "run" and the last
+        record of every file under "records"
+    """
+    manifest = {"run": None, "records": {}}
+    if not os.path.exists(path):
+        return manifest
+    with open(path) as in_file:
+        for line in in_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if "shard" in entry:
+                manifest["run"] = entry
+            else:
+                manifest["records"][entry["path"]] = entry
+    return manifest
+
+
+def _append(manifest, entries):
+    """Append entries to a manifest and make sure they reach the disk"""
+    with open(manifest, "a") as out_file:
+        out_file.write("".join(json.dumps(entry) + "\n"
+                               for entry in entries))
+        out_file.flush()
+        os.fsync(out_file.fileno())
+
+
+def run_shard(paths, index, count, out_dir=".", checkpoint=256,
+              retry_failed=False, output_mode="jsonl", workers=None,
+              progress=None, root=None, **options):
+    """Analyze the files of one shard, skipping those already finished
+
+    The files of the shard are analyzed by batch_process in groups of
+    checkpoint files. The results of the shard go to their own
+    directory out_dir/shard-<index>-of-<count>, in the given output
+    mode. After every group, once its results are written, the records
+    of its files are appended to the manifest
+    out_dir/shard-<index>-of-<count>.jsonl. A restarted shard skips
+    every file of the manifest, so a crash loses at most one group. With
+    retry_failed the files that failed are analyzed again.
+
+    The results and .log files are named by the path of their file
+    relative to root, the deepest directory holding the whole archive
+    by default, so files of the same name in different folders never
+    overwrite each other. The manifest records the name of every file.
+
+    Args:
+        paths (list): the file paths of the whole archive
+        index (int): the shard, from 0 to count - 1
+        count (int): the number of shards
+        out_dir (string): the directory shared by all shards
+        checkpoint (int): the number of files between two checkpoints
+        retry_failed (bool): analyze the failed files again
+        output_mode (string): the output mode of batch_process
+        workers (int): the number of worker processes, all cores if None
+        progress (function): called with (done, total, record) per file
+        root (string): the directory the output names are relative to
+        **options: the keyword arguments passed on to batch_process
+
+    Returns:
+        dictionary: the counts of the shard and the records of the files
+        analyzed in this run
+    """
+    mine = shard_paths(paths, index, count)
+    if root is None and paths:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(path))
+                                   for path in paths])
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = os.path.join(out_dir, MANIFEST.format(index, count))
+    results_dir = os.path.join(out_dir, SHARD_DIR.format(index, count))
+    done = read_manifest(manifest)["records"]
+    todo = [path for path in mine if path not in done or
+            (retry_failed and done[path]["status"] != "ok")]
+    _append(manifest, [{"shard": index, "shards": count,
+                        "total": len(mine), "output_mode": output_mode,
+                        "root": root, "pid": os.getpid()}])
+    start = perf_counter()
+    records = []
+    for first in range(0, len(todo), checkpoint):
+        group = todo[first:first + checkpoint]
+        summary = batch_process(group, workers=workers, ordered=False,
+                                out_dir=results_dir,
+                                output_mode=output_mode, root=root,
+                                **options)
+        _append(manifest, summary["records"])
+        for record in summary["records"]:
+            records.append(record)
+            if progress is not None:
+                progress(len(records), len(todo), record)
+    return {"shard": index,
+            "shards": count,
+            "total": len(mine),
+            "skipped": len(mine) - len(todo),
+            "processed": len(records),
+            "failed": sum(r["status"] != "ok" for r in records),
+            "elapsed": perf_counter() - start,
+            "output": results_dir,
+            "records": records}
+
+
+def merge_shards(out_dir=".", output_mode=None, results=True):
+    """Combine the results and the timing of every shard
+
+    The manifests of out_dir give the state of every shard: how many of
+    its files are finished, how many failed and how long the analysis
+    took. Unless results is False, the results of every shard are read
+    back one shard at a time and written together by a result writer
+    into out_dir/merged, in the output mode of the shards unless
+    another is given. The results are first written to a fresh
+    directory that then replaces out_dir/merged, so merging again never
+    duplicates results. The summary is also written to
+    out_dir/summary.json.
+
+    Args:
+        out_dir (string): the directory shared by all shards
+        output_mode (string): the output mode of the merged results
+        results (bool): merge the results as well as the summary
+
+    Returns:
+        dictionary: the counts, timing and failures of the whole run and
+        of every shard
+    """
+    from ECG_output import open_writer, read_results
+    manifests = sorted(glob.glob(os.path.join(out_dir,
+                                              MANIFEST.format("*", "*"))))
+    runs = []
+    shards = []
+    failures = []
+    for manifest in manifests:
+        state = read_manifest(manifest)
+        run = state["run"]
+        records = list(state["records"].values())
+        failed = [r for r in records if r["status"] != "ok"]
+        seconds = sum(r.get("seconds", 0.0) for r in records)
+        runs.append(run)
+        shards.append({"shard": run["shard"],
+                       "shards": run["shards"],
+                       "total": run["total"],
+                       "done": len(records),
+                       "failed": len(failed),
+                       "pending": run["total"] - len(records),
+                       "seconds": seconds})
+        failures.extend({"path": r["path"], "error": r["error"]}
+                        for r in failed)
+    output = None
+    if results and runs:
+        merged = os.path.join(out_dir, MERGED_DIR)
+        staging = merged + ".tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        writer = open_writer(output_mode or runs[0]["output_mode"], staging)
+        with writer:
+            for run in runs:
+                shard_dir = os.path.join(out_dir, SHARD_DIR.format(
+                    run["shard"], run["shards"]))
+                if not os.path.exists(shard_dir):
+                    continue
+                for name, result in read_results(run["output_mode"],
+                                                 shard_dir).items():
+                    writer.write(name, result)
+        shutil.rmtree(merged, ignore_errors=True)
+        os.replace(staging, merged)
+        output = os.path.join(merged, os.path.relpath(writer.target,
+                                                      staging))
+    counts = {run["shards"] for run in shards}
+    total = sum(shard["total"] for shard in shards)
+    done = sum(shard["done"] for shard in shards)
+    failed = sum(shard["failed"] for shard in shards)
+    seconds = sum(shard["seconds"] for shard in shards)
+    summary = {"shards": len(shards),
+               "complete": (len(counts) == 1 and
+                            len(shards) == counts.pop() and done == total),
+               "total": total,
+               "succeeded": done - failed,
+               "failed": failed,
+               "pending": total - done,
+               "seconds": seconds,
+               "files_per_second": done / seconds if seconds else 0.0,
+               "output": os.path.normpath(output) if output else None,
+               "failures": failures,
+               "per_shard": shards}
+    with open(os.path.join(out_dir, SUMMARY), "w") as out_file:
+        json.dump(summary, out_file, indent=2)
+    return summary
+
+
+def main(argv=None):
+    """Run one shard of an archive, or merge the finished shards
+
+    Args:
+        argv (list): the command line arguments, sys.argv if None
+
+    Returns:
+        int: the exit status, 1 if any file failed
+    """
+    parser = argparse.ArgumentParser(
+        description="Analyze an ECG archive in resumable shards")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    run = commands.add_parser("run", help="analyze the files of one shard")
+    run.add_argument("sources", nargs="+",
+                     help="directory, walked with its subdirectories, "
+                     "glob, .csv file or manifest")
+    run.add_argument("--shard", type=int, required=True,
+                     help="the shard to run, from 0")
+    run.add_argument("--shards", type=int, required=True,
+                     help="the number of shards")
+    run.add_argument("-o", "--out-dir", default=".",
+                     help="directory shared by all shards")
+    run.add_argument("-j", "--workers", type=int, default=None,
+                     help="number of worker processes")
+    run.add_argument("--checkpoint", type=int, default=256,
+                     help="files between two checkpoints")
+    run.add_argument("--retry-failed", action="store_true",
+                     help="analyze the files that failed before again")
+    run.add_argument("--output-mode", choices=OUTPUT_MODES,
+                     default="jsonl", help="output mode of the shard")
+    run.add_argument("--filter", choices=FILTER_ENGINES,
+                     default="ideal", help="band-pass filter engine")
+    run.add_argument("--detector", choices=DETECTOR_ENGINES,
+                     default="legacy", help="R peak detector engine")
+    merge = commands.add_parser("merge", help="combine the shards")
+    merge.add_argument("-o", "--out-dir", default=".",
+                       help="directory shared by all shards")
+    merge.add_argument("--output-mode", choices=OUTPUT_MODES, default=None,
+                       help="output mode of the merged results, that of "
+                       "the shards by default")
+    merge.add_argument("--summary-only", action="store_true",
+                       help="do not merge the results")
+    args = parser.parse_args(argv)
+    if args.command == "merge":
+        summary = merge_shards(args.out_dir, args.output_mode,
+                               not args.summary_only)
+        del summary["failures"]
+        print(json.dumps(summary, indent=2))
+        return 0 if summary["complete"] and not summary["failed"] else 1
+    paths = []
+    for source in args.sources:
+        paths.extend(collect_paths(source, recursive=True))
+    summary = run_shard(paths, args.shard, args.shards, args.out_dir,
+                        args.checkpoint, args.retry_failed,
+                        args.output_mode, args.workers,
+                        filter_engine=args.filter, detector=args.detector)
+    del summary["records"]
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
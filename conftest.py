@@ -0,0 +1,42 @@
+import pytest
+import numpy as np
+
+
+def _write_csv(path, time, voltage):
+    rows = ["{},{}".format(t, v) for t, v in zip(time, voltage)]
+    path.write_text("time,voltage\n" + "\n".join(rows) + "\n")
+    return str(path)
+
+
+def _synthetic_strip(duration=10, fs=250, beat_times=None, wander=0.1,
+                     noise=0.0):
+    t = np.arange(0, duration, 1 / fs)
+    v = wander * np.sin(2 * np.pi * 0.2 * t)
+    if noise:
+        v += noise * np.random.default_rng(0).normal(size=t.size)
+    if beat_times is None:
+        beat_times = np.arange(0.4, duration, 0.8)
+    for bt in beat_times:
+        v += np.exp(-((t - bt) / 0.01) ** 2)
+    return t, v, np.asarray(beat_times)
+
+
+@pytest.fixture
+def write_csv():
+    """Write a .csv strip of the given time and voltage values"""
+    return _write_csv
+
+
+@pytest.fixture
+def synthetic_strip():
+    """Make a strip of Gaussian beats on a wandering baseline"""
+    return _synthetic_strip
+
+
+@pytest.fixture
+def write_strip():
+    """Write a synthetic strip to a .csv file and return its path"""
+    def write(path, *args, **kwargs):
+        t, v, _ = _synthetic_strip(*args, **kwargs)
+        return _write_csv(path, t, v)
+    return write
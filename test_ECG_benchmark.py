@@ -0,0 +1,143 @@
+import pytest
+import numpy as np
+
+
+@pytest.mark.parametrize("duration, fs, hr_bpm", [
+    (10, 250, 75),
+    (60, 500, 120),
+])
+def test_synthetic_ecg(duration, fs, hr_bpm):
+    from ECG_benchmark import synthetic_ecg
+    time, voltage, beats = synthetic_ecg(duration, fs, hr_bpm)
+    assert len(time) == len(voltage) == duration * fs
+    assert abs(len(beats) - duration * hr_bpm / 60) <= 2
+    index = np.round(beats * fs).astype(int)
+    assert (voltage[index] > 0.5).all()
+
+
+def test_benchmark_filters():
+    from ECG_benchmark import benchmark_filters
+    results = benchmark_filters([1, 2], engines=["ideal", "sos"], repeat=1)
+    assert len(results) == 4
+    assert [r["engine"] for r in results] == ["ideal", "sos"] * 2
+    for r in results:
+        assert r["seconds"] > 0
+        assert r["peak_bytes"] > 0
+
+
+def test_benchmark_filter_batch():
+    from ECG_benchmark import benchmark_filter_batch
+    results = benchmark_filter_batch([1], count=5, repeat=1)
+    assert [r["engine"] for r in results] == ["full_spectrum", "planned"]
+    for r in results:
+        assert r["stage"] == "filter_batch"
+        assert r["count"] == 5
+        assert r["samples"] == 5 * 250
+
+
+def test_synthetic_ecg_missing():
+    from ECG_benchmark import synthetic_ecg
+    time, voltage, beats = synthetic_ecg(60, 250, missing=0.1)
+    assert 0.08 < np.isnan(voltage).mean() < 0.12
+    assert not np.isnan(time).any()
+
+
+def test_benchmark_pipeline(tmp_path):
+    from ECG_benchmark import benchmark_pipeline
+    results = benchmark_pipeline([5, 10], missing=0.01, repeat=1,
+                                 work_dir=str(tmp_path))
+    stages = ["take_in_data", "clean_missing", "fourier_transform",
+              "ideal_filter", "find_R_wave", "fetch_metrics", "output_file"]
+    assert [r["stage"] for r in results] == stages * 2
+    assert [r["duration"] for r in results] == [5] * 7 + [10] * 7
+    for r in results:
+        assert r["seconds"] >= 0
+        assert r["peak_bytes"] > 0
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("detected, expected", [
+    ([1.0, 2.0, 3.0], (1.0, 1.0)),
+    ([1.01, 2.2, 3.0, 4.0], (2 / 3, 0.5)),
+    ([], (0.0, 0.0)),
+])
+def test_score_beats(detected, expected):
+    from ECG_benchmark import score_beats
+    assert score_beats(detected, [1.0, 2.0, 3.0]) == pytest.approx(expected)
+
+
+def test_benchmark_detectors():
+    from ECG_benchmark import benchmark_detectors
+    results = benchmark_detectors([60], repeat=1)
+    assert len(results) == 6
+    by_engine = {(r["engine"], r["drift"]): r for r in results}
+    for engine in ("pan_tompkins", "adaptive"):
+        assert by_engine[(engine, 0.6)]["sensitivity"] == 1.0
+    assert by_engine[("legacy", 0.0)]["sensitivity"] == 1.0
+    assert by_engine[("legacy", 0.6)]["sensitivity"] < 1.0
+
+
+def test_benchmark_decimation(tmp_path):
+    from ECG_benchmark import benchmark_decimation
+    results = benchmark_decimation([20], 1000, ["adaptive"], repeat=1,
+                                   work_dir=str(tmp_path))
+    assert [r["decimate"] for r in results] == [None, "auto"]
+    for r in results:
+        assert r["sensitivity"] == 1.0
+        assert r["max_error"] <= 0.002
+
+
+def test_benchmark_output(tmp_path):
+    from ECG_benchmark import benchmark_output
+    results = benchmark_output([3600], repeat=1, work_dir=str(tmp_path))
+    assert [(r["stage"], r["engine"]) for r in results] == [
+        ("output_write", "json"), ("output_load", "json"),
+        ("output_write", "binary"), ("output_load", "binary")]
+    assert results[2]["file_bytes"] < results[0]["file_bytes"]
+    assert results[0]["samples"] == 4500
+
+
+def test_benchmark_memory(tmp_path):
+    from ECG_benchmark import benchmark_memory
+    results = benchmark_memory([60], repeat=1, work_dir=str(tmp_path))
+    assert [(r["stage"], r["engine"]) for r in results] == [
+        ("take_in_data", "float64"), ("analyze_strip", "float64"),
+        ("take_in_data", "float32"), ("analyze_strip", "float32")]
+    assert results[0]["signal_bytes"] == 2 * 8 * 15000
+    assert results[2]["signal_bytes"] == 2 * 4 * 15000
+    for r in results:
+        assert r["peak_ratio"] == r["peak_bytes"] / r["signal_bytes"]
+    assert results[0]["peak_ratio"] < 4
+    assert "rss_growth_bytes" in results[1]
+    assert "rss_growth_bytes" not in results[0]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_benchmark_csv(tmp_path):
+    from ECG_benchmark import benchmark_csv
+    results = benchmark_csv([0.1], repeat=1, work_dir=str(tmp_path))
+    assert [r["engine"] for r in results] == ["fast", "pandas"]
+    for r in results:
+        assert r["stage"] == "take_in_data"
+        assert 0.05 * 2 ** 20 < r["input_bytes"] < 0.2 * 2 ** 20
+        assert r["seconds"] > 0
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("seconds, expected", [
+    ([1.0, 2.0], []),
+    ([1.05, 2.0], []),
+    ([1.5, 1.0], [("ideal_filter", 1.5)]),
+    ([1.5, 3.0], [("ideal_filter", 1.5), ("find_R_wave", 1.5)]),
+])
+def test_compare_results(seconds, expected):
+    from ECG_benchmark import compare_results
+    baseline = [{"stage": "ideal_filter", "engine": None, "duration": 10,
+                 "fs": 250, "seconds": 1.0},
+                {"stage": "find_R_wave", "engine": None, "duration": 10,
+                 "fs": 250, "seconds": 2.0}]
+    current = [dict(r, seconds=s) for r, s in zip(baseline, seconds)]
+    current.append({"stage": "new", "engine": None, "duration": 10,
+                    "fs": 250, "seconds": 9.0})
+    answer = compare_results(baseline, current, 0.1)
+    assert [(r["stage"], r["ratio"]) for r in answer] == expected
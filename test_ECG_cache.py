@@ -0,0 +1,150 @@
+import os
+import pytest
+import numpy as np
+from numpy import nan
+
+
+def test_load_cached_data(tmp_path, write_csv, monkeypatch, caplog):
+    import ECG_cache
+    from ECG_cache import load_cached_data
+    path = write_csv(tmp_path / "a.csv", [0, 1, nan, 3], [5, 6, 7, 8])
+    cache_dir = str(tmp_path / "cache")
+    time, voltage = load_cached_data(path, cache_dir)
+    assert np.array_equal(time, [0, 1, 3])
+    assert np.array_equal(voltage, [5, 6, 8])
+
+    def fail(*args):
+        raise AssertionError("the file was parsed again")
+    monkeypatch.setattr(ECG_cache, "take_in_data", fail)
+    caplog.clear()
+    time, voltage = load_cached_data(path, cache_dir)
+    assert isinstance(time, np.memmap)
+    assert np.array_equal(voltage, [5, 6, 8])
+    assert "There is missing data in time list" in caplog.text
+    time, voltage, missing = load_cached_data(path, cache_dir, report=True)
+    assert missing == {"missing": 1, "time_missing": 1, "voltage_missing": 0}
+    with pytest.raises(AssertionError):
+        load_cached_data(path, cache_dir, rebuild=True)
+
+
+def test_cache_key(tmp_path, write_csv):
+    from ECG_cache import cache_key
+    path = write_csv(tmp_path / "a.csv", [0, 1], [5, 6])
+    key = cache_key(path)
+    assert cache_key(path) == key
+    assert cache_key(path, np.float32) != key
+    write_csv(tmp_path / "a.csv", [0, 1, 2], [5, 6, 7])
+    assert cache_key(path) != key
+
+
+def test_evict_cache(tmp_path, write_csv):
+    from ECG_cache import load_cached_data, cache_key
+    cache_dir = str(tmp_path / "cache")
+    paths = []
+    for i in range(4):
+        paths.append(write_csv(tmp_path / "{}.csv".format(i),
+                               range(100), range(100)))
+        load_cached_data(paths[-1], cache_dir)
+        stamp = 1000000000 + i
+        for suffix in (".npy", ".json"):
+            os.utime(os.path.join(cache_dir, cache_key(paths[-1]) + suffix),
+                     (stamp, stamp))
+    entry = sum(os.path.getsize(os.path.join(cache_dir, name))
+                for name in os.listdir(cache_dir)) // 4
+    load_cached_data(paths[0], cache_dir)
+    load_cached_data(paths[1], cache_dir, max_bytes=2 * entry, rebuild=True)
+    names = os.listdir(cache_dir)
+    assert len(names) == 4
+    assert cache_key(paths[0]) + ".npy" in names
+    assert cache_key(paths[1]) + ".npy" in names
+
+
+def test_analyze_strip_cached(tmp_path, write_strip):
+    from ECG_processor import analyze_strip
+    path = write_strip(tmp_path / "strip.csv")
+    expected = analyze_strip(path)
+    for i in range(2):
+        answer = analyze_strip(path, cache_dir=str(tmp_path / "cache"))
+        assert answer["num_beats"] == expected["num_beats"]
+        assert np.array_equal(answer["beats"], expected["beats"])
+
+
+def test_result_key(tmp_path, write_strip):
+    from ECG_cache import result_key
+    a = write_strip(tmp_path / "a.csv")
+    b = write_strip(tmp_path / "b.csv")
+    c = write_strip(tmp_path / "c.csv",
+                    beat_times=np.arange(0.4, 10, 0.9))
+    assert result_key(a) == result_key(b)
+    assert result_key(a) != result_key(c)
+    assert result_key(a) != result_key(a, filter_engine="sos")
+    assert result_key(a) != result_key(a, np.float32)
+
+
+def test_analyze_strip_result_cache(tmp_path, write_strip, monkeypatch):
+    import ECG_processor
+    from ECG_processor import analyze_strip
+    result_dir = str(tmp_path / "results")
+    path = write_strip(tmp_path / "strip.csv")
+    expected = analyze_strip(path, result_dir=result_dir)
+    assert len(os.listdir(result_dir)) == 1
+
+    def fail(*args):
+        raise AssertionError("recomputed")
+    monkeypatch.setattr(ECG_processor, "take_in_data", fail)
+    metrics = []
+    answer = analyze_strip(path, result_dir=result_dir, metrics=metrics)
+    assert [m["stage"] for m in metrics] == ["load_result"]
+    assert answer["num_beats"] == expected["num_beats"]
+    assert answer["voltage_extremes"] == expected["voltage_extremes"]
+    assert np.array_equal(answer["beats"], expected["beats"])
+    with pytest.raises(AssertionError):
+        analyze_strip(path, result_dir=result_dir, rebuild_cache=True)
+    monkeypatch.setattr(ECG_processor, "PEAK_HEIGHT", 0.6)
+    with pytest.raises(AssertionError):
+        analyze_strip(path, result_dir=result_dir)
+
+
+def test_result_cache_eviction(tmp_path, write_strip):
+    from ECG_processor import analyze_strip
+    from ECG_cache import result_key, RESULT_SUFFIX
+    result_dir = tmp_path / "results"
+    paths = [write_strip(tmp_path / "s{}.csv".format(i),
+                         beat_times=np.arange(0.4 + 0.1 * i, 10, 0.8))
+             for i in range(3)]
+    for path in paths:
+        analyze_strip(path, result_dir=str(result_dir), result_bytes=1)
+    assert os.listdir(str(result_dir)) == [result_key(paths[2]) +
+                                           RESULT_SUFFIX]
+
+
+def test_plan_results(tmp_path, write_strip):
+    from ECG_processor import analyze_strip
+    from ECG_cache import plan_results
+    result_dir = str(tmp_path / "results")
+    paths = [write_strip(tmp_path / "s{}.csv".format(i),
+                         beat_times=np.arange(0.4 + 0.1 * i, 10, 0.8))
+             for i in range(3)]
+    analyze_strip(paths[1], result_dir=result_dir)
+    report = plan_results(paths + [str(tmp_path / "missing.csv")],
+                          result_dir)
+    assert (report["total"], report["cached"], report["recompute"]) == \
+        (4, 1, 3)
+    assert [f["cached"] for f in report["files"]] == [False, True, False,
+                                                      False]
+    assert report["files"][3]["error"].startswith("FileNotFoundError")
+    assert report["config"]["peak_height"] == 0.7
+
+
+def test_main_dry_run(tmp_path, write_strip, capsys):
+    from ECG_processor import main
+    path = write_strip(tmp_path / "strip.csv")
+    result_dir = str(tmp_path / "results")
+    argv = [path, "--result-cache", result_dir, "--dry-run"]
+    assert main(argv) == 0
+    assert capsys.readouterr().out.startswith("recompute " + path)
+    assert main([path, "--result-cache", result_dir, "-q",
+                 "-o", str(tmp_path / "out")]) == 0
+    capsys.readouterr()
+    assert main(argv) == 0
+    assert capsys.readouterr().out.startswith("cached    " + path)
@@ -0,0 +1,131 @@
+import json
+import sqlite3
+import pytest
+import numpy as np
+
+
+def result(num_beats):
+    return {"duration": 10.0, "voltage_extremes": (-0.5, 1.5),
+            "num_beats": np.int64(num_beats), "mean_hr_bpm": 72,
+            "beats": np.arange(num_beats) * 0.8}
+
+
+@pytest.mark.parametrize("mode", ["json", "jsonl", "sqlite", "binary"])
+def test_writers(tmp_path, mode):
+    from ECG_output import open_writer, read_results
+    with open_writer(mode, str(tmp_path), batch_size=3) as writer:
+        for i in range(10):
+            writer.write("s{}.csv".format(i), result(i))
+        writer.write("s1.csv", result(12))
+    assert writer.written == 11
+    results = read_results(mode, str(tmp_path))
+    assert sorted(results) == ["s{}.csv".format(i) for i in range(10)]
+    assert results["s1.csv"]["num_beats"] == 12
+    assert results["s3.csv"]["beats"] == pytest.approx([0, 0.8, 1.6])
+    assert results["s3.csv"]["voltage_extremes"] == [-0.5, 1.5]
+
+
+def test_jsonl_appends(tmp_path):
+    from ECG_output import open_writer, read_results
+    with open_writer("jsonl", str(tmp_path)) as writer:
+        writer.write("a.csv", result(1))
+    with open_writer("jsonl", str(tmp_path)) as writer:
+        writer.write("b.csv", result(2))
+    lines = (tmp_path / "results.jsonl").read_text().splitlines()
+    assert [json.loads(line)["name"] for line in lines] == ["a.csv", "b.csv"]
+    assert sorted(read_results("jsonl", str(tmp_path))) == ["a.csv", "b.csv"]
+
+
+def test_sqlite_columns(tmp_path):
+    from ECG_output import open_writer
+    with open_writer("sqlite", str(tmp_path)) as writer:
+        writer.write("a.csv", result(3))
+        writer.write("leads.csv", {"duration": 5.0, "leads": {}})
+    connection = sqlite3.connect(str(tmp_path / "results.sqlite"))
+    rows = connection.execute("SELECT name, duration, num_beats, "
+                              "voltage_min, voltage_max FROM results "
+                              "ORDER BY name").fetchall()
+    connection.close()
+    assert rows == [("a.csv", 10.0, 3, -0.5, 1.5),
+                    ("leads.csv", 5.0, None, None, None)]
+
+
+def test_binary_round_trip(tmp_path):
+    from ECG_output import write_binary, read_binary
+    path = str(tmp_path / "a.ecgb")
+    leads = {"I": result(4), "II": {"duration": 10.0, "beats": []}}
+    write_binary(path, {"duration": 10.0, "leads": leads,
+                        "consensus_beats": [0.0, 0.8]})
+    answer = read_binary(path)
+    assert list(answer) == ["duration", "leads", "consensus_beats"]
+    lead = answer["leads"]["I"]
+    assert list(lead) == ["duration", "voltage_extremes", "num_beats",
+                          "mean_hr_bpm", "beats", "rr_ms"]
+    assert isinstance(lead["beats"].base, np.memmap)
+    assert not lead["beats"].flags.writeable
+    assert lead["beats"].dtype == np.dtype("<f8")
+    assert np.array_equal(lead["beats"], np.arange(4) * 0.8)
+    assert lead["rr_ms"].dtype == np.dtype("<f4")
+    assert np.allclose(lead["rr_ms"], 800)
+    assert len(answer["leads"]["II"]["beats"]) == 0
+    assert np.array_equal(answer["consensus_beats"], [0.0, 0.8])
+    write_binary(path, {"duration": 10.0, "num_beats": None})
+    assert read_binary(path) == {"duration": 10.0, "num_beats": None}
+    (tmp_path / "b.ecgb").write_bytes(b"{}" * 16)
+    with pytest.raises(ValueError):
+        read_binary(str(tmp_path / "b.ecgb"))
+
+
+def test_writer_error(tmp_path):
+    from ECG_output import open_writer
+    writer = open_writer("json", str(tmp_path / "missing"))
+    writer.write("a.csv", result(1))
+    with pytest.raises(FileNotFoundError):
+        writer.close()
+
+
+def test_writer_keeps_first_error(tmp_path, monkeypatch):
+    from ECG_output import ResultWriter, JsonWriter
+    from ECG_processor import batch_process
+    from ECG_benchmark import write_synthetic_csv
+    with pytest.raises(TypeError):
+        ResultWriter(str(tmp_path))
+
+    def broken(self, batch):
+        raise OSError("disk full")
+
+    def stop(done, total, record):
+        raise RuntimeError("stop")
+    monkeypatch.setattr(JsonWriter, "_write_batch", broken)
+    path = str(tmp_path / "s.csv")
+    write_synthetic_csv(path, 10)
+    with pytest.raises(RuntimeError):
+        batch_process([path], workers=1, out_dir=str(tmp_path),
+                      progress=stop)
+    with pytest.raises(OSError):
+        batch_process([path], workers=1, out_dir=str(tmp_path))
+
+
+@pytest.mark.parametrize("mode, workers", [
+    ("jsonl", 1),
+    ("sqlite", 2),
+    ("binary", 2),
+])
+def test_batch_output_mode(tmp_path, mode, workers):
+    from ECG_processor import batch_process
+    from ECG_output import read_results
+    from ECG_benchmark import write_synthetic_csv
+    paths = [str(tmp_path / "s{}.csv".format(i)) for i in range(3)]
+    for path in paths:
+        beats = write_synthetic_csv(path, 10)
+    bad = tmp_path / "bad.csv"
+    bad.write_text("time,voltage\n0,1\n")
+    out_dir = tmp_path / "out"
+    summary = batch_process(paths + [str(bad)], workers=workers,
+                            out_dir=str(out_dir), output_mode=mode)
+    assert summary["failed"] == 1
+    assert "result" not in summary["records"][0]
+    results = read_results(mode, str(out_dir))
+    assert sorted(results) == ["s0.csv", "s1.csv", "s2.csv"]
+    assert results["s0.csv"]["num_beats"] == len(beats)
+    assert not (out_dir / "s0.csv.json").exists()
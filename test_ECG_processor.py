@@ -69,6 +69,47 @@ def test_if_missing_vol(a, b, expected1, expected2):
     assert answer2 == expected2
 
 
+@pytest.mark.parametrize("a, b, expected1, expected2, expected3", [
+    ([1, 2, nan, 4, 5], [0.1, 0.2, 0.3, 0.4, 0.5],
+     [1, 2, 4, 5], [0.1, 0.2, 0.4, 0.5], [2]),
+    ([nan, 3.3, 4.4, nan], [1.1, 1.2, nan, 1.4],
+     [3.3], [1.2], [0, 2, 3]),
+    ([2.2, 3.3, 4.4, 5.5], [1.1, 1.2, 1.3, 1.4],
+     [2.2, 3.3, 4.4, 5.5], [1.1, 1.2, 1.3, 1.4], []),
+])
+def test_clean_missing(a, b, expected1, expected2, expected3):
+    from ECG_processor import clean_missing
+    answer1, answer2, report = clean_missing(a, b)
+    assert np.array_equal(answer1, expected1)
+    assert np.array_equal(answer2, expected2)
+    assert report["removed"] == len(expected3)
+    assert list(report["indices"]) == expected3
+
+
+@pytest.mark.parametrize("a, b, expected1, expected2, expected3", [
+    ([1, 2, nan, 4, 5], [0.1, 0.2, 0.3, nan, 0.5],
+     [1, 2, 3, 4, 5], [0.1, 0.2, 0.3, 0.4, 0.5], 2),
+    ([nan, 1, 2, 3], [0.0, 0.1, 0.2, 0.3],
+     [0, 1, 2, 3], [0.0, 0.1, 0.2, 0.3], 1),
+    ([nan, nan, 0.1, 0.2, 0.4, 0.5, nan], [1, 2, 3, 4, 5, 6, 7],
+     [-0.1, 0, 0.1, 0.2, 0.4, 0.5, 0.6], [1, 2, 3, 4, 5, 6, 7], 3),
+])
+def test_clean_missing_interpolate(a, b, expected1, expected2, expected3):
+    from ECG_processor import clean_missing
+    answer1, answer2, report = clean_missing(a, b, interpolate=True)
+    assert np.allclose(answer1, expected1)
+    assert np.allclose(answer2, expected2)
+    assert report["removed"] == 0
+    assert report["interpolated"] == expected3
+
+
+def test_clean_missing_logging(caplog):
+    from ECG_processor import clean_missing
+    clean_missing([1, nan, 3], [1, 2, nan])
+    assert "There is missing data in time list" in caplog.text
+    assert "There is missing data in voltage list" in caplog.text
+
+
 @pytest.mark.parametrize("a, b, expected1, expected2", [
     (np.linspace(0, 10, 10), np.sin(np.linspace(0, 10, 10)),
      array([-0.9, -0.7, -0.5, -0.3, -0.1, 0.1, 0.3, 0.5, 0.7, 0.9]),
@@ -150,8 +191,8 @@ def test_find_R_wave(a, expected1, expected2, expected3, expected4):
     answer1, answer2, answer3, answer4 = find_R_wave(a)
     assert (answer1 == expected1).any()
     assert (answer2 == expected2).any()
-    assert (answer3 == expected3)
-    assert (answer4 == expected4)
+    assert np.array_equal(answer3, expected3)
+    assert np.array_equal(answer4, expected4)
 
 
 @pytest.mark.parametrize(("a, b, c, d, e, f, r1, r2, r3, r4"), [
@@ -246,3 +287,893 @@ def test_produce_dict(a, b, c, d, e, expected):
     from ECG_processor import produce_dict
     answer = produce_dict(a, b, c, d, e)
     assert (answer == expected)
+
+
+def test_analyze_strip(tmp_path, write_strip):
+    from ECG_processor import analyze_strip
+    path = write_strip(tmp_path / "strip.csv")
+    answer = analyze_strip(path)
+    assert answer["num_beats"] == 12
+    assert answer["mean_hr_bpm"] == 72
+    assert np.allclose(answer["beats"], np.arange(0.4, 10, 0.8))
+
+
+def test_collect_paths(tmp_path, write_strip):
+    from ECG_processor import collect_paths
+    a = write_strip(tmp_path / "a.csv")
+    b = write_strip(tmp_path / "b.csv")
+    (tmp_path / "notes.txt").write_text("not a strip")
+    manifest = tmp_path / "list.txt"
+    manifest.write_text("# archive\nb.csv\n\na.csv\n")
+    assert collect_paths(str(tmp_path)) == [a, b]
+    assert collect_paths(str(tmp_path / "*.csv")) == [a, b]
+    assert collect_paths(a) == [a]
+    assert collect_paths(str(manifest)) == [b, a]
+    (tmp_path / "sub").mkdir()
+    c = write_strip(tmp_path / "sub" / "a.csv")
+    assert collect_paths(str(tmp_path)) == [a, b]
+    assert collect_paths(str(tmp_path), recursive=True) == [a, b, c]
+
+
+def test_output_name(tmp_path):
+    from ECG_processor import output_name
+    path = str(tmp_path / "ward" / "a.csv")
+    assert output_name(path) == "a.csv"
+    assert output_name(path, str(tmp_path)) == "ward%2Fa.csv"
+    assert output_name(str(tmp_path / "ward%2Fa.csv"),
+                       str(tmp_path)) == "ward%252Fa.csv"
+
+
+def test_process_file_isolates_errors(tmp_path):
+    from ECG_processor import process_file
+    bad = tmp_path / "bad.csv"
+    bad.write_text("time,voltage\n0,1\n")
+    record = process_file(str(bad), str(tmp_path))
+    assert record["status"] == "error"
+    assert (tmp_path / "bad.csv.log").exists()
+    assert not (tmp_path / "bad.csv.json").exists()
+
+
+@pytest.mark.parametrize("workers, ordered", [
+    (1, True),
+    (2, True),
+    (2, False),
+])
+def test_batch_process(tmp_path, write_strip, workers, ordered):
+    import json
+    from ECG_processor import batch_process
+    paths = [write_strip(tmp_path / "s{}.csv".format(i)) for i in range(4)]
+    bad = tmp_path / "bad.csv"
+    bad.write_text("time,voltage\n0,1\n")
+    paths.insert(2, str(bad))
+    out_dir = tmp_path / "out"
+    seen = []
+    summary = batch_process(paths, workers=workers, ordered=ordered,
+                            out_dir=str(out_dir),
+                            progress=lambda d, t, r: seen.append(d))
+    assert summary["total"] == 5
+    assert summary["succeeded"] == 4
+    assert summary["failed"] == 1
+    assert summary["failures"][0]["path"] == str(bad)
+    assert seen == [1, 2, 3, 4, 5]
+    if ordered:
+        assert [r["path"] for r in summary["records"]] == paths
+    with open(str(out_dir / "s0.csv.json")) as in_file:
+        assert json.load(in_file)["num_beats"] == 12
+
+
+def test_job_logging(tmp_path, caplog):
+    import threading
+    from ECG_processor import job_logging, _logger
+
+    def job(i):
+        with job_logging(str(tmp_path / "job{}.log".format(i))):
+            for _ in range(50):
+                _logger().info("message of job %d", i)
+    threads = [threading.Thread(target=job, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i in range(4):
+        lines = (tmp_path / "job{}.log".format(i)).read_text().splitlines()
+        assert lines == ["INFO:ECG:message of job {}".format(i)] * 50
+    assert "message of job" not in caplog.text
+
+
+def test_pipeline(tmp_path, write_strip):
+    from ECG_processor import ECGPipeline, analyze_strip
+    paths = [write_strip(tmp_path / "s{}.csv".format(i), 10 + i)
+             for i in range(4)]
+    bad = tmp_path / "bad.csv"
+    bad.write_text("time,voltage\n0,1\n")
+    paths.insert(1, str(bad))
+    log_dir = tmp_path / "logs"
+    with ECGPipeline(workers=3, log_dir=str(log_dir),
+                     detector="adaptive") as pipeline:
+        pipeline.warm_up()
+        records = pipeline.run_many(paths)
+        unordered = pipeline.run_many(paths, ordered=False)
+    assert [r["path"] for r in records] == paths
+    assert sorted(r["path"] for r in unordered) == sorted(paths)
+    assert [r["status"] for r in records].count("error") == 1
+    assert records[1]["error"]
+    for i, path in enumerate(paths[:1] + paths[2:]):
+        expected = analyze_strip(path, detector="adaptive")
+        record = [r for r in records if r["path"] == path][0]
+        assert record["result"]["num_beats"] == expected["num_beats"]
+        assert np.array_equal(record["result"]["beats"], expected["beats"])
+        log = (log_dir / "s{}.csv.log".format(i)).read_text()
+        assert log.count("Start a new ECG trace") == 1
+        assert "ERROR" not in log
+    assert "ERROR" in (log_dir / "bad.csv.log").read_text()
+
+
+def test_pipeline_same_names(tmp_path, write_strip):
+    from ECG_processor import ECGPipeline
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    paths = [write_strip(tmp_path / "a" / "strip.csv"),
+             write_strip(tmp_path / "b" / "strip.csv", 12)]
+    log_dir = tmp_path / "logs"
+    with ECGPipeline(workers=2, log_dir=str(log_dir)) as pipeline:
+        records = pipeline.run_many(paths)
+    assert [r["name"] for r in records] == ["a%2Fstrip.csv", "b%2Fstrip.csv"]
+    assert sorted(p.name for p in log_dir.iterdir()) == [
+        "a%2Fstrip.csv.log", "b%2Fstrip.csv.log"]
+    for record in records:
+        log = (log_dir / (record["name"] + ".log")).read_text()
+        assert log.count("Start a new ECG trace") == 1
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_take_in_data(tmp_path, dtype):
+    from ECG_processor import take_in_data
+    path = tmp_path / "strip.csv"
+    path.write_text("time,voltage\n0,0.5\n0.1,abc\n0.2,-0.25\n")
+    time, voltage = take_in_data(str(path), dtype)
+    for answer in (time, voltage):
+        assert isinstance(answer, np.ndarray)
+        assert answer.dtype == dtype
+        assert answer.flags["C_CONTIGUOUS"]
+    assert np.allclose(time, [0, 0.1, 0.2])
+    assert np.isnan(voltage[1])
+
+
+@pytest.mark.parametrize("text", [
+    "time,voltage\n0,0.5\n0.1,\n0.2,-0.25\n",
+    "time,voltage\n0,0.5\n0.1,nan\n0.2,-2.5e-1\n",
+    "time,voltage\n0,0.5\n0.1,abc\n0.2,-0.25\n",
+    "time,voltage\n0,0.5\n0.1,--\n0.2,-0.25\n",
+])
+def test_take_in_data_fast(tmp_path, text):
+    from ECG_processor import take_in_data
+    path = tmp_path / "strip.csv"
+    path.write_text(text)
+    fast = take_in_data(str(path))
+    slow = take_in_data(str(path), fast=False)
+    for answer, expected in zip(fast, slow):
+        np.testing.assert_array_equal(answer, expected)
+    assert np.allclose(fast[1], [0.5, np.nan, -0.25], equal_nan=True)
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_read_numeric_csv_dtype(tmp_path, fast):
+    from ECG_processor import _read_numeric_csv
+    path = tmp_path / "strip.csv"
+    path.write_text("time,voltage\n0,0.5\n0.1,0.1\n0.2,-0.25\n")
+    ECG = _read_numeric_csv(str(path), fast, np.float32)
+    assert list(ECG.dtypes) == [np.float32, np.float32]
+
+
+def test_analyze_strip_float32(tmp_path, write_strip):
+    from ECG_processor import analyze_strip
+    path = write_strip(tmp_path / "strip.csv")
+    answer = analyze_strip(path, np.float32)
+    assert answer["num_beats"] == 12
+    assert np.allclose(answer["beats"], np.arange(0.4, 10, 0.8), atol=1e-5)
+
+
+def test_output_file(tmp_path):
+    import json
+    from ECG_processor import output_file
+    output_file({"beats": np.array([0.5, 1.5]), "num_beats": np.int64(2)},
+                str(tmp_path / "strip.csv"))
+    with open(str(tmp_path / "strip.csv.json")) as in_file:
+        answer = json.load(in_file)
+    assert answer == {"beats": [0.5, 1.5], "num_beats": 2}
+
+
+@pytest.mark.parametrize("a, expected", [
+    (array([1, 2, 1, 3, 1, 2, 1, 2, 1, 3, 1, 2, 1, 3, 1, 2, 1, 3, 1, 2, 1, 3,
+            1]),
+     array([3, 9, 13, 17, 17])),
+    (array([1, 2, 1, 3, 1, 2, 1, 2, 1, 4, 1, 2, 1, 3, 1, 2, 1, 5, 1]),
+     array([3, 9, 13, 17])),
+])
+def test_find_R_wave_index(a, expected):
+    from ECG_processor import find_R_wave
+    answer = find_R_wave(a, return_index=True)
+    assert len(answer) == 5
+    assert np.array_equal(answer[4], expected)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_local_maxima(dtype):
+    from scipy.signal import find_peaks
+    from ECG_processor import _local_maxima
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        size = rng.integers(0, 40)
+        a = rng.integers(0, 4, size).astype(dtype)
+        a[rng.random(size) < 0.05] = np.nan
+        assert np.array_equal(_local_maxima(a), find_peaks(a)[0])
+        a = rng.normal(size=size).astype(dtype)
+        assert np.array_equal(_local_maxima(a), find_peaks(a)[0])
+
+
+@pytest.mark.parametrize("engine", ["pan_tompkins", "adaptive"])
+def test_find_R_wave_engines(engine):
+    from ECG_processor import find_R_wave, fetch_metrics
+    fs = 250
+    time = np.arange(0, 60, 1 / fs)
+    beat_times = 0.5 + 0.8 * np.arange(74)
+    height = 1 + 0.6 * np.sin(2 * np.pi * beat_times / 30)
+    signal = np.zeros_like(time)
+    for bt, h in zip(beat_times, height):
+        signal += h * np.exp(-((time - bt) / 0.01) ** 2)
+    waves = np.exp(-((time[:, None] - beat_times - 0.3) / 0.05) ** 2)
+    signal -= 0.3 * waves.sum(axis=1)
+    answer = find_R_wave(signal, True, engine, fs)
+    assert len(answer) == 5
+    assert len(answer[3]) == 0
+    assert np.allclose(time[answer[4]], beat_times, atol=1 / fs)
+    metrics = fetch_metrics(*answer[:4], time, signal, answer[4])
+    assert metrics[1] == 74
+    assert np.allclose(metrics[3], beat_times, atol=1 / fs)
+
+
+@pytest.mark.parametrize("engine", ["pan_tompkins", "adaptive"])
+@pytest.mark.parametrize("seed", [0, 1])
+def test_find_R_wave_noisy(engine, seed):
+    from ECG_processor import find_R_wave, band_pass_filter
+    from ECG_benchmark import synthetic_ecg, score_beats
+    time, voltage, beats = synthetic_ecg(120, noise=0.2, seed=seed)
+    recovered_time = np.real(band_pass_filter(time, voltage))
+    beat_index = find_R_wave(recovered_time, True, engine, 250)[4]
+    sensitivity, ppv = score_beats(time[beat_index], beats)
+    assert sensitivity > 0.98
+    assert ppv > 0.97
+
+
+def test_find_R_wave_engine_errors():
+    from ECG_processor import find_R_wave
+    with pytest.raises(ValueError):
+        find_R_wave(np.zeros(100), engine="adaptive")
+    with pytest.raises(ValueError):
+        find_R_wave(np.zeros(100), engine="unknown", fs=250)
+
+
+@pytest.mark.parametrize("detector", ["pan_tompkins", "adaptive"])
+def test_analyze_detector(tmp_path, write_strip, detector):
+    from ECG_processor import analyze_strip, analyze_stream, analyze_leads
+    beat_times = 0.3 + 0.752 * np.arange(79)
+    path = write_strip(tmp_path / "strip.csv", duration=60,
+                       beat_times=beat_times)
+    for answer in (analyze_strip(path, detector=detector),
+                   analyze_stream(path, 4000, 500, detector=detector)):
+        assert answer["num_beats"] == 79
+        assert np.allclose(answer["beats"], beat_times, atol=0.01)
+    path, t, leads = write_leads(tmp_path / "leads.csv")
+    answer = analyze_leads(path, detector=detector)
+    for lead in answer["leads"].values():
+        assert np.allclose(lead["beats"], np.arange(0.4, 10, 0.8))
+
+
+@pytest.mark.parametrize("window, step", [
+    (30, None),
+    (30, 10),
+    (45.5, 7),
+    (500, None),
+])
+def test_windowed_metrics(window, step):
+    from ECG_processor import windowed_metrics
+    rng = np.random.default_rng(1)
+    beats = np.cumsum(rng.normal(0.8, 0.06, 200))
+    answer = windowed_metrics(beats, window, step, end=beats[-1] + 0.5)
+    step = window if step is None else step
+    assert answer["window"] == window and answer["step"] == step
+    for i, hr in enumerate(answer["hr_bpm"]):
+        start = answer["start"] + i * step
+        assert start + window <= max(beats[-1] + 0.5, window) + 1e-9
+        inside = (beats >= start) & (beats < start + window)
+        rr = np.diff(beats)[inside[1:]]
+        sd = np.diff(np.diff(beats))[inside[2:]]
+        assert answer["num_beats"][i] == inside.sum()
+        assert hr == pytest.approx(60 / rr.mean(), abs=0.05)
+        assert answer["sdnn_ms"][i] == pytest.approx(
+            1000 * rr.std(ddof=1), abs=0.05)
+        assert answer["rmssd_ms"][i] == pytest.approx(
+            1000 * np.sqrt(np.mean(sd ** 2)), abs=0.05)
+        assert answer["pnn50"][i] == pytest.approx(
+            100 * np.mean(np.abs(sd) > 0.05), abs=0.05)
+
+
+def test_windowed_metrics_sparse():
+    from ECG_processor import windowed_metrics
+    answer = windowed_metrics([1.0, 2.0, 70.0, 71.0, 72.5], 60, end=120,
+                              rr_series=True)
+    assert answer["num_beats"] == [2, 3]
+    assert answer["hr_bpm"] == [60.0, 2.6]
+    assert answer["sdnn_ms"] == [None, pytest.approx(38538.9, abs=0.1)]
+    assert answer["pnn50"] == [None, 100.0]
+    assert answer["rr_ms"] == [1000, 68000, 1000, 1500]
+    assert windowed_metrics([], 60)["hr_bpm"] == [None]
+    with pytest.raises(ValueError):
+        windowed_metrics([1.0], 0)
+
+
+def test_analyze_strip_hrv(tmp_path, write_strip):
+    import json
+    from ECG_processor import analyze_strip, analyze_stream
+    path = write_strip(tmp_path / "strip.csv", duration=60,
+                       beat_times=0.3 + 0.752 * np.arange(79))
+    for answer in (analyze_strip(path, hrv_window=20, hrv_step=10),
+                   analyze_stream(path, 4000, 500, hrv_window=20,
+                                  hrv_step=10)):
+        hrv = answer["hrv"]
+        assert len(hrv["hr_bpm"]) == 4
+        assert hrv["hr_bpm"] == [pytest.approx(79.8, abs=0.1)] * 4
+        assert hrv["rmssd_ms"] == [pytest.approx(0, abs=0.1)] * 4
+        json.dumps(hrv, allow_nan=False)
+        assert "rr_ms" not in hrv
+    assert "hrv" not in analyze_strip(path)
+    for answer in (analyze_strip(path, hrv_window=20, rr_series=True),
+                   analyze_stream(path, 4000, 500, hrv_window=20,
+                                  rr_series=True)):
+        assert answer["hrv"]["rr_ms"] == [752] * 78
+
+
+def test_analyze_leads_hrv(tmp_path):
+    import json
+    from ECG_processor import analyze_leads, main
+    path, _, _ = write_leads(tmp_path / "leads.csv")
+    answer = analyze_leads(path, hrv_window=4, rr_series=True)
+    for lead in answer["leads"].values():
+        assert lead["hrv"]["hr_bpm"] == [pytest.approx(75, abs=0.1)] * 2
+        assert lead["hrv"]["rr_ms"] == [800] * 11
+    assert main([path, "--leads", "--hrv-window", "4", "--hrv-rr", "-q",
+                 "-j", "1", "-o", str(tmp_path)]) == 0
+    with open(str(tmp_path / "leads.csv.json")) as in_file:
+        result = json.load(in_file)
+    assert result["leads"]["V2"]["hrv"]["rr_ms"] == [800] * 11
+    with pytest.raises(SystemExit):
+        main([path, "--hrv-rr"])
+
+
+def quality_strip(kind, duration=10, fs=250):
+    t = np.arange(0, duration, 1 / fs)
+    rng = np.random.default_rng(0)
+    v = 0.02 * rng.normal(size=t.size)
+    for bt in np.arange(0.4, duration, 0.8):
+        v += np.exp(-((t - bt) / 0.01) ** 2)
+    if kind == "flatline":
+        v[500:] = 0.25
+    elif kind == "clipping":
+        v = np.clip(v, -0.05, 0.2)
+    elif kind == "missing":
+        v[::3] = np.nan
+    elif kind == "out_of_range":
+        v[:100] += 400
+    elif kind == "low_snr":
+        v = rng.normal(size=t.size)
+    return t, v
+
+
+@pytest.mark.parametrize("kind, reasons", [
+    ("clean", []),
+    ("flatline", ["flatline"]),
+    ("clipping", ["clipping"]),
+    ("missing", ["missing"]),
+    ("out_of_range", ["out_of_range"]),
+    ("low_snr", ["low_snr"]),
+])
+def test_assess_quality(kind, reasons):
+    from ECG_processor import assess_quality
+    time, voltage = quality_strip(kind)
+    report = assess_quality(time, voltage)
+    assert report["reasons"] == reasons
+    assert report["ok"] == (not reasons)
+    assert report["missing"] == pytest.approx(
+        1 / 3 if kind == "missing" else 0, abs=1e-3)
+
+
+def test_assess_quality_limits():
+    from ECG_processor import assess_quality
+    time, voltage = quality_strip("clean")
+    assert assess_quality(time, voltage, {"snr_db": 100})["reasons"] == [
+        "low_snr"]
+    assert assess_quality(time[:250], voltage[:250])["reasons"] == [
+        "too_short"]
+    with pytest.raises(ValueError):
+        assess_quality(time, voltage, {"noise": 1})
+
+
+def test_analyze_strip_quality(tmp_path, write_strip):
+    import json
+    from ECG_processor import analyze_strip
+    good = write_strip(tmp_path / "good.csv")
+    time, voltage = quality_strip("flatline")
+    bad = str(tmp_path / "bad.csv")
+    np.savetxt(bad, np.c_[time, voltage], delimiter=',',
+               header='time,voltage', comments='')
+    answer = analyze_strip(good, quality="reject")
+    assert answer["quality"]["ok"]
+    assert answer["num_beats"] == 12
+    flagged = analyze_strip(bad, quality="flag")
+    assert flagged["quality"]["reasons"] == ["flatline"]
+    assert flagged["num_beats"] > 0
+    metrics = []
+    rejected = analyze_strip(bad, quality="reject", metrics=metrics)
+    assert rejected["quality"] == flagged["quality"]
+    assert rejected["num_beats"] is None
+    assert len(rejected["beats"]) == 0
+    assert rejected["duration"] == pytest.approx(time[-1])
+    assert [m["stage"] for m in metrics] == ["take_in_data",
+                                             "assess_quality"]
+    json.dumps(rejected, default=list)
+    assert "quality" not in analyze_strip(good)
+    with pytest.raises(ValueError):
+        analyze_strip(good, quality="skip")
+
+
+def test_analyze_strip_quality_cache(tmp_path, synthetic_strip, write_csv):
+    from ECG_processor import analyze_strip
+    time, voltage, _ = synthetic_strip(30)
+    voltage[::3] = np.nan
+    path = write_csv(tmp_path / "strip.csv", time, voltage)
+    expected = analyze_strip(path, quality="reject")
+    assert expected["quality"]["reasons"] == ["missing"]
+    assert expected["num_beats"] is None
+    for i in range(2):
+        answer = analyze_strip(path, quality="reject",
+                               cache_dir=str(tmp_path / "cache"))
+        assert answer["quality"] == expected["quality"]
+        assert answer["num_beats"] is None
+
+
+@pytest.mark.parametrize("argv", [
+    ["--quality", "flag", "--window", "4000"],
+    ["--quality", "reject", "--leads"],
+    ["--quality", "flag", "--quality-limit", "snr_db=abc"],
+    ["--quality-limit", "snr_db=6"],
+])
+def test_main_rejects_quality(tmp_path, write_strip, capsys, argv):
+    from ECG_processor import main
+    path = write_strip(tmp_path / "strip.csv")
+    with pytest.raises(SystemExit):
+        main([path, "-o", str(tmp_path)] + argv)
+    assert "--quality" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("option, variable", [
+    ("--result-cache", "ECG_RESULT_CACHE"),
+    ("--cache-dir", "ECG_CACHE_DIR"),
+])
+@pytest.mark.parametrize("argv", [["--window", "10000"], ["--leads"]])
+def test_main_rejects_cache(tmp_path, write_strip, capsys, monkeypatch,
+                            option, variable, argv):
+    import os
+    from ECG_processor import main
+    path = write_strip(tmp_path / "strip.csv")
+    cache = str(tmp_path / "cache")
+    with pytest.raises(SystemExit):
+        main([path, "-o", str(tmp_path), option, cache] + argv)
+    assert "--no-cache" in capsys.readouterr().err
+    monkeypatch.setenv(variable, cache)
+    with pytest.raises(SystemExit):
+        main([path, "-o", str(tmp_path)] + argv)
+    assert main([path, "-o", str(tmp_path), "-q", "-j", "1",
+                 "--no-cache"] + argv) == 0
+    assert not os.path.exists(cache)
+
+
+def test_process_file_strip_options(tmp_path, write_strip):
+    from ECG_processor import process_file
+    path = write_strip(tmp_path / "strip.csv")
+    with pytest.raises(ValueError):
+        process_file(path, str(tmp_path), window=4000, quality="flag")
+    with pytest.raises(ValueError):
+        process_file(path, str(tmp_path), leads=True, quality="reject")
+    with pytest.raises(ValueError):
+        process_file(path, str(tmp_path), window=4000,
+                     result_dir=str(tmp_path / "results"))
+    with pytest.raises(ValueError):
+        process_file(path, str(tmp_path), leads=True, decimate="auto")
+    with pytest.raises(ValueError):
+        process_file(path, str(tmp_path), window=4000,
+                     cache_dir=str(tmp_path / "cache"))
+
+
+def test_batch_process_strip_options(tmp_path, write_strip, monkeypatch):
+    import multiprocessing
+    from ECG_processor import batch_process
+    paths = [write_strip(tmp_path / "s{}.csv".format(i)) for i in range(2)]
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("the pool was started")
+    monkeypatch.setattr(multiprocessing, "Pool", no_pool)
+    with pytest.raises(ValueError):
+        batch_process(paths, workers=2, out_dir=str(tmp_path / "out"),
+                      window=4000, quality="flag")
+    assert not (tmp_path / "out").exists()
+
+
+@pytest.mark.parametrize("argv", [["--window", "10000"], ["--leads"]])
+def test_main_rejects_decimate(tmp_path, write_strip, capsys, argv):
+    from ECG_processor import main
+    path = write_strip(tmp_path / "strip.csv")
+    with pytest.raises(SystemExit):
+        main([path, "-o", str(tmp_path), "--decimate"] + argv)
+    assert "--decimate" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("fs, target, length, expected", [
+    (250, "auto", None, 1),
+    (1000, "auto", None, 5),
+    (2000, "auto", None, 11),
+    (2000, "auto", 600000, 10),
+    (2000, 500, None, 4),
+])
+def test_decimation_factor(fs, target, length, expected):
+    from ECG_processor import decimation_factor
+    assert decimation_factor(fs, target, length=length) == expected
+
+
+def test_decimate_signal():
+    from ECG_processor import decimate_signal
+    time = np.arange(0, 10, 1 / 1000)
+    voltage = np.sin(2 * np.pi * 10 * time) + np.sin(2 * np.pi * 450 * time)
+    new_time, new_voltage, factor = decimate_signal(time, voltage)
+    assert factor == 5
+    assert np.array_equal(new_time, time[::5])
+    assert new_voltage.shape == new_time.shape
+    middle = slice(100, -100)
+    expected = np.sin(2 * np.pi * 10 * new_time)
+    assert np.abs(new_voltage - expected)[middle].max() < 0.01
+    leads = decimate_signal(time, np.stack([voltage, -voltage]))[1]
+    assert np.allclose(leads, [new_voltage, -new_voltage])
+    assert decimate_signal(time[::5], voltage[::5])[2] == 1
+    with pytest.raises(ValueError):
+        decimate_signal(time, voltage, 60)
+
+
+def test_refine_peaks():
+    from ECG_processor import refine_peaks
+    time = np.arange(0, 2, 1 / 1000)
+    peaks = np.array([0.3013, 0.9987, 1.5])
+    signal = sum(np.exp(-((time - peak) / 0.02) ** 2) for peak in peaks)
+    coarse = np.round(peaks * 200).astype(int)
+    refined = refine_peaks(signal[::5], coarse, 5)
+    assert np.abs(time[refined] - peaks).max() <= 0.001
+
+
+def test_analyze_strip_decimate(tmp_path, write_strip):
+    from ECG_processor import analyze_strip
+    beat_times = np.arange(0.4011, 30, 0.8)
+    path = write_strip(tmp_path / "strip.csv", 30, 1000, beat_times)
+    metrics = []
+    answer = analyze_strip(path, decimate="auto", metrics=metrics)
+    expected = analyze_strip(path)
+    assert answer["num_beats"] == expected["num_beats"] == len(beat_times)
+    assert answer["duration"] == expected["duration"]
+    assert np.abs(answer["beats"] - beat_times).max() <= 0.001
+    stages = {m["stage"]: m["input_size"] for m in metrics}
+    assert stages["band_pass_filter"] == 6000
+    assert "refine_peaks" in stages
+
+
+def test_fetch_metrics_index():
+    from ECG_processor import fetch_metrics
+    time = np.linspace(0, 10, 11)
+    recovered_time = array([0, 5, 0, 5, 0, 5, 0, 5, 0, 5, 0])
+    answer = fetch_metrics(array([], dtype=int), array([]), [], [5, 5, 5],
+                           time, recovered_time, array([5, 1, 3]))
+    assert answer[1] == 3
+    assert np.array_equal(answer[3], [1, 3, 5])
+
+
+@pytest.mark.parametrize("window, overlap, expected", [
+    (4, 0, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]),
+    (4, 2, [[0, 1, 2, 3], [2, 3, 4, 5], [4, 5, 6, 7], [6, 7, 8, 9]]),
+    (5, 1, [[0, 1, 2, 3, 4], [4, 5, 6, 7, 8], [8, 9]]),
+    (20, 5, [[0, 1, 2, 3, 4, 5, 6, 7, 8, 9]]),
+])
+def test_stream_data(tmp_path, window, overlap, expected):
+    from ECG_processor import stream_data
+    path = tmp_path / "strip.csv"
+    rows = ["{},{}".format(i, 2 * i) for i in range(10)]
+    rows.insert(6, "nan,7")
+    path.write_text("time,voltage\n" + "\n".join(rows) + "\n")
+    answer = list(stream_data(str(path), window, overlap, chunksize=3))
+    assert [list(t) for t, v in answer] == expected
+    assert [list(v / 2) for t, v in answer] == expected
+
+
+@pytest.mark.parametrize("window, margin", [
+    (2**18, 2**12),
+    (4000, 500),
+    (2500, 600),
+])
+def test_analyze_stream(tmp_path, write_strip, window, margin):
+    from ECG_processor import analyze_strip, analyze_stream
+    path = write_strip(tmp_path / "strip.csv", duration=60,
+                       beat_times=0.3 + 0.752 * np.arange(79))
+    expected = analyze_strip(path)
+    answer = analyze_stream(path, window, margin)
+    assert answer["duration"] == expected["duration"]
+    assert answer["voltage_extremes"] == expected["voltage_extremes"]
+    assert answer["num_beats"] == expected["num_beats"]
+    assert answer["mean_hr_bpm"] == expected["mean_hr_bpm"]
+    assert np.allclose(answer["beats"], expected["beats"])
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+@pytest.mark.parametrize("decimals", [None, 0])
+def test_select_spilled_peaks(dtype, decimals):
+    import tempfile
+    from ECG_processor import _select_R_peaks, _select_spilled_peaks
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        size = int(rng.integers(4, 60))
+        values = 2 * rng.normal(size=size)
+        if decimals is not None:
+            values = np.round(values, decimals)
+        records = np.empty(size, [("time", np.float64), ("value", dtype)])
+        records["time"] = np.sort(rng.random(size))
+        records["value"] = values
+        new_peaks, _, _, _, beat_index = _select_R_peaks(
+            np.arange(size), records["value"].copy())
+        with tempfile.TemporaryFile() as spill:
+            spill.write(records.tobytes())
+            for chunk in (1, 3, 64):
+                num_beats, beats_time = _select_spilled_peaks(
+                    spill, records.dtype, size, chunk)
+                assert num_beats == len(new_peaks) + 3
+                assert np.array_equal(beats_time,
+                                      records["time"][beat_index])
+
+
+@pytest.mark.parametrize("engine", ["ideal", "sos", "fir"])
+def test_band_pass_filter(engine):
+    from ECG_processor import band_pass_filter
+    time = np.arange(0, 20, 1 / 250)
+    passed = np.sin(2 * np.pi * 10 * time)
+    voltage = passed + 2 + np.sin(2 * np.pi * 0.05 * time)
+    answer = band_pass_filter(time, voltage, engine)
+    assert answer.shape == voltage.shape
+    assert not np.iscomplexobj(answer)
+    middle = slice(1000, 4000)
+    assert np.abs(answer[middle] - passed[middle]).max() < 0.1
+
+
+@pytest.mark.parametrize("length, fs", [
+    (2500, 250),
+    (2501, 360),
+    (3, 1000),
+])
+def test_filter_mask(length, fs):
+    from ECG_processor import (band_pass_filter, filter_mask,
+                               fourier_transform, ideal_filter)
+    filter_mask.cache_clear()
+    time = np.arange(length) / fs
+    rng = np.random.default_rng(0)
+    for voltage in (rng.normal(size=length), rng.normal(size=(2, length))):
+        f_index, freq_ECG = fourier_transform(time, voltage)
+        expected = np.real(ideal_filter(f_index, voltage, freq_ECG))
+        answer = band_pass_filter(time, voltage)
+        assert answer.shape == voltage.shape
+        assert np.allclose(answer, expected, atol=1e-12)
+    info = filter_mask.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+    assert not filter_mask(length, float(fs)).flags.writeable
+
+
+def test_band_pass_filter_float32():
+    from ECG_processor import band_pass_filter
+    time = np.arange(0, 20, 1 / 250)
+    voltage = np.random.default_rng(0).normal(size=time.size)
+    answer = band_pass_filter(time, voltage.astype(np.float32))
+    assert answer.dtype == np.float32
+    assert np.allclose(answer, band_pass_filter(time, voltage), atol=1e-5)
+
+
+def test_band_pass_filter_engine():
+    from ECG_processor import band_pass_filter
+    with pytest.raises(ValueError):
+        band_pass_filter([0, 1, 2], [0, 1, 0], "fft")
+
+
+@pytest.mark.parametrize("engine", ["ideal", "sos", "fir"])
+def test_analyze_strip_engines(tmp_path, write_strip, engine):
+    from ECG_processor import analyze_strip
+    path = write_strip(tmp_path / "strip.csv")
+    answer = analyze_strip(path, filter_engine=engine)
+    assert answer["num_beats"] == 12
+    assert np.allclose(answer["beats"], np.arange(0.4, 10, 0.8))
+
+
+def write_leads(path, count=3, duration=10, fs=250):
+    t = np.arange(0, duration, 1 / fs)
+    leads = []
+    for i in range(count):
+        v = 0.1 * np.sin(2 * np.pi * 0.2 * t + i)
+        for bt in np.arange(0.4, duration, 0.8):
+            v += (1 + 0.2 * i) * np.exp(-((t - bt) / 0.01) ** 2)
+        leads.append(v)
+    header = "time," + ",".join("V{}".format(i + 1) for i in range(count))
+    np.savetxt(str(path), np.c_[t, np.array(leads).T], delimiter=',',
+               header=header, comments='')
+    return str(path), t, np.array(leads)
+
+
+def test_take_in_leads(tmp_path):
+    from ECG_processor import take_in_leads
+    path = tmp_path / "leads.csv"
+    path.write_text("time,I,II,III\n0,1,2,3\n0.1,4,x,6\n")
+    time, voltage, names = take_in_leads(str(path))
+    assert names == ["I", "II", "III"]
+    assert np.array_equal(time, [0, 0.1])
+    assert voltage.shape == (3, 2)
+    assert voltage.flags["C_CONTIGUOUS"]
+    assert np.array_equal(voltage[:, 0], [1, 2, 3])
+    assert np.isnan(voltage[1, 1])
+
+
+def test_clean_missing_leads():
+    from ECG_processor import clean_missing
+    time = [0, 1, 2, nan]
+    voltage = [[1, nan, 3, 4], [5, 6, 7, 8]]
+    answer1, answer2, report = clean_missing(time, voltage)
+    assert np.array_equal(answer1, [0, 2])
+    assert np.array_equal(answer2, [[1, 3], [5, 7]])
+    assert report["removed"] == 2
+    answer1, answer2, report = clean_missing(time, voltage, True)
+    assert np.array_equal(answer1, [0, 1, 2, 3])
+    assert np.array_equal(answer2, [[1, 2, 3, 4], [5, 6, 7, 8]])
+
+
+@pytest.mark.parametrize("engine", ["legacy", "pan_tompkins", "adaptive"])
+@pytest.mark.parametrize("decimals", [None, 0])
+def test_find_R_wave_leads(engine, decimals):
+    from ECG_processor import find_R_wave, find_R_wave_leads
+    rng = np.random.default_rng(0)
+    recovered_time = 3 * rng.normal(size=(4, 2500))
+    if decimals is not None:
+        recovered_time = np.round(recovered_time, decimals)
+    answer = find_R_wave_leads(recovered_time, engine, 250)
+    assert len(answer) == 4
+    for lead, (num_beats, beat_index) in zip(recovered_time, answer):
+        expected = find_R_wave(lead, True, engine, 250)[4]
+        assert num_beats == len(expected)
+        assert np.array_equal(beat_index, expected)
+
+
+@pytest.mark.parametrize("lead_beats, min_leads, expected", [
+    ([[1.0, 2.0, 3.0], [1.01, 2.02, 3.5], [0.99, 3.01]], None,
+     [1.0, 2.01, 3.005]),
+    ([[1.0, 2.0, 3.0], [1.01, 2.02, 3.5], [0.99, 3.01]], 3, [1.0]),
+    ([[1.0], [5.0]], 1, [1.0, 5.0]),
+    ([[], []], None, []),
+])
+def test_consensus_beats(lead_beats, min_leads, expected):
+    from ECG_processor import consensus_beats
+    answer = consensus_beats(lead_beats, 0.05, min_leads)
+    assert np.allclose(answer, expected)
+
+
+def test_analyze_leads(tmp_path):
+    from ECG_processor import analyze_leads
+    path, t, leads = write_leads(tmp_path / "leads.csv")
+    answer = analyze_leads(path)
+    assert list(answer["leads"]) == ["V1", "V2", "V3"]
+    assert answer["voltage_extremes"][0] == pytest.approx(leads.max())
+    for lead in answer["leads"].values():
+        assert lead["num_beats"] == 12
+        assert np.allclose(lead["beats"], np.arange(0.4, 10, 0.8))
+    assert np.allclose(answer["consensus_beats"], np.arange(0.4, 10, 0.8))
+    assert "consensus_beats" not in analyze_leads(path, consensus=False)
+
+
+def test_analyze_strip_metrics(tmp_path, write_strip):
+    import tracemalloc
+    from ECG_processor import analyze_strip
+    path = write_strip(tmp_path / "strip.csv")
+    metrics = []
+    tracemalloc.start()
+    try:
+        analyze_strip(path, metrics=metrics)
+    finally:
+        tracemalloc.stop()
+    assert [m["stage"] for m in metrics] == [
+        "take_in_data", "clean_missing", "extreme_detection",
+        "band_pass_filter", "find_R_wave", "fetch_metrics"]
+    for m in metrics:
+        assert m["wall_seconds"] >= 0
+        assert m["cpu_seconds"] >= 0
+        assert m["peak_bytes"] >= 0
+        assert m["traced"]
+        assert m["max_rss_growth_bytes"] is None or \
+            m["max_rss_growth_bytes"] >= 0
+    assert metrics[1]["input_size"] == 2500
+
+
+def test_process_file_instrument(tmp_path, write_strip):
+    import json
+    from ECG_processor import process_file
+    path = write_strip(tmp_path / "strip.csv")
+    seen = []
+    record = process_file(path, str(tmp_path), instrument=True,
+                          metrics_hook=lambda p, m: seen.append((p, m)))
+    assert seen == [(path, record["stages"])]
+    assert record["stages"][-1]["stage"] == "output_file"
+    assert not any(m["traced"] for m in record["stages"])
+    assert all("peak_bytes" not in m for m in record["stages"])
+    with open(str(tmp_path / "strip.csv.metrics.json")) as in_file:
+        assert json.load(in_file)["stages"] == record["stages"]
+    record = process_file(path, str(tmp_path), instrument=True,
+                          trace_memory=True)
+    assert all(m["traced"] for m in record["stages"])
+    assert all(m["peak_bytes"] >= 0 for m in record["stages"])
+    assert record["stages"][0]["peak_bytes"] > 0
+    record = process_file(path, str(tmp_path))
+    assert "stages" not in record
+
+
+def test_profile_file(tmp_path, write_strip):
+    import pstats
+    from ECG_processor import profile_file
+    path = write_strip(tmp_path / "strip.csv")
+    stats_path = str(tmp_path / "strip.prof")
+    record = profile_file(path, stats_path, str(tmp_path))
+    assert record["status"] == "ok"
+    stats = pstats.Stats(stats_path)
+    assert any(f[2] == "analyze_strip" for f in stats.stats)
+
+
+STARTUP_TARGET = 0.5
+
+
+def test_startup_time():
+    import os
+    import sys
+    import subprocess
+    from time import perf_counter
+    code = ("import sys, ECG_processor; print(','.join(m for m in "
+            "('pandas', 'scipy', 'matplotlib') if m in sys.modules))")
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = np.inf
+    for i in range(3):
+        start = perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], cwd=here,
+                                stdout=subprocess.PIPE, check=True)
+        best = min(best, perf_counter() - start)
+    assert result.stdout.decode().strip() == ""
+    assert best < STARTUP_TARGET
+
+
+def test_main_needs_source(capsys):
+    from ECG_processor import main
+    with pytest.raises(SystemExit):
+        main([])
+    assert "--interactive" in capsys.readouterr().err
+
+
+def test_plot_strip(tmp_path, write_strip):
+    pytest.importorskip("matplotlib")
+    from ECG_processor import plot_strip
+    path = write_strip(tmp_path / "strip.csv")
+    figure = plot_strip(path, out_path=str(tmp_path / "strip.png"))
+    assert len(figure.axes[0].lines) == 2
+    assert len(figure.axes[0].lines[1].get_xdata()) == 12
+    assert (tmp_path / "strip.png").exists()
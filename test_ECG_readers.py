@@ -0,0 +1,159 @@
+import json
+import pytest
+import numpy as np
+
+
+def digital_strip(duration=10, fs=250, channels=2):
+    from ECG_benchmark import synthetic_ecg
+    _, voltage, beats = synthetic_ecg(duration, fs, noise=0.01)
+    leads = np.stack([voltage * (i + 1) for i in range(channels)], axis=1)
+    return np.round(leads * 200).astype(np.int16), beats
+
+
+def write_raw(path, digital, fs=250, dtype="int16", **header):
+    header.update({"fs": fs, "dtype": dtype, "channels": digital.shape[1]})
+    digital.astype(dtype).tofile(str(path))
+    with open(str(path.with_suffix(".hdr")), "w") as out_file:
+        json.dump(header, out_file)
+    return str(path)
+
+
+def write_wfdb(directory, digital, fs=250, form="16"):
+    name = "rec"
+    if form == "16":
+        digital.astype("<i2").tofile(str(directory / "rec.dat"))
+    else:
+        flat = digital.reshape(-1).astype(np.int32) & 0xfff
+        if len(flat) % 2:
+            flat = np.append(flat, 0)
+        first, second = flat[0::2], flat[1::2]
+        packed = np.stack([first & 0xff,
+                           ((first >> 8) & 0x0f) | ((second >> 4) & 0xf0),
+                           second & 0xff], axis=1).astype(np.uint8)
+        packed.tofile(str(directory / "rec.dat"))
+    lines = ["{} {} {} {}".format(name, digital.shape[1], fs,
+                                  digital.shape[0])]
+    for i in range(digital.shape[1]):
+        lines.append("rec.dat {} 200(10)/mV 12 0 0 0 0 lead{}".format(
+            form, i))
+    path = directory / "rec.hea"
+    path.write_text("\n".join(lines) + "\n# a comment\n")
+    return str(path)
+
+
+def write_edf(path, digital, fs=250, per_record=250):
+    count = digital.shape[0] // per_record
+    ns = digital.shape[1] + 1
+
+    def fields(values, width):
+        return "".join(str(value).ljust(width)[:width] for value in values)
+    header = ("0".ljust(8) + "patient".ljust(80) + "recording".ljust(80) +
+              "01.01.20" + "00.00.00" + str(256 * (ns + 1)).ljust(8) +
+              "".ljust(44) + str(count).ljust(8) +
+              str(per_record / fs).ljust(8) + str(ns).ljust(4))
+    labels = ["ECG{}".format(i) for i in range(ns - 1)] + ["EDF Annotations"]
+    header += fields(labels, 16) + fields([""] * ns, 80)
+    header += fields(["uV"] * (ns - 1) + [""], 8)
+    header += fields([-32768 * 5] * ns, 8) + fields([32767 * 5] * ns, 8)
+    header += fields([-32768] * ns, 8) + fields([32767] * ns, 8)
+    header += fields([""] * ns, 80)
+    header += fields([per_record] * (ns - 1) + [10], 8)
+    header += fields([""] * ns, 32)
+    with open(str(path), "wb") as out_file:
+        out_file.write(header.encode("ascii"))
+        for i in range(count):
+            block = digital[i * per_record:(i + 1) * per_record]
+            for lead in block.T:
+                out_file.write(lead.astype("<i2").tobytes())
+            out_file.write(np.zeros(10, dtype="<i2").tobytes())
+    return str(path)
+
+
+@pytest.mark.parametrize("dtype", ["int16", "float32"])
+def test_read_raw(tmp_path, dtype):
+    from ECG_readers import read_record, read_signal
+    digital, _ = digital_strip()
+    path = write_raw(tmp_path / "strip.raw", digital, dtype=dtype, gain=200,
+                     offset=[0, 10], names=["I", "II"])
+    time, voltage, names = read_record(path)
+    assert names == ["I", "II"]
+    assert voltage.shape == (2, 2500)
+    assert np.allclose(time, np.arange(2500) / 250)
+    assert np.allclose(voltage[0], digital[:, 0] / 200)
+    assert np.allclose(voltage[1], (digital[:, 1] - 10) / 200)
+    time, voltage = read_signal(path, np.float32)
+    assert voltage.dtype == np.float32
+    assert voltage.flags["C_CONTIGUOUS"]
+    assert np.allclose(voltage, digital[:, 0] / 200, atol=1e-6)
+
+
+def test_raw_memmap(tmp_path):
+    from ECG_readers import open_record
+    digital, _ = digital_strip(channels=1)
+    path = write_raw(tmp_path / "strip.raw", digital, units="uV")
+    record = open_record(path)
+    assert isinstance(record.digital(10, 20).base, np.memmap)
+    assert record.length == 2500
+    assert np.allclose(record.voltage(10, 20)[0], digital[10:20, 0] / 1000)
+
+
+@pytest.mark.parametrize("form", ["16", "212"])
+def test_read_wfdb(tmp_path, form):
+    from ECG_readers import read_record, open_record
+    digital, _ = digital_strip(channels=3)
+    digital = np.clip(digital, -2000, 2000)
+    digital[5, 1] = -32768 if form == "16" else -2048
+    path = write_wfdb(tmp_path, digital, form=form)
+    time, voltage, names = read_record(path)
+    assert names == ["lead0", "lead1", "lead2"]
+    assert voltage.shape == (3, 2500)
+    expected = (digital.T - 10) / 200
+    assert np.isnan(voltage[1, 5])
+    voltage[1, 5] = expected[1, 5]
+    assert np.allclose(voltage, expected)
+    record = open_record(path)
+    assert np.array_equal(record.digital(101, 104), digital[101:104])
+
+
+def test_read_edf(tmp_path):
+    from ECG_readers import read_record, open_record
+    digital, _ = digital_strip()
+    path = write_edf(tmp_path / "strip.edf", digital)
+    time, voltage, names = read_record(path)
+    assert names == ["ECG0", "ECG1"]
+    assert np.allclose(time, np.arange(2500) / 250)
+    assert np.allclose(voltage, digital.T * 5 / 1000, atol=1e-6)
+    record = open_record(path)
+    assert np.array_equal(record.digital(240, 260), digital[240:260])
+
+
+def test_iter_record(tmp_path):
+    from ECG_readers import iter_record, read_signal
+    digital, _ = digital_strip()
+    path = write_wfdb(tmp_path, digital)
+    pieces = list(iter_record(path, 1000, channel=1))
+    assert [len(t) for t, _ in pieces] == [1000, 1000, 500]
+    time, voltage = read_signal(path, channel=1)
+    assert np.array_equal(np.concatenate([t for t, _ in pieces]), time)
+    assert np.array_equal(np.concatenate([v for _, v in pieces]), voltage)
+
+
+def test_unknown_extension(tmp_path):
+    from ECG_readers import open_record, is_binary
+    assert not is_binary("strip.csv")
+    with pytest.raises(ValueError):
+        open_record(str(tmp_path / "strip.xyz"))
+
+
+def test_analyze_binary(tmp_path):
+    from ECG_processor import analyze_strip, analyze_stream, collect_paths
+    digital, beats = digital_strip(30, channels=1)
+    path = write_wfdb(tmp_path, digital)
+    answer = analyze_strip(path)
+    assert answer["num_beats"] == len(beats)
+    assert np.allclose(answer["beats"], beats, atol=0.02)
+    streamed = analyze_stream(path, window=2048, margin=256)
+    assert streamed["num_beats"] == len(beats)
+    write_raw(tmp_path / "strip.raw", digital, gain=200)
+    assert collect_paths(str(tmp_path)) == [str(tmp_path / "rec.hea"),
+                                            str(tmp_path / "strip.raw")]
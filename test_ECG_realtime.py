@@ -0,0 +1,51 @@
+import pytest
+import numpy as np
+
+
+def synthetic(strip, duration=30, interval=0.8):
+    return strip(duration, beat_times=np.arange(0.3, duration - 0.1, interval),
+                 wander=0.3, noise=0.02)
+
+
+@pytest.mark.parametrize("block", [1, 7, 10, 250, 7500])
+def test_streaming_detector_blocks(synthetic_strip, block):
+    from ECG_realtime import StreamingRDetector
+    t, v, truth = synthetic(synthetic_strip)
+    detector = StreamingRDetector(250)
+    beats = []
+    for first in range(0, len(v), block):
+        beats.extend(detector.push(v[first:first + block]))
+    beats.extend(detector.flush())
+    assert len(beats) == len(truth)
+    assert np.abs(np.array(beats) - truth).max() < 0.01
+    assert detector.mean_hr_bpm == pytest.approx(75, abs=0.5)
+
+
+@pytest.mark.parametrize("interval, rr_window", [
+    (0.6, 4),
+    (1.2, 8),
+])
+def test_streaming_detector_rate(synthetic_strip, interval, rr_window):
+    from ECG_realtime import StreamingRDetector
+    t, v, truth = synthetic(synthetic_strip, interval=interval)
+    detector = StreamingRDetector(250, rr_window=rr_window)
+    beats = detector.push(v) + detector.flush()
+    assert len(beats) == len(truth)
+    assert len(detector._rr) == rr_window
+    assert detector.mean_hr_bpm == pytest.approx(60 / interval, abs=0.5)
+
+
+def test_replay(tmp_path, synthetic_strip, write_csv):
+    from ECG_realtime import replay
+    t, v, truth = synthetic(synthetic_strip, duration=10)
+    path = write_csv(tmp_path / "strip.csv", t, v)
+    stats = replay(path, speed=100)
+    assert stats["num_beats"] == len(truth)
+    assert stats["samples"] == len(t)
+    assert stats["elapsed"] >= 10 / 100
+    assert stats["latency_p95"] < 0.2
+    assert stats["delay_budget"] == pytest.approx(0.24)
+    assert 0 < stats["delay_mean"] <= stats["delay_max"]
+    assert stats["delay_max"] <= stats["delay_budget"]
+    assert stats["over_budget"] == 0
+    assert stats["realtime_factor"] > 1
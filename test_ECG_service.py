@@ -0,0 +1,144 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+import numpy as np
+
+
+def post(url, body, content_type="text/csv"):
+    request = urllib.request.Request(url + "/analyze", data=body,
+                                     headers={"Content-Type": content_type})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def get(url, path):
+    with urllib.request.urlopen(url + path, timeout=30) as response:
+        return json.loads(response.read())
+
+
+def test_service(tmp_path):
+    from ECG_service import ECGService
+    from ECG_processor import analyze_strip
+    from ECG_benchmark import write_synthetic_csv
+    path = str(tmp_path / "strip.csv")
+    beats = write_synthetic_csv(path, 20)
+    expected = analyze_strip(path)
+    with ECGService(port=0, workers=2, root=str(tmp_path),
+                    spool_dir=str(tmp_path)) as service:
+        assert get(service.url, "/health") == {"status": "ok"}
+        with open(path, "rb") as in_file:
+            status, answer = post(service.url, in_file.read())
+        assert status == 200
+        assert answer["num_beats"] == len(beats) == expected["num_beats"]
+        assert np.allclose(answer["beats"], expected["beats"])
+        status, answer = post(service.url, json.dumps({"path": path}).encode(),
+                              "application/json")
+        assert status == 200
+        assert answer["num_beats"] == len(beats)
+        status, answer = post(service.url, b"time,voltage\n0,1\n")
+        assert status == 422
+        status, _ = post(service.url, b'{"path": "/etc/passwd"}',
+                         "application/json")
+        assert status == 403
+        status, _ = post(service.url, b"{}", "application/json")
+        assert status == 400
+        stats = get(service.url, "/stats")
+    assert stats["submitted"] == 3
+    assert stats["completed"] == 2
+    assert stats["failed"] == 1
+    assert stats["latency_max"] >= stats["service_max"] > 0
+    assert stats["strips_per_second"] > 0
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["strip.csv"]
+
+
+def test_service_concurrent(tmp_path):
+    from ECG_service import ECGService
+    from ECG_benchmark import write_synthetic_csv
+    paths = [str(tmp_path / "s{}.csv".format(i)) for i in range(3)]
+    counts = [len(write_synthetic_csv(path, 10 + 5 * i))
+              for i, path in enumerate(paths)]
+    answers = {}
+
+    def client(i):
+        body = json.dumps({"path": paths[i % 3]}).encode()
+        answers[i] = post(service.url, body, "application/json")
+    with ECGService(port=0, workers=2, max_pending=32) as service:
+        threads = [threading.Thread(target=client, args=(i,))
+                   for i in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = service.stats()
+    for i in range(12):
+        status, answer = answers[i]
+        assert status == 200
+        assert answer["num_beats"] == counts[i % 3]
+    assert stats["completed"] == 12
+    assert stats["in_flight"] == 0
+
+
+def test_service_backpressure(tmp_path, monkeypatch):
+    import ECG_processor
+    from ECG_service import ECGService, ServiceBusy
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocked(path, **options):
+        started.set()
+        release.wait(30)
+        return {"path": path}
+    monkeypatch.setattr(ECG_processor, "analyze_strip", blocked)
+    with ECGService(port=0, workers=1, max_pending=1) as service:
+        first = service.submit(path="a.csv")
+        assert started.wait(30)
+        second = service.submit(path="b.csv")
+        with pytest.raises(ServiceBusy):
+            service.submit(path="c.csv")
+        status, answer = post(service.url, b"time,voltage\n0,1\n")
+        assert status == 503
+        assert service.stats()["rejected"] == 2
+        assert service.stats()["in_flight"] == 1
+        release.set()
+        assert first.result(30) == {"path": "a.csv"}
+        assert second.result(30) == {"path": "b.csv"}
+    with pytest.raises(ValueError):
+        service.submit()
+
+
+def test_service_spreads_burst(monkeypatch):
+    import ECG_processor
+    from ECG_service import ECGService
+    barrier = threading.Barrier(3)
+    threads = set()
+
+    def meet(path, **options):
+        threads.add(threading.current_thread())
+        barrier.wait(30)
+        return {"path": path}
+    monkeypatch.setattr(ECG_processor, "analyze_strip", meet)
+    with ECGService(port=0, workers=3, max_pending=8) as service:
+        futures = [service.submit(path=name) for name in "abc"]
+        assert [f.result(30)["path"] for f in futures] == list("abc")
+        assert service.stats()["in_flight"] == 0
+        assert threads == set(service.pipeline.executor._threads)
+
+
+@pytest.mark.parametrize("length", ["abc", "-5"])
+def test_service_bad_length(length):
+    import http.client
+    from ECG_service import ECGService
+    with ECGService(port=0, workers=1) as service:
+        host, port = service.url[len("http://"):].split(":")
+        connection = http.client.HTTPConnection(host, int(port), timeout=30)
+        connection.putrequest("POST", "/analyze")
+        connection.putheader("Content-Length", length)
+        connection.endheaders()
+        response = connection.getresponse()
+        assert response.status == 400
+        connection.close()
@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+
+def write_archive(directory, count, bad=()):
+    from ECG_benchmark import write_synthetic_csv
+    directory.mkdir()
+    paths = []
+    for i in range(count):
+        path = str(directory / "s{}.csv".format(i))
+        if i in bad:
+            with open(path, "w") as out_file:
+                out_file.write("time,voltage\n0,1\n")
+        else:
+            write_synthetic_csv(path, 10, seed=i)
+        paths.append(path)
+    return paths
+
+
+def test_shard_paths():
+    from ECG_shard import shard_paths, shard_of
+    paths = ["data/{}/s{}.csv".format(i % 7, i) for i in range(200)]
+    shards = [shard_paths(paths, i, 4) for i in range(4)]
+    assert sorted(sum(shards, [])) == sorted(paths)
+    assert all(30 < len(shard) < 70 for shard in shards)
+    assert shard_of("data/1/s8.csv", 4) == shard_of("data//1/./s8.csv", 4)
+    assert shard_paths(list(reversed(paths)), 2, 4) == shards[2]
+    with pytest.raises(ValueError):
+        shard_paths(paths, 4, 4)
+
+
+def test_run_shard_resume(tmp_path):
+    from ECG_shard import run_shard, read_manifest
+    paths = write_archive(tmp_path / "data", 6, bad=(4,))
+    out_dir = tmp_path / "out"
+    first = run_shard(paths, 0, 1, str(out_dir), checkpoint=2, workers=1)
+    assert (first["processed"], first["failed"]) == (6, 1)
+    manifest = out_dir / "shard-0-of-1.jsonl"
+    lines = manifest.read_text().splitlines()
+    assert len(lines) == 7
+    manifest.write_text("\n".join(lines[:3]) + '\n{"path": "dat')
+    seen = []
+    second = run_shard(paths, 0, 1, str(out_dir), checkpoint=2, workers=1,
+                       progress=lambda d, t, r: seen.append(r["path"]))
+    assert second["skipped"] == 2
+    assert second["processed"] == 4
+    assert sorted(seen) == sorted(set(paths) - set(
+        json.loads(line)["path"] for line in lines[1:3]))
+    third = run_shard(paths, 0, 1, str(out_dir), workers=1)
+    assert (third["skipped"], third["processed"]) == (6, 0)
+    retry = run_shard(paths, 0, 1, str(out_dir), workers=1,
+                      retry_failed=True)
+    assert [r["path"] for r in retry["records"]] == [paths[4]]
+    records = read_manifest(str(manifest))["records"]
+    assert len(records) == 6
+    assert records[paths[4]]["status"] == "error"
+
+
+def test_run_shard_same_names(tmp_path):
+    from ECG_shard import run_shard, read_manifest
+    from ECG_processor import collect_paths
+    from ECG_output import read_results
+    write_archive(tmp_path / "data", 0)
+    write_archive(tmp_path / "data" / "a", 2)
+    write_archive(tmp_path / "data" / "b", 1)
+    paths = collect_paths(str(tmp_path / "data"), recursive=True)
+    assert len(paths) == 3
+    out_dir = tmp_path / "out"
+    summary = run_shard(paths, 0, 1, str(out_dir), workers=1,
+                        output_mode="json")
+    assert summary["failed"] == 0
+    names = ["a%2Fs0.csv", "a%2Fs1.csv", "b%2Fs0.csv"]
+    assert sorted(read_results("json", summary["output"])) == names
+    assert sorted(os.listdir(summary["output"])) == sorted(
+        [name + ".json" for name in names] + [name + ".log"
+                                              for name in names])
+    records = read_manifest(str(out_dir / "shard-0-of-1.jsonl"))["records"]
+    assert sorted(r["name"] for r in records.values()) == names
+
+
+def test_shards_in_processes(tmp_path):
+    from ECG_shard import merge_shards
+    from ECG_output import read_results
+    paths = write_archive(tmp_path / "data", 9, bad=(3,))
+    out_dir = str(tmp_path / "out")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "ECG_shard.py")
+    processes = [subprocess.Popen(
+        [sys.executable, script, "run", str(tmp_path / "data"),
+         "--shard", str(i), "--shards", "3", "-o", out_dir, "-j", "1",
+         "--checkpoint", "2"], stdout=subprocess.PIPE)
+        for i in range(3)]
+    outputs = [json.loads(process.communicate(timeout=120)[0])
+               for process in processes]
+    assert sum(output["processed"] for output in outputs) == 9
+    summary = merge_shards(out_dir)
+    assert summary["complete"]
+    assert (summary["total"], summary["succeeded"]) == (9, 8)
+    assert summary["failures"][0]["path"] == paths[3]
+    assert summary["seconds"] > 0
+    assert [s["shard"] for s in summary["per_shard"]] == [0, 1, 2]
+    merged = os.path.join(out_dir, "merged")
+    assert summary["output"] == os.path.join(merged, "results.jsonl")
+    names = sorted(os.path.basename(path) for i, path in enumerate(paths)
+                   if i != 3)
+    assert sorted(read_results("jsonl", merged)) == names
+    assert merge_shards(out_dir)["output"] == summary["output"]
+    with open(summary["output"]) as in_file:
+        assert len(in_file.readlines()) == 8
+    summary = merge_shards(out_dir, "json")
+    assert summary["output"] == merged
+    assert sorted(read_results("json", merged)) == names
+    assert sorted(os.listdir(merged)) == [name + ".json" for name in names]
+    with open(os.path.join(out_dir, "summary.json")) as in_file:
+        assert json.load(in_file)["total"] == 9